@@ -1,26 +1,19 @@
-import os
-import re
 import glob
-import itertools
-import json
-import re
-import unidecode
-
-# create list in order to begin for loop
-files=glob.glob("*.json")
+import os
 
-#setup for loop to go through each csv  in dir, then find  and convert the unicode Greek  chars to Roman alphabet
-for file in files:
-  #open file, read mode
-  file_conn=open(file,"r")
-  json_contents = json.load(file_conn)
-  file_conn.close()
+import text_normalization
 
-  for i, work in enumerate(json_contents['author_works']):
-    for j, section in enumerate(work['sections']):
-      for k, line in enumerate(section['lines']):
-        json_contents['author_works'][i]['sections'][j]['lines'][k] = unidecode.unidecode(line)
+# worker processes re-import this file when they start (e.g., on macOS and
+# Windows), so only the main process should look for files and start them
+if __name__ == '__main__':
+  # create list in order to begin for loop
+  files=glob.glob("*.json")
 
-  file_conn=open(file,"w")
-  json.dump(json_contents, file_conn, indent=2, ensure_ascii=True)
-  file_conn.close()
+  # convert the unicode Greek chars in each json file in this dir to Roman
+  # alphabet, replacing the files; each file is read and written a section at
+  # a time, several files at once, and only replaced once its new copy is
+  # complete (see text_normalization.normalize_corpus)
+  # note that pipeline.py can instead transliterate as it parses, without
+  # rewriting the files (see transliterate_greek there)
+  text_normalization.normalize_corpus(
+    files, os.getcwd(), number_of_workers=os.cpu_count() or 1)
@@ -0,0 +1,122 @@
+'''Choose how many parsed lines to batch before writing them, as a run goes.
+
+pipeline.py writes parsed lines in batches of a fixed size (write_lines). A
+small batch means a DataFrame and a file append for every few lines; a large
+one holds more parsed lines in memory, and more parsing is lost if a run is
+interrupted mid-section. An AdaptiveBatchSize, passed as write_lines (or
+batch_size) to create_csvs, starts from a given size and, after each batch:
+
+  - halves it, if this process's memory is above a budget;
+  - otherwise doubles it, if writing the batch took more than a target share
+    of the time spent parsing and writing it;
+  - and caps it at the number of lines parsed (at the measured rate) in
+    max_batch_seconds, so that output is never far behind parsing.
+
+Batches still end at section boundaries (see
+create_csvs.section_to_line_batches()), so a finished section is always
+written in full. Each batch's size is recorded with run_metrics.observe()
+as "batch_size", and so appears in the run log.
+'''
+
+import logging
+
+import run_metrics
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+
+def current_rss_mb() -> float:
+  '''The current resident memory of this process, in MB, or None if psutil
+  isn't installed.'''
+  try:
+    import psutil
+  except ImportError:
+    return None
+
+  return psutil.Process().memory_info().rss / 1024 ** 2
+
+
+class AdaptiveBatchSize():
+  '''A batch size that adapts to write latency, parsing rate, and memory.
+
+  Args:
+    initial: The size of the first batch, in lines. Defaults to 10.
+
+    minimum: The smallest size to choose. Defaults to 1.
+
+    maximum: The largest size to choose. Defaults to 1000.
+
+    memory_budget_mb: The resident memory, in MB, above which batches are
+      made smaller. Defaults to None, which doesn't check memory.
+
+    target_write_share: The share of each batch's time that writing may take
+      before batches are made larger. Defaults to 0.05.
+
+    max_batch_seconds: The most parsing time a batch should hold. Defaults to
+      30.
+  '''
+
+  def __init__(
+      self,
+      initial: int = 10,
+      minimum: int = 1,
+      maximum: int = 1000,
+      memory_budget_mb: float = None,
+      target_write_share: float = 0.05,
+      max_batch_seconds: float = 30):
+    self.size = max(minimum, min(initial, maximum))
+    self.minimum = minimum
+    self.maximum = maximum
+    self.memory_budget_mb = memory_budget_mb
+    self.target_write_share = target_write_share
+    self.max_batch_seconds = max_batch_seconds
+
+  def __repr__(self) -> str:
+    return (f'AdaptiveBatchSize(size={self.size}, minimum={self.minimum}, '
+            f'maximum={self.maximum}, '
+            f'memory_budget_mb={self.memory_budget_mb})')
+
+  def record(self, lines: int, parse_seconds: float,
+             write_seconds: float) -> int:
+    '''Record a batch, and choose the size of the next one.
+
+    Args:
+      lines: The number of lines in the batch.
+
+      parse_seconds: The time taken to parse (and score) them.
+
+      write_seconds: The time taken to write them (in the writer thread, if
+        they were handed to one; see create_csvs.mqdq_to_csv()).
+
+    Output: The new size.
+    '''
+    run_metrics.observe('batch_size', lines)
+    if lines == 0:
+      return self.size
+
+    size = self.size
+    reason = None
+    rss_mb = current_rss_mb() if self.memory_budget_mb is not None else None
+    if rss_mb is not None and rss_mb > self.memory_budget_mb:
+      size = self.size // 2
+      reason = f'memory {rss_mb:.0f} MB is above {self.memory_budget_mb} MB'
+    elif lines >= self.size and write_seconds > self.target_write_share * (
+        parse_seconds + write_seconds):
+      # (only batches that were full say anything about larger ones)
+      size = self.size * 2
+      reason = (f'writing took {write_seconds:.3f}s of '
+                f'{parse_seconds + write_seconds:.3f}s')
+
+    if parse_seconds > 0:
+      lines_per_second = lines / parse_seconds
+      if size > lines_per_second * self.max_batch_seconds:
+        size = int(lines_per_second * self.max_batch_seconds)
+        reason = f'parsing {lines_per_second:.1f} lines per second'
+
+    size = max(self.minimum, min(size, self.maximum))
+    if size != self.size:
+      logger.info('Batch size %d -> %d lines (%s).', self.size, size, reason)
+      self.size = size
+
+    return self.size
@@ -0,0 +1,282 @@
+'''Summarize pipeline output per file, as analysis/01_cleaning.r does.
+
+analysis/01_cleaning.r reads every CSV of a pipeline output directory into
+one data frame (MQDQII_functions.r::read_csv_folder, which grows it with
+rbind) before cleaning it. Every step of the cleaning works within a single
+file, though: meter corrections and date corrections are looked up line by
+line, and the line counts and enumerativeness rates are per file. So here
+each output file is read on its own, in chunks and only for the columns
+the cleaning needs, by a pool of worker processes. Each file is reduced to
+its summary rows. The results are written as one small CSV with the columns
+that analysis/02_plotting.r and analysis/03_table.r use:
+
+  folder, file, author_name, date, n, high_count, one_count,
+  enumerativeness_rate8, enumerativeness_rate1
+
+Usage:
+
+  python3 aggregate.py CSVS_No_Exclusion \\
+    analysis/tables/CSVS_No_Exclusion_summary.csv
+
+  python3 aggregate.py CSVS_No_Exclusion \\
+    analysis/tables/CSVS_No_Exclusion_PhalecianHendecasyllables_summary.csv \\
+    --tokens-threshold 0 --lines-threshold 0 \\
+    --included-meter "Phalecian hendecasyllables"
+'''
+
+import argparse
+import csv
+import functools
+from glob import glob
+import logging
+import multiprocessing
+import os
+
+import pandas as pd
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+analysis_directory = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'analysis')
+
+# The columns of pipeline output that the summary needs:
+used_columns = [
+    'author_name', 'author_date', 'work_name', 'section_meter', 'tokens',
+    'enumerativeness']
+string_columns = ['author_name', 'author_date', 'work_name', 'section_meter']
+
+summary_columns = [
+    'folder', 'file', 'author_name', 'date', 'n', 'high_count', 'one_count',
+    'enumerativeness_rate8', 'enumerativeness_rate1']
+
+
+def read_cleaning_csv(path: str) -> pd.DataFrame:
+  '''Read one of the analysis/*_cleaning.csv files as readr::read_csv
+  would: with a byte order mark removed, whitespace trimmed from the column
+  names and values, and "" and "NA" read as missing values.'''
+  data = pd.read_csv(
+      path, dtype=str, encoding='utf-8-sig', keep_default_na=False,
+      na_values=['', 'NA'], skipinitialspace=True)
+  data.columns = [column.strip() for column in data.columns]
+  for column in data.columns:
+    data[column] = data[column].str.strip().replace('', None)
+  return data
+
+
+def read_output_chunks(path: str, chunk_lines: int = 100000):
+  '''Read the used_columns of a pipeline output file (CSV or Parquet) in
+  chunks of up to chunk_lines lines, with string values trimmed as
+  readr::read_csv would.'''
+  if path.endswith('.parquet'):
+    import pyarrow.parquet as pq
+
+    chunks = (
+        batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(
+            batch_size=chunk_lines, columns=used_columns))
+  else:
+    header = pd.read_csv(path, nrows=0).columns
+    if not set(used_columns).issubset(header):
+      logger.warning('"%s" is missing expected columns. Skipping it...', path)
+      return
+    chunks = pd.read_csv(
+        path, usecols=used_columns, chunksize=chunk_lines,
+        dtype={column: str for column in string_columns},
+        keep_default_na=False, na_values=['', 'NA'])
+
+  for chunk in chunks:
+    for column in string_columns:
+      chunk[column] = chunk[column].astype(object).where(
+          chunk[column].notna(), None)
+      chunk[column] = chunk[column].str.strip()
+    yield chunk
+
+
+def split_author_date(author_date: pd.Series) -> pd.DataFrame:
+  '''Split author_date on "-" into "min" and "max", as
+  tidyr::separate(sep = "-", fill = "right") does in
+  MQDQII_functions.r::convert_years.'''
+  parts = [
+      value.split('-')[:2] if isinstance(value, str) else []
+      for value in author_date]
+  parts = [part + [None] * (2 - len(part)) for part in parts]
+  return pd.DataFrame([
+      [value.strip() if value is not None else None for value in part]
+      for part in parts], columns=['min', 'max'], index=author_date.index)
+
+
+def summarize_file(
+    path: str,
+    meter_corrections: pd.DataFrame,
+    date_corrections: pd.DataFrame,
+    tokens_threshold: int = 3,
+    lines_threshold: int = 500,
+    included_meters: tuple = ('Hexameters', 'Elegiac couplets')) -> list:
+  '''Clean and summarize one pipeline output file, as
+  analysis/01_cleaning.r::cleaning does.
+
+  Args:
+    path: A CSV or Parquet file written by pipeline.py.
+
+    meter_corrections: analysis/meter_cleaning.csv, from read_cleaning_csv.
+
+    date_corrections: analysis/dates_cleaning.csv, from read_cleaning_csv.
+
+    tokens_threshold: Only lines with more than this many tokens are kept.
+
+    lines_threshold: Only files with more than this many lines left are kept.
+
+    included_meters: Only lines in these meters (after meter corrections)
+      are kept.
+
+  Output: A list of dicts with the keys in summary_columns, one for each
+    distinct (author_name, date) in the file, or an empty list if the file
+    is excluded.
+  '''
+  # Like read_csv_folder, the file is recorded as a CSV file name, which is
+  # also how dates_cleaning.csv refers to it:
+  file = f'{os.path.splitext(os.path.basename(path))[0]}.csv'
+  folder = os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+  counts = []
+  for chunk in read_output_chunks(path):
+    # Clean meters, with a hash join on author, work, and meter:
+    chunk = chunk.merge(
+        meter_corrections,
+        on=['author_name', 'work_name', 'section_meter'], how='left')
+    chunk['section_meter'] = chunk['Corrected_meter'].where(
+        chunk['Corrected_meter'].notna(), chunk['section_meter'])
+
+    chunk = chunk[
+        chunk['section_meter'].isin(included_meters) &
+        (chunk['tokens'] > tokens_threshold)]
+
+    enumerativeness = pd.to_numeric(chunk['enumerativeness'])
+    counts.append(pd.DataFrame({
+        'author_name': chunk['author_name'],
+        'author_date': chunk['author_date'],
+        'lines': 1,
+        'high_count': (enumerativeness > .8).astype(int),
+        'one_count': (enumerativeness == 1).astype(int),
+    }).groupby(['author_name', 'author_date'], dropna=False).sum())
+
+  if len(counts) == 0:
+    return []
+
+  counts = pd.concat(counts).groupby(level=[0, 1], dropna=False).sum()
+  n = int(counts['lines'].sum())
+  if not n > lines_threshold:
+    return []
+
+  # Convert author dates for each distinct author and date, rather than for
+  # each line:
+  authors = counts.index.to_frame(index=False)
+  authors = pd.concat([authors, split_author_date(authors['author_date'])],
+                      axis=1)
+  authors['file'] = file
+  authors = authors.merge(
+      date_corrections, on=['min', 'max', 'author_name', 'file'],
+      how='left')
+
+  high_count = int(counts['high_count'].sum())
+  one_count = int(counts['one_count'].sum())
+  summary = []
+  for author_name, date in authors[['author_name', 'New Date']].drop_duplicates(
+      ).itertuples(index=False):
+    summary.append({
+        'folder': folder,
+        'file': file,
+        'author_name': author_name,
+        'date': pd.to_numeric(date) if pd.notna(date) else None,
+        'n': n,
+        'high_count': high_count,
+        'one_count': one_count,
+        'enumerativeness_rate8': high_count / n,
+        'enumerativeness_rate1': one_count / n,
+    })
+
+  return summary
+
+
+def summarize_folder(
+    input_directory: str,
+    output_file: str,
+    tokens_threshold: int = 3,
+    lines_threshold: int = 500,
+    included_meters: tuple = ('Hexameters', 'Elegiac couplets'),
+    meter_cleaning_file: str = os.path.join(
+        analysis_directory, 'meter_cleaning.csv'),
+    dates_cleaning_file: str = os.path.join(
+        analysis_directory, 'dates_cleaning.csv'),
+    number_of_workers: int = None) -> pd.DataFrame:
+  '''Summarize every output file in input_directory into output_file.
+
+  Args:
+    input_directory: A directory of CSV or Parquet files from pipeline.py.
+
+    output_file: The summary CSV to write.
+
+    tokens_threshold, lines_threshold, included_meters: See summarize_file.
+
+    meter_cleaning_file: The meter corrections. Defaults to
+      analysis/meter_cleaning.csv.
+
+    dates_cleaning_file: The date corrections. Defaults to
+      analysis/dates_cleaning.csv.
+
+    number_of_workers: The number of processes to read files with. Defaults
+      to the number of cores.
+
+  Output: The summary, as a DataFrame, which is also written to output_file.
+  '''
+  paths = sorted(
+      glob(os.path.join(input_directory, '*.csv')) +
+      glob(os.path.join(input_directory, '*.parquet')))
+
+  summarize = functools.partial(
+      summarize_file,
+      meter_corrections=read_cleaning_csv(meter_cleaning_file),
+      date_corrections=read_cleaning_csv(dates_cleaning_file),
+      tokens_threshold=tokens_threshold,
+      lines_threshold=lines_threshold,
+      included_meters=tuple(included_meters))
+
+  logger.info('Summarizing %d files...', len(paths))
+  with multiprocessing.Pool(number_of_workers) as pool:
+    summaries = pool.map(summarize, paths, chunksize=1)
+
+  summary = pd.DataFrame(
+      [row for rows in summaries for row in rows], columns=summary_columns)
+
+  output_directory = os.path.dirname(output_file)
+  if output_directory != '':
+    os.makedirs(output_directory, exist_ok=True)
+  summary.to_csv(output_file, quoting=csv.QUOTE_NONNUMERIC, index=False)
+
+  return summary
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Summarize pipeline output per file, as '
+                  'analysis/01_cleaning.r does.')
+  parser.add_argument('input_directory')
+  parser.add_argument('output_file')
+  parser.add_argument('--tokens-threshold', type=int, default=3)
+  parser.add_argument('--lines-threshold', type=int, default=500)
+  parser.add_argument(
+      '--included-meter', action='append', default=None,
+      help='A meter to keep; may be repeated. Defaults to "Hexameters" and '
+           '"Elegiac couplets".')
+  parser.add_argument('--workers', type=int, default=None)
+  args = parser.parse_args()
+
+  logger.setLevel(logging.INFO)
+  summarize_folder(
+      args.input_directory,
+      args.output_file,
+      tokens_threshold=args.tokens_threshold,
+      lines_threshold=args.lines_threshold,
+      included_meters=args.included_meter or (
+          'Hexameters', 'Elegiac couplets'),
+      number_of_workers=args.workers)
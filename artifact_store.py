@@ -0,0 +1,252 @@
+'''Reuse finished output files across output directories.
+
+pipeline.py only skips an author file if its output already exists in
+output_directory, so each new output directory parses the whole corpus again,
+and an output written by older code, or with other settings, is kept as if it
+were current. An ArtifactStore keeps every finished output (with its
+manifest) under a key made from:
+
+  - a hash of the author's JSON file (kept in the corpus index, so that
+    only new or changed files are hashed; see corpus_index.py);
+  - the run's parameters that change the output (see output_parameters()),
+    including the parser settings (see tokenize_latin.parser_settings(); a
+    parse server only parses for runs with the same settings);
+  - a hash of the source of the modules that produce the output
+    (code_modules), and the installed CLTK version.
+
+Before parsing, pipeline.py (through reuse_outputs()) hard-links (or, across
+file systems, copies) the stored output for each author file whose key is in
+the store into the new output directory, and only parses the rest. Each
+output's manifest records its key from when it is started, and an existing
+output whose manifest records a different key (or, if it was left
+unfinished, none) is parsed again, rather than kept or resumed.
+Finished outputs are added to the store with store_outputs(). Stored files
+are made read-only, so that an output linked from the store can't be
+changed in place. Outputs parsed with the morphology memo in fast mode also
+depend on the memo's counts, so pipeline.py doesn't use the store then.
+'''
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import uuid
+
+import corpus_index
+import create_csvs
+import parse_cache
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+repository_directory = os.path.dirname(os.path.abspath(__file__))
+
+# The modules whose code determines the output files:
+code_modules = [
+    'compact_tags.py', 'create_csvs.py', 'fault_isolation.py',
+    'morphology_memo.py', 'mqdq_stream.py', 'parquet_output.py',
+    'section_pool.py', 'sentence_stream.py', 'text_normalization.py',
+    'tokenize_latin.py']
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+  '''A hash of the source of code_modules and the installed CLTK version.'''
+  digest = hashlib.sha256(parse_cache.cltk_version().encode('utf-8'))
+  for module in code_modules:
+    digest.update(f'\n{module}\n'.encode('utf-8'))
+    digest.update(corpus_index.file_hash(
+        os.path.join(repository_directory, module)).encode('utf-8'))
+  return digest.hexdigest()
+
+
+def output_parameters(
+    allowed_meters: list = None,
+    excluded_parts_of_speech: list = [],
+    output_format: str = 'csv',
+    **settings) -> dict:
+  '''The run parameters that change an output file, as a dict for
+  artifact_key().
+
+  Args:
+    allowed_meters, excluded_parts_of_speech, output_format: As in
+      pipeline.py.
+
+    settings: Any other settings that change the output: the parser
+      settings (see tokenize_latin.parser_settings()), e.g.,
+      pipeline_profile, analyze_batch_size, transliterate_greek, and
+      sentence_timeout_seconds.
+  '''
+  return dict(
+      settings,
+      allowed_meters=sorted(allowed_meters) if allowed_meters is not None
+                     else None,
+      excluded_parts_of_speech=sorted(excluded_parts_of_speech),
+      output_format=output_format)
+
+
+def artifact_key(data_file: str, parameters: dict,
+                 input_hash: str = None) -> str:
+  '''The store key for the output of data_file with parameters.
+
+  Args:
+    data_file: The input file.
+
+    parameters: From output_parameters().
+
+    input_hash: data_file's corpus_index.file_hash(), if already known (e.g.,
+      from its corpus index entry). Defaults to None, which hashes it.
+  '''
+  return hashlib.sha256(json.dumps({
+      'input': input_hash if input_hash is not None
+               else corpus_index.file_hash(data_file),
+      'parameters': parameters,
+      'code': code_version(),
+  }, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+  try:
+    os.link(source, destination)
+  except OSError:
+    # e.g., across file systems, or where hard links aren't supported
+    shutil.copy2(source, destination)
+
+
+class ArtifactStore():
+  '''A directory of finished output files, by artifact_key().
+
+  Args:
+    directory: The directory to keep them in. It is created if it does not
+      exist.
+  '''
+
+  def __init__(self, directory: str):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def _artifact_directory(self, key: str) -> str:
+    return os.path.join(self.directory, key[:2], key)
+
+  def contains(self, key: str) -> bool:
+    return os.path.isdir(self._artifact_directory(key))
+
+  def fetch(self, key: str, output_file: str) -> bool:
+    '''Link (or copy) the output stored under key, and its manifest, to
+    output_file.
+
+    Output: Whether the store had an output under key.
+    '''
+    artifact_directory = self._artifact_directory(key)
+    if not os.path.isdir(artifact_directory):
+      return False
+
+    stored_file = os.path.join(
+        artifact_directory, f'output{os.path.splitext(output_file)[1]}')
+    for source, destination in (
+        (stored_file, output_file),
+        (create_csvs.checkpoint_file_name(stored_file),
+         create_csvs.checkpoint_file_name(output_file))):
+      if os.path.lexists(destination):
+        os.remove(destination)
+      _link_or_copy(source, destination)
+    return True
+
+  def put(self, key: str, output_file: str) -> None:
+    '''Store a finished output_file, and its manifest, under key (recording
+    key in the manifest).'''
+    checkpoint = create_csvs.read_checkpoint(output_file) or {
+        'data_file': None, 'complete': True, 'sections': []}
+    if checkpoint.get('artifact_key') != key:
+      checkpoint['artifact_key'] = key
+      create_csvs.write_checkpoint(output_file, checkpoint)
+
+    artifact_directory = self._artifact_directory(key)
+    if os.path.isdir(artifact_directory):
+      return
+
+    # Build the artifact beside its final place, then rename it there, so
+    # that a partly stored artifact is never fetched:
+    temporary_directory = f'{artifact_directory}.{uuid.uuid4().hex}.tmp'
+    os.makedirs(temporary_directory)
+    stored_file = os.path.join(
+        temporary_directory, f'output{os.path.splitext(output_file)[1]}')
+    for source, destination in (
+        (output_file, stored_file),
+        (create_csvs.checkpoint_file_name(output_file),
+         create_csvs.checkpoint_file_name(stored_file))):
+      _link_or_copy(source, destination)
+      os.chmod(destination, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+    try:
+      os.rename(temporary_directory, artifact_directory)
+    except OSError:
+      # Another process stored the same artifact first.
+      shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+def reuse_outputs(store: ArtifactStore, data_files: list,
+                  output_directory: str, parameters: dict,
+                  output_format: str = 'csv', index: dict = None) -> tuple:
+  '''Decide which of data_files need to be parsed, reusing stored outputs.
+
+  A complete output already in output_directory is kept if its manifest
+  records the current key, or records no key (an output from before the
+  store). Otherwise, the stored output for the key is fetched, if there is
+  one. Files left to parse should be written with their keys (e.g.,
+  create_csvs.mqdq_to_csv(..., artifact_key=keys[data_file])), so that an
+  output an interrupted run left is only resumed if it was started with the
+  same key (see create_csvs.resume_checkpoint()).
+
+  index is a corpus index of data_files (see corpus_index.build_index()),
+  whose hashes are used rather than hashing each file again. Defaults to
+  None, which hashes every file.
+
+  Output: A (files_to_process, keys) pair, where files_to_process are the
+    data_files left to parse, and keys is a dict from each of data_files to
+    its key.
+  '''
+  files_to_process = []
+  keys = {}
+  reused = 0
+  for data_file in data_files:
+    key = keys[data_file] = artifact_key(
+        data_file, parameters,
+        index[data_file]['sha256'] if index is not None else None)
+    output_file = create_csvs.output_file_name(
+        data_file, output_directory, output_format)
+
+    if create_csvs.output_is_complete(output_file):
+      checkpoint = create_csvs.read_checkpoint(output_file) or {}
+      if checkpoint.get('artifact_key', key) == key:
+        continue
+      logger.warning(
+          '"%s" was written from other input, settings, or code; replacing '
+          'it...', output_file)
+      create_csvs.remove_output(output_file)
+
+    if store.contains(key):
+      # (in place of any output an interrupted run left)
+      create_csvs.remove_output(output_file)
+      store.fetch(key, output_file)
+      reused += 1
+    else:
+      files_to_process.append(data_file)
+
+  logger.info(
+      'Reused %d stored outputs; %d files left to parse.', reused,
+      len(files_to_process))
+  return files_to_process, keys
+
+
+def store_outputs(store: ArtifactStore, keys: dict, output_directory: str,
+                  output_format: str = 'csv') -> None:
+  '''Add each finished output of the data files in keys to store.'''
+  for data_file, key in keys.items():
+    output_file = create_csvs.output_file_name(
+        data_file, output_directory, output_format)
+    if create_csvs.output_is_complete(output_file):
+      store.put(key, output_file)
@@ -0,0 +1,101 @@
+'''Micro-benchmark of token-to-line alignment in tokenize_latin.
+
+Compares tokenize_latin.align_tags_to_lines with the previous alignment loop
+(reproduced below), which re-joined every token of the line after each new
+token and removed tokens from the front of a list. No CLTK parsing is done:
+the token stream is built directly from synthetic lines, so only alignment
+is timed. Long lines and long sentences are where the old loop was slowest.
+
+Usage, from the root of this repository:
+
+  python3 benchmarks/bench_alignment.py
+'''
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tokenize_latin  # noqa: E402
+
+words = (
+    'arma virumque cano Troiae qui primus ab oris Italiam fato profugus '
+    'Lauiniaque uenit litora multum ille et terris iactatus et alto').split()
+
+
+def quadratic_align(input_text, tags_generator):
+  '''The alignment loop from before align_tags_to_lines, for comparison.'''
+  staged_tags = []
+
+  for line in input_text:
+    relevant_tags = []
+    line_combined = re.sub(
+        r'\s', '', tokenize_latin.prepare_input_text(line))
+
+    while ''.join([x.get('string') for x in relevant_tags]) != line_combined:
+      if len(staged_tags) == 0:
+        staged_tags += next(tags_generator)
+      relevant_tags.append(staged_tags[0])
+      del staged_tags[0]
+
+    line_with_parsing = ' '.join(
+        [f'{x["string"]} [{x["pos"]}{", " + ", ".join(x["case"]) + " case" if x["case"] is not None else ""}]' for x in relevant_tags])
+
+    yield {
+        'text': line,
+        'text_parsed': line_with_parsing,
+        'tags': relevant_tags,
+    }
+
+
+def synthetic_section(lines: int, words_per_line: int,
+                      sentences: int) -> tuple:
+  '''Build a section of lines and the token stream CLTK would produce for
+  it, split into the given number of sentences.'''
+  input_text = [
+      ' '.join(words[(i + j) % len(words)] for j in range(words_per_line))
+      for i in range(lines)]
+
+  tokens = [
+      {'string': word, 'lemma': word, 'pos': 'noun', 'case': ['nominative']}
+      for line in input_text for word in line.split()]
+  sentence_length = -(-len(tokens) // sentences)
+
+  return input_text, [
+      tokens[i:i + sentence_length]
+      for i in range(0, len(tokens), sentence_length)]
+
+
+def main():
+  print(f'{"lines":>6} {"words/line":>10} {"sentences":>9} '
+        f'{"old (s)":>9} {"new (s)":>9} {"speedup":>8}')
+
+  for lines, words_per_line, sentences in [
+      (100, 8, 10),
+      (1000, 8, 1),
+      (100, 100, 1),
+      (100, 400, 1),
+      (2000, 20, 1)]:
+    input_text, sentence_tags = synthetic_section(
+        lines, words_per_line, sentences)
+
+    assert list(tokenize_latin.align_tags_to_lines(
+        input_text, iter(sentence_tags))) == list(
+            quadratic_align(input_text, iter(sentence_tags)))
+
+    old_time = min(timeit.repeat(
+        lambda: list(quadratic_align(input_text, iter(sentence_tags))),
+        number=1, repeat=3))
+    new_time = min(timeit.repeat(
+        lambda: list(tokenize_latin.align_tags_to_lines(
+            input_text, iter(sentence_tags))),
+        number=1, repeat=3))
+
+    print(f'{lines:>6} {words_per_line:>10} {sentences:>9} '
+          f'{old_time:>9.4f} {new_time:>9.4f} {old_time / new_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,206 @@
+'''Benchmark the pipeline on synthetic corpora of several sizes: lines and
+sentences per second for tokenize_latin.tokenize_latin,
+tokenize_latin.enumerativeness, create_csvs.mqdq_to_enumerativeness_dataframe
+and create_csvs.mqdq_to_csv, with each run's peak memory and the time per
+stage of mqdq_to_csv (see run_metrics).
+
+By default, parsing and sentence splitting use benchmarks/fake_nlp.py in
+place of CLTK, so the results measure everything other than CLTK itself, and
+don't vary with the CLTK version or need CLTK installed. Use --cltk to parse
+with CLTK instead.
+
+Each corpus size runs in its own process, so that peak memory is measured
+from a clean start. Results can be saved with --output and compared against
+a saved run (e.g., from another commit) with --compare.
+
+Usage, from the root of this repository:
+
+  python3 benchmarks/bench_corpus.py [--sizes small medium] \\
+    [--output results.json] [--compare baseline.json]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+repository_directory = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Corpus sizes, as arguments to synthetic_corpus.write_corpus:
+sizes = {
+    'small': {'authors': 2, 'works': 2, 'sections': 5, 'lines': 40},
+    'medium': {'authors': 4, 'works': 3, 'sections': 10, 'lines': 60},
+    'large': {'authors': 8, 'works': 4, 'sections': 20, 'lines': 80},
+}
+
+# The benchmarks, in the order they are reported:
+benchmark_names = [
+    'tokenize_latin', 'enumerativeness', 'mqdq_to_enumerativeness_dataframe',
+    'mqdq_to_csv']
+
+
+def git_commit() -> str:
+  '''The current commit of this repository, or None.'''
+  try:
+    return subprocess.run(
+        ['git', 'rev-parse', '--short', 'HEAD'], cwd=repository_directory,
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run_size(size: str, use_cltk: bool, noise: float) -> dict:
+  '''Run every benchmark on one corpus size, in this process.'''
+  import create_csvs
+  import run_metrics
+  import synthetic_corpus
+  import tokenize_latin
+
+  if not use_cltk:
+    from fake_nlp import FakeNLP, FakeSentenceTokenizer
+    tokenize_latin.use_nlp(FakeNLP())
+    tokenize_latin.use_sentence_tokenizer(FakeSentenceTokenizer())
+
+  with tempfile.TemporaryDirectory() as directory:
+    data_files = synthetic_corpus.write_corpus(
+        os.path.join(directory, 'data'), noise=noise, **sizes[size])
+    sections = [
+        section for data_file in data_files
+        for _, _, _, _, section in create_csvs.iter_filtered_sections(
+            data_file)]
+    lines = sum(len(section['lines']) for section in sections)
+
+    # Load the model (if any) before timing anything:
+    tokenize_latin.get_nlp()
+    results = {}
+
+    run_metrics.reset()
+    start = time.perf_counter()
+    parsed_lines = [
+        parsed_line for section in sections
+        for parsed_line in tokenize_latin.tokenize_latin(section['lines'])]
+    results['tokenize_latin'] = time.perf_counter() - start
+    sentences = run_metrics.summary()['counters'].get('sentences', 0)
+
+    start = time.perf_counter()
+    for parsed_line in parsed_lines:
+      tokenize_latin.enumerativeness(parsed_line)
+    results['enumerativeness'] = time.perf_counter() - start
+    del parsed_lines
+
+    start = time.perf_counter()
+    for data_file in data_files:
+      for _ in create_csvs.mqdq_to_enumerativeness_dataframe(data_file):
+        pass
+    results['mqdq_to_enumerativeness_dataframe'] = \
+        time.perf_counter() - start
+
+    run_metrics.reset()
+    start = time.perf_counter()
+    for data_file in data_files:
+      create_csvs.mqdq_to_csv(
+          data_file, create_csvs.output_file_name(
+              data_file, os.path.join(directory, 'output')))
+    results['mqdq_to_csv'] = time.perf_counter() - start
+    stages = run_metrics.summary()['stages']
+
+  return {
+      'size': size,
+      'lines': lines,
+      'sentences': sentences,
+      'benchmarks': {
+          name: {
+              'seconds': round(seconds, 3),
+              'lines_per_second': round(lines / seconds, 1),
+              'sentences_per_second': round(sentences / seconds, 1),
+          } for name, seconds in results.items()},
+      'mqdq_to_csv_stage_seconds': {
+          name: stage['seconds'] for name, stage in stages.items()},
+      'peak_rss_mb': run_metrics.peak_rss_mb(),
+  }
+
+
+def print_results(results: list, baseline: dict = None) -> None:
+  '''Print a table of results, with the change in lines per second from
+  baseline, a saved run, if given.'''
+  baseline_results = {
+      result['size']: result for result in baseline['results']
+  } if baseline is not None else {}
+
+  print(f'{"size":>6} {"lines":>6} {"benchmark":>34} {"seconds":>8} '
+        f'{"lines/s":>9} {"sent/s":>9} {"vs. baseline":>12}')
+  for result in results:
+    for name in benchmark_names:
+      benchmark = result['benchmarks'][name]
+      change = ''
+      baseline_benchmark = baseline_results.get(result['size'], {}).get(
+          'benchmarks', {}).get(name)
+      if baseline_benchmark is not None:
+        change = '{:.2f}x'.format(
+            benchmark['lines_per_second'] /
+            baseline_benchmark['lines_per_second'])
+      print(f'{result["size"]:>6} {result["lines"]:>6} {name:>34} '
+            f'{benchmark["seconds"]:>8} {benchmark["lines_per_second"]:>9} '
+            f'{benchmark["sentences_per_second"]:>9} {change:>12}')
+    print(f'{result["size"]:>6} peak RSS: {result["peak_rss_mb"]} MB; '
+          'mqdq_to_csv seconds per stage: ' + ', '.join(
+              f'{name} {seconds:.3f}' for name, seconds in
+              result['mqdq_to_csv_stage_seconds'].items()))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--sizes', nargs='+', choices=list(sizes), default=['small', 'medium'])
+  parser.add_argument(
+      '--noise', type=float, default=0.05,
+      help='The share of lines with Greek words or editorial marks.')
+  parser.add_argument(
+      '--cltk', action='store_true', help='Parse with CLTK.')
+  parser.add_argument('--output', help='Save the results to a JSON file.')
+  parser.add_argument(
+      '--compare', help='Compare against results saved with --output.')
+  parser.add_argument('--child', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child is not None:
+    print(json.dumps(run_size(args.child, args.cltk, args.noise)))
+    return
+
+  results = []
+  for size in args.sizes:
+    command = [sys.executable, os.path.abspath(__file__), '--child', size,
+               '--noise', str(args.noise)]
+    if args.cltk:
+      command.append('--cltk')
+    results.append(json.loads(subprocess.run(
+        command, check=True, stdout=subprocess.PIPE,
+        universal_newlines=True).stdout.strip().splitlines()[-1]))
+
+  baseline = None
+  if args.compare is not None:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    print(f'Baseline: commit {baseline.get("commit")}, '
+          f'{"CLTK" if baseline.get("cltk") else "fake NLP"}')
+  print_results(results, baseline)
+
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump({
+          'commit': git_commit(),
+          'cltk': args.cltk,
+          'noise': args.noise,
+          'results': results,
+      }, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,125 @@
+'''Benchmark writing parsed lines as CSV batches versus Parquet row groups.
+
+Synthetic parsed lines (in the form produced by
+create_csvs.section_to_enumerativeness_lines) are written both ways:
+
+  - csv: a DataFrame per write_lines lines, via create_csvs.lines_to_dataframe,
+    appended to a CSV, as create_csvs.mqdq_to_csv does
+  - parquet: parquet_output.ParquetLineWriter, with large row groups
+
+No parsing is done, so only output is timed. The time to read each file back
+(as pipeline consumers, e.g. rescore.py, would) and the file sizes are also
+reported.
+
+Usage, from the root of this repository:
+
+  python3 benchmarks/bench_output_format.py [--lines N] [--write-lines N]
+'''
+
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+import create_csvs  # noqa: E402
+import parquet_output  # noqa: E402
+
+words = (
+    'arma virumque cano Troiae qui primus ab oris Italiam fato profugus '
+    'Lauiniaque uenit litora multum ille et terris iactatus et alto').split()
+parts_of_speech = ['noun', 'verb', 'adjective', 'pronoun', 'adverb']
+cases = ['nominative', 'accusative', 'ablative', 'genitive', 'dative']
+
+author = {'author_name': 'P. Vergilius Maro', 'author_date': '70-19 a.',
+          'author_id': 1}
+work = {'name': 'Aeneis', 'edition': '(G. B. Conte, 2009)'}
+
+
+def synthetic_lines(count: int, lines_per_section: int = 500):
+  '''Yield (line, section) pairs of parsed lines.'''
+  for i in range(count):
+    section = {'href': f'http://example.org/section/{i // lines_per_section}',
+               'meter': 'Hexameters'}
+    line_words = [words[(i + j) % len(words)] for j in range(7)]
+    tags = [{'string': word, 'lemma': word.lower(),
+             'pos': parts_of_speech[(i + j) % len(parts_of_speech)],
+             'case': [cases[(i * j) % len(cases)]] if j % 3 else None}
+            for j, word in enumerate(line_words)]
+    yield {
+        'text': ' '.join(line_words),
+        'text_parsed': ' '.join(
+            f'{t["string"]} [{t["pos"]}]' for t in tags),
+        'tags': tags,
+        'line_number': i % lines_per_section,
+        'enumerativeness': round(((i % 5) + 1) / 7, 3),
+        'tokens': 7,
+        'top_case': (i % 5) + 1,
+    }, section
+
+
+def write_csv(lines: list, output_file: str, write_lines: int) -> None:
+  write_header = True
+  for start in range(0, len(lines), write_lines):
+    batch = lines[start:start + write_lines]
+    create_csvs.lines_to_dataframe(
+        [line for line, _ in batch], author, work, batch[0][1]).to_csv(
+            output_file, mode='a', header=write_header,
+            quoting=csv.QUOTE_NONNUMERIC, index=False)
+    write_header = False
+
+
+def write_parquet(lines: list, output_file: str) -> None:
+  writer = parquet_output.ParquetLineWriter(output_file)
+  for line, section in lines:
+    writer.add_line(line, author, work, section)
+  writer.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--lines', type=int, default=100000)
+  parser.add_argument('--write-lines', type=int, default=10)
+  args = parser.parse_args()
+
+  # Sections are at most 500 lines, so batches never span two sections:
+  lines = list(synthetic_lines(args.lines))
+
+  with tempfile.TemporaryDirectory() as directory:
+    csv_file = os.path.join(directory, 'output.csv')
+    parquet_file = os.path.join(directory, 'output.parquet')
+
+    start = time.perf_counter()
+    write_csv(lines, csv_file, args.write_lines)
+    csv_write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_parquet(lines, parquet_file)
+    parquet_write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pd.read_csv(csv_file)
+    csv_read = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pd.read_parquet(parquet_file)
+    parquet_read = time.perf_counter() - start
+
+    print(f'{args.lines} lines, CSV batches of {args.write_lines} lines')
+    print(f'{"format":>8} {"write (s)":>9} {"lines/s":>9} {"read (s)":>8} '
+          f'{"size (MB)":>9}')
+    for name, write_time, read_time, output_file in [
+        ('csv', csv_write, csv_read, csv_file),
+        ('parquet', parquet_write, parquet_read, parquet_file)]:
+      print(f'{name:>8} {write_time:>9.2f} '
+            f'{args.lines / write_time:>9.0f} {read_time:>8.2f} '
+            f'{os.path.getsize(output_file) / 1024 ** 2:>9.2f}')
+
+
+if __name__ == '__main__':
+  main()
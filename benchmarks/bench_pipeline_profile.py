@@ -0,0 +1,122 @@
+'''Benchmark CLTK pipeline profiles: sentences parsed per second and resident
+memory, for the "default" and "minimal" profiles of tokenize_latin and a few
+analyze batch sizes.
+
+Each configuration runs in its own process, so that model loading time and
+memory are measured from a clean start. Sentences come from the lines of an
+MQDQ author file, if one is given, or else from a short built-in passage.
+
+Usage, from the root of this repository:
+
+  python3 benchmarks/bench_pipeline_profile.py [author.json] [--sentences N]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+sample_lines = [
+    'Arma uirumque cano, Troiae qui primus ab oris',
+    'Italiam fato profugus Lauiniaque uenit',
+    'litora, multum ille et terris iactatus et alto',
+    'ui superum, saeuae memorem Iunonis ob iram;',
+    'multa quoque et bello passus, dum conderet urbem',
+    'inferretque deos Latio, genus unde Latinum',
+    'Albanique patres atque altae moenia Romae.',
+]
+
+configurations = [
+    ('default', 1),
+    ('minimal', 1),
+    ('minimal', 4),
+    ('minimal', 16),
+]
+
+
+def load_lines(data_file: str) -> list:
+  '''All lines of an MQDQ author file, or the built-in sample.'''
+  if data_file is None:
+    return sample_lines
+
+  with open(data_file) as f:
+    data = json.load(f)
+
+  return [line for work in data.get('author_works')
+          for section in work.get('sections', [])
+          for line in section.get('lines', [])]
+
+
+def run_configuration(profile: str, batch_size: int, data_file: str,
+                      sentences: int) -> dict:
+  '''Parse sentences with one configuration, in this process.'''
+  import psutil
+  import tokenize_latin
+
+  process = psutil.Process()
+  start_rss = process.memory_info().rss
+
+  start = time.perf_counter()
+  tokenize_latin.use_pipeline_profile(profile, batch_size=batch_size)
+  tokenize_latin.get_nlp()
+  load_seconds = time.perf_counter() - start
+
+  all_sentences = tokenize_latin.get_sentence_tokenizer().tokenize(
+      ' '.join(load_lines(data_file)))
+  # Repeat short inputs until there are enough sentences to time:
+  all_sentences = (all_sentences * (sentences // len(all_sentences) + 1))[
+      :sentences]
+
+  start = time.perf_counter()
+  tokens = sum(len(tags) for tags in tokenize_latin.analyze_sentences(
+      all_sentences))
+  parse_seconds = time.perf_counter() - start
+
+  return {
+      'profile': profile,
+      'batch_size': batch_size,
+      'load_seconds': round(load_seconds, 2),
+      'sentences_per_second': round(len(all_sentences) / parse_seconds, 1),
+      'tokens': tokens,
+      'rss_mb': round(process.memory_info().rss / 1024 ** 2),
+      'model_rss_mb': round((process.memory_info().rss - start_rss) / 1024 ** 2),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('data_file', nargs='?', default=None)
+  parser.add_argument('--sentences', type=int, default=200)
+  parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child is not None:
+    print(json.dumps(run_configuration(
+        args.child[0], int(args.child[1]), args.data_file, args.sentences)))
+    return
+
+  print(f'{"profile":>8} {"batch":>5} {"load (s)":>8} {"sent/s":>8} '
+        f'{"tokens":>7} {"RSS (MB)":>8} {"model (MB)":>10}')
+  for profile, batch_size in configurations:
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        '--child', profile, str(batch_size),
+        '--sentences', str(args.sentences)]
+    if args.data_file is not None:
+      command.append(args.data_file)
+    result = json.loads(subprocess.run(
+        command, check=True, stdout=subprocess.PIPE,
+        universal_newlines=True).stdout.strip().splitlines()[-1])
+
+    print(f'{result["profile"]:>8} {result["batch_size"]:>5} '
+          f'{result["load_seconds"]:>8} {result["sentences_per_second"]:>8} '
+          f'{result["tokens"]:>7} {result["rss_mb"]:>8} '
+          f'{result["model_rss_mb"]:>10}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,74 @@
+'''A deterministic stand-in for CLTK's NLP object, for benchmarking.
+
+FakeNLP.analyze splits text into words and punctuation and gives each word a
+part of speech and case chosen from a hash of the word, so the same text
+always gets the same tags, in a few microseconds rather than the
+milliseconds that Stanza takes. With it (see tokenize_latin.use_nlp()),
+benchmarks measure everything in the pipeline other than CLTK itself, and
+run without downloading any models.
+
+The returned objects have only the attributes tokenize_latin.tags_from_doc
+reads. FakeSentenceTokenizer likewise stands in for CLTK's Latin sentence
+tokenizer (see tokenize_latin.use_sentence_tokenizer()), so that, with both,
+CLTK needn't be installed at all.
+'''
+
+import re
+import zlib
+
+_token_pattern = re.compile(r'\w+|[^\w\s]')
+# A sentence runs to the next full stop, question or exclamation mark, or
+# semicolon (or the end of the text):
+_sentence_pattern = re.compile(r'\S[^.?!;]*[.?!;]*')
+
+parts_of_speech = [
+    'noun', 'noun', 'verb', 'verb', 'adjective', 'adverb', 'pronoun',
+    'proper_noun', 'conjunction', 'adposition']
+# Parts of speech that are given a case:
+declined_parts_of_speech = {'noun', 'adjective', 'pronoun', 'proper_noun'}
+cases = ['nominative', 'accusative', 'genitive', 'dative', 'ablative',
+         'vocative']
+
+
+class FakeFeatures():
+  def __init__(self, features: dict):
+    self.features = features
+
+
+class FakeWord():
+  def __init__(self, string: str):
+    self.string = string
+    self.lemma = string.lower()
+
+    if not string[0].isalnum():
+      self.pos = 'punctuation'
+      self.features = FakeFeatures({})
+      return
+
+    word_hash = zlib.crc32(string.lower().encode('utf-8'))
+    self.pos = parts_of_speech[word_hash % len(parts_of_speech)]
+    self.features = FakeFeatures(
+        {'Case': [cases[(word_hash // 16) % len(cases)]]}
+        if self.pos in declined_parts_of_speech else {})
+
+
+class FakeDoc():
+  def __init__(self, words: list):
+    self.words = words
+
+
+class FakeNLP():
+  '''Tag text deterministically, with the interface of cltk.NLP that
+  tokenize_latin uses.'''
+
+  def analyze(self, text: str) -> FakeDoc:
+    return FakeDoc([FakeWord(token) for token in _token_pattern.findall(text)])
+
+
+class FakeSentenceTokenizer():
+  '''Split text into sentences at full stops, question and exclamation
+  marks, and semicolons, with the interface of CLTK's
+  LatinPunktSentenceTokenizer that tokenize_latin uses.'''
+
+  def tokenize(self, text: str) -> list:
+    return [sentence.rstrip() for sentence in _sentence_pattern.findall(text)]
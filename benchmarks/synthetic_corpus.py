@@ -0,0 +1,156 @@
+'''Write synthetic MQDQ author files, of any size, for benchmarking.
+
+Each file has the structure of those written by
+download_mqdq_author.download_mqdq_author_works() (see
+create_csvs.mqdq_to_enumerativeness_dataframe), with lines of Latin-looking
+words drawn from a fixed vocabulary. A share of lines can be given the kinds
+of noise found in MQDQ texts that tokenize_latin.prepare_input_text has to
+remove: Greek words, editorial brackets, quotes, and daggers. The same
+arguments always give the same files.
+
+Usage, from the root of this repository:
+
+  python3 benchmarks/synthetic_corpus.py OUTPUT_DIRECTORY \\
+    [--authors 3] [--works 2] [--sections 5] [--lines 40] [--noise 0.05]
+'''
+
+import argparse
+import json
+import os
+import random
+
+vocabulary = (
+    'arma uirumque cano Troiae qui primus ab oris Italiam fato profugus '
+    'Lauiniaque uenit litora multum ille et terris iactatus alto ui superum '
+    'saeuae memorem Iunonis ob iram multa quoque bello passus dum conderet '
+    'urbem inferretque deos Latio genus unde Latinum Albanique patres atque '
+    'altae moenia Romae Musa mihi causas memora quo numine laeso quidue '
+    'dolens regina deum tot uoluere casus insignem pietate uirum tot adire '
+    'labores impulerit tantaene animis caelestibus irae').split()
+greek_words = ['λόγος', 'ἀνήρ', 'θεός', 'Μοῦσα', 'πόλεμος']
+punctuation = ['', '', '', ',', ',', '.', ';', ':', '?', '!']
+meters = ['Hexameters', 'Elegiac couplets', 'Phalecian hendecasyllables',
+          'Iambic trimeters']
+
+
+def add_noise(words: list, rng: random.Random) -> list:
+  '''Add one kind of MQDQ noise to a line's words.'''
+  position = rng.randrange(len(words) + 1)
+  kind = rng.randrange(4)
+  if kind == 0:
+    return words[:position] + [rng.choice(greek_words)] + words[position:]
+  if kind == 1:
+    return words[:position] + [f'<{rng.choice(vocabulary)}>'] + \
+        words[position:]
+  if kind == 2:
+    return words[:position] + [f'"{rng.choice(vocabulary)}"'] + \
+        words[position:]
+  return words[:position] + [f'†{rng.choice(vocabulary)}†'] + words[position:]
+
+
+def synthetic_line(rng: random.Random, noise: float = 0.05) -> str:
+  '''A line of 4 to 9 words, ending in punctuation some of the time.'''
+  words = [rng.choice(vocabulary) for _ in range(rng.randint(4, 9))]
+  if rng.random() < noise:
+    words = add_noise(words, rng)
+  words[0] = words[0].capitalize() if rng.random() < 0.2 else words[0]
+  return ' '.join(words) + rng.choice(punctuation)
+
+
+def synthetic_author(
+    author_id: int,
+    works: int = 2,
+    sections: int = 5,
+    lines: int = 40,
+    meter_choices: list = meters,
+    noise: float = 0.05,
+    seed: int = 0) -> dict:
+  '''An author dict, as in an MQDQ author file.
+
+  Args:
+    author_id: The author's "author_id", also used in its name.
+
+    works: The number of works.
+
+    sections: The number of sections in each work.
+
+    lines: The number of lines in each section.
+
+    meter_choices: The meters to give sections, chosen at random.
+
+    noise: The share of lines with a Greek word, brackets, quotes, or
+      daggers added.
+
+    seed: A seed for the random choices, combined with author_id.
+
+  Output: A dict, which can be written with json.dump.
+  '''
+  rng = random.Random(f'{seed}-{author_id}')
+  return {
+      'author_name': f'Auctor Syntheticus {author_id}',
+      'author_date': f'{rng.randint(1, 500)}-{rng.randint(501, 900)}',
+      'author_id': author_id,
+      'author_url': f'http://example.org/autori/{author_id}',
+      'author_works': [{
+          'name': f'opus {work}',
+          'edition': '(synthetic)',
+          'sections': [{
+              'href': f'http://example.org/testo/{author_id}/{work}/{section}',
+              'meter': rng.choice(meter_choices),
+              'lines': [synthetic_line(rng, noise) for _ in range(lines)],
+          } for section in range(sections)],
+      } for work in range(works)],
+  }
+
+
+def write_corpus(
+    output_directory: str,
+    authors: int = 3,
+    works: int = 2,
+    sections: int = 5,
+    lines: int = 40,
+    meter_choices: list = meters,
+    noise: float = 0.05,
+    seed: int = 0) -> list:
+  '''Write authors synthetic author files, named 000.json, 001.json, etc.,
+  to output_directory. The other arguments are as for synthetic_author().
+
+  Output: A list of the files written.
+  '''
+  os.makedirs(output_directory, exist_ok=True)
+
+  data_files = []
+  for author_id in range(authors):
+    data_file = os.path.join(output_directory, f'{author_id:03d}.json')
+    with open(data_file, 'w') as f:
+      json.dump(synthetic_author(
+          author_id, works=works, sections=sections, lines=lines,
+          meter_choices=meter_choices, noise=noise, seed=seed), f)
+    data_files.append(data_file)
+
+  return data_files
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('output_directory')
+  parser.add_argument('--authors', type=int, default=3)
+  parser.add_argument('--works', type=int, default=2)
+  parser.add_argument('--sections', type=int, default=5)
+  parser.add_argument('--lines', type=int, default=40)
+  parser.add_argument(
+      '--meter', action='append', default=None,
+      help='A meter to give sections; may be repeated.')
+  parser.add_argument('--noise', type=float, default=0.05)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  data_files = write_corpus(
+      args.output_directory, authors=args.authors, works=args.works,
+      sections=args.sections, lines=args.lines,
+      meter_choices=args.meter or meters, noise=args.noise, seed=args.seed)
+  print(f'Wrote {len(data_files)} files to "{args.output_directory}".')
+
+
+if __name__ == '__main__':
+  main()
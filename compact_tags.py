@@ -0,0 +1,192 @@
+'''A compact representation of parsed tokens, and enumerativeness computed on
+it.
+
+Each parsed token used to be a dict of its string, lemma, part of speech, and
+a list of its cases, so a parsed section held a dict, a list, and several
+strings per token, and tokenize_latin.enumerativeness walked each line's
+dicts four times, comparing strings. Here, a token is a Token, with
+__slots__, and its part of speech and cases are stored as small integer
+codes, interned once per process. enumerativeness() scores a line in one pass
+over its tokens, testing parts of speech against bitmasks of the excluded
+codes.
+
+Tokens can be read like the old dicts (token['pos'], token.get('case')), and
+as_dicts() gives the old dicts themselves, for output (CSV, Parquet, the
+parse cache, and the parse server all still see dicts). Codes are specific to
+the process that interned them, so Tokens are pickled by name.
+'''
+
+import functools
+import sys
+
+# Part of speech and case names, indexed by their codes, and the reverse:
+pos_names = []
+case_names = []
+_pos_codes = {}
+_case_codes = {}
+# Each distinct tuple of case codes, so that tokens with the same cases share
+# one:
+_case_tuples = {}
+
+
+def pos_code(name: str) -> int:
+  '''The code for a part of speech, interning it if it is new.'''
+  code = _pos_codes.get(name)
+  if code is None:
+    code = _pos_codes[name] = len(pos_names)
+    pos_names.append(name)
+  return code
+
+
+def case_code(name: str) -> int:
+  '''The code for a case, interning it if it is new.'''
+  code = _case_codes.get(name)
+  if code is None:
+    code = _case_codes[name] = len(case_names)
+    case_names.append(name)
+  return code
+
+
+# Parts of speech never counted as tokens: punctuation, and the tokens of
+# sentences that couldn't be parsed (see fault_isolation.unparsed_pos)
+uncounted_parts_of_speech = ('punctuation', 'unparsed')
+_uncounted_mask = sum(
+    1 << pos_code(name) for name in uncounted_parts_of_speech)
+
+
+class Token():
+  '''A parsed token.
+
+  Args:
+    string: The token string.
+
+    lemma: The lemma of the string.
+
+    pos: The part of speech of the string.
+
+    case: A list of the token's case values, or None.
+  '''
+  __slots__ = ('string', 'lemma', 'pos_code', 'case_codes')
+
+  def __init__(self, string: str, lemma: str, pos: str, case: list = None):
+    self.string = string
+    self.lemma = sys.intern(lemma) if type(lemma) is str else lemma
+    self.pos_code = pos_code(pos)
+    if case is not None:
+      case_codes = tuple(case_code(value) for value in case)
+      case_codes = _case_tuples.setdefault(case_codes, case_codes)
+    else:
+      case_codes = None
+    self.case_codes = case_codes
+
+  @property
+  def pos(self) -> str:
+    return pos_names[self.pos_code]
+
+  @property
+  def case(self) -> list:
+    if self.case_codes is None:
+      return None
+    return [case_names[code] for code in self.case_codes]
+
+  def as_dict(self) -> dict:
+    '''The token as a dict, with keys "string", "lemma", "pos", and "case".
+    '''
+    return {
+        'string': self.string,
+        'lemma': self.lemma,
+        'pos': self.pos,
+        'case': self.case,
+    }
+
+  @classmethod
+  def from_dict(cls, tag: dict) -> 'Token':
+    return cls(tag['string'], tag['lemma'], tag['pos'], tag.get('case'))
+
+  def __getitem__(self, key: str):
+    if key not in ('string', 'lemma', 'pos', 'case'):
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def get(self, key: str, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __eq__(self, other) -> bool:
+    if isinstance(other, Token):
+      return self.as_dict() == other.as_dict()
+    return NotImplemented
+
+  def __repr__(self) -> str:
+    return f'Token({self.as_dict()!r})'
+
+  def __reduce__(self):
+    return (Token, (self.string, self.lemma, self.pos, self.case))
+
+
+def as_dicts(tags: list) -> list:
+  '''A list of tokens (Tokens or dicts) as a list of dicts.'''
+  return [tag.as_dict() if isinstance(tag, Token) else tag for tag in tags]
+
+
+def from_dicts(tags: list) -> list:
+  '''A list of tokens (dicts or Tokens) as a list of Tokens.'''
+  return [tag if isinstance(tag, Token) else Token.from_dict(tag)
+          for tag in tags]
+
+
+@functools.lru_cache(maxsize=256)
+def _exclusion_masks(excluded_parts_of_speech: tuple,
+                     number_of_pos: int) -> tuple:
+  '''Bitmasks of the part of speech codes whose cases aren't counted (those
+  named in excluded_parts_of_speech) and of those that aren't counted as
+  tokens (those containing a name in excluded_parts_of_speech, and
+  uncounted_parts_of_speech), as of when number_of_pos parts of speech had
+  been interned.
+  '''
+  case_mask = 0
+  token_mask = _uncounted_mask
+  for code, name in enumerate(pos_names[:number_of_pos]):
+    if name in excluded_parts_of_speech:
+      case_mask |= 1 << code
+    if any(excluded_pos in name for excluded_pos in excluded_parts_of_speech):
+      token_mask |= 1 << code
+  return case_mask, token_mask
+
+
+def enumerativeness(tags: list, excluded_parts_of_speech: list = []) -> dict:
+  '''Score a line's tokens; see tokenize_latin.enumerativeness.
+
+  Args:
+    tags: A list of Tokens.
+
+    excluded_parts_of_speech: Parts of speech whose tokens' cases aren't
+      counted, and which (with any part of speech containing one of them, as
+      a substring) aren't counted as tokens. Neither are the tokens of
+      sentences that couldn't be parsed (see fault_isolation.py), so a line
+      with none parsed has no score.
+
+  Output: A dict with "top_case", "tokens", and "enumerativeness".
+  '''
+  case_mask, token_mask = _exclusion_masks(
+      tuple(excluded_parts_of_speech), len(pos_names))
+
+  case_counts = {}
+  tokens = 0
+  for tag in tags:
+    bit = 1 << tag.pos_code
+    if tag.case_codes is not None and not case_mask & bit:
+      for code in tag.case_codes:
+        case_counts[code] = case_counts.get(code, 0) + 1
+    if not token_mask & bit:
+      tokens += 1
+
+  top_case = max(case_counts.values()) if len(case_counts) > 0 else 0
+
+  return {
+      'top_case': top_case,
+      'tokens': tokens,
+      'enumerativeness': round(top_case / tokens, 3) if tokens > 0 else None,
+  }
@@ -0,0 +1,182 @@
+'''An index of the MQDQ author files to be processed.
+
+pipeline.py used to learn what was in each author file (which meters its
+sections are in, and how many lines they have) only by parsing it. Here,
+each file is read once, one section at a time, and its author, works, and
+each section's href, meter, line count, and position in the file are kept
+in a small JSON index, with a hash of its contents (for artifact_store.py,
+so that an unchanged file isn't read again to find its key). Files are
+indexed again only when their size or modification time changes.
+
+With the index, pipeline.py can skip files with no sections in the allowed
+meters without opening them, estimate how long a run will take, and hand
+the largest sections to workers first, so that a large author doesn't leave
+one worker busy after all of the others have finished.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+import mqdq_stream
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+
+def file_hash(path: str) -> str:
+  '''The SHA-256 of a file's contents.'''
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def index_file(data_file: str) -> dict:
+  '''Index one MQDQ author file.
+
+  Args:
+    data_file: The filename of a JSON file, as for create_csvs.mqdq_to_csv.
+
+  Output: A dict with keys:
+    - "size" and "mtime_ns": The file's size and modification time, when
+      it was indexed.
+    - "sha256": The file_hash() of the file.
+    - "author": The file's values other than "author_works".
+    - "works": Each work's values other than "sections", by work index.
+    - "sections": A list with a dict per section, in file order, with keys
+      "work_index", "section_index", "byte_offset" (see
+      mqdq_stream.read_section()), "href", "meter", and "lines" (the number
+      of lines in the section).
+  '''
+  stat = os.stat(data_file)
+  entry = {
+      'size': stat.st_size,
+      'mtime_ns': stat.st_mtime_ns,
+      'sha256': file_hash(data_file),
+      'author': {},
+      'works': [],
+      'sections': [],
+  }
+
+  for author, work_index, work, section_index, section, byte_offset in \
+      mqdq_stream.iter_sections(data_file):
+    entry['author'] = author
+    # (works without sections are left empty)
+    while len(entry['works']) <= work_index:
+      entry['works'].append({})
+    entry['works'][work_index] = work
+    entry['sections'].append({
+        'work_index': work_index,
+        'section_index': section_index,
+        'byte_offset': byte_offset,
+        'href': section.get('href'),
+        'meter': section.get('meter'),
+        'lines': len(section.get('lines', [])),
+    })
+
+  return entry
+
+
+def build_index(data_files: list, index_path: str = None) -> dict:
+  '''Index data_files, reusing the entries in index_path for files that
+  haven't changed, and save the updated index to index_path.
+
+  Args:
+    data_files: A list of MQDQ author files.
+
+    index_path: A JSON file to keep the index in between runs. Defaults to
+      None, which indexes every file and saves nothing.
+
+  Output: A dict from each of data_files to its index_file() entry.
+  '''
+  saved_index = {}
+  if index_path is not None and os.path.exists(index_path):
+    with open(index_path) as f:
+      saved_index = json.load(f)
+
+  index = {}
+  for data_file in data_files:
+    entry = saved_index.get(data_file)
+    stat = os.stat(data_file)
+    if entry is None or entry['size'] != stat.st_size or \
+        entry.get('mtime_ns') != stat.st_mtime_ns or 'sha256' not in entry:
+      logger.info('Indexing "%s"...', data_file)
+      entry = index_file(data_file)
+    index[data_file] = entry
+
+  if index_path is not None:
+    # Keep the entries of files that aren't part of this run:
+    saved_index.update(index)
+    temporary_index_path = f'{index_path}.tmp'
+    with open(temporary_index_path, 'w') as f:
+      json.dump(saved_index, f, separators=(',', ':'), ensure_ascii=False)
+    os.replace(temporary_index_path, index_path)
+
+  return index
+
+
+def allowed_sections(entry: dict, allowed_meters: list = None) -> list:
+  '''The sections of an index entry whose meter is in allowed_meters (or all
+  of them, if allowed_meters is None).'''
+  return [
+      section for section in entry['sections']
+      if allowed_meters is None or section['meter'] in allowed_meters]
+
+
+def section_tasks(index: dict, data_file: str,
+                  allowed_meters: list = None) -> list:
+  '''The same tasks as section_pool.section_tasks(), from the index rather
+  than from data_file itself.'''
+  entry = index[data_file]
+  return [dict(
+      section,
+      data_file=data_file,
+      work=entry['works'][section['work_index']],
+  ) for section in allowed_sections(entry, allowed_meters)]
+
+
+def total_lines(index: dict, data_files: list,
+                allowed_meters: list = None) -> int:
+  '''The number of lines in the allowed sections of data_files.'''
+  return sum(
+      section['lines'] for data_file in data_files
+      for section in allowed_sections(index[data_file], allowed_meters))
+
+
+class Progress():
+  '''Log how many of a run's lines have been parsed, and estimate how long
+  the rest will take, from the rate so far.
+
+  Args:
+    total_lines: The number of lines to be parsed in the run (e.g., from
+      total_lines()).
+  '''
+
+  def __init__(self, total_lines: int):
+    self.total_lines = total_lines
+    self.done_lines = 0
+    self._started = time.time()
+
+  def update(self, lines: int) -> None:
+    '''Record that another lines lines have been parsed.'''
+    self.done_lines += lines
+    if self.total_lines == 0:
+      return
+
+    elapsed = time.time() - self._started
+    remaining = self.total_lines - self.done_lines
+    if self.done_lines > 0 and remaining > 0:
+      seconds = elapsed / self.done_lines * remaining
+      eta = f'{int(seconds // 3600)}:{int(seconds % 3600 // 60):02d}:' \
+          f'{int(seconds % 60):02d}'
+      logger.info(
+          'Parsed %d of %d lines (%.1f%%); about %s left.', self.done_lines,
+          self.total_lines, 100 * self.done_lines / self.total_lines, eta)
+    else:
+      logger.info(
+          'Parsed %d of %d lines (%.1f%%).', self.done_lines,
+          self.total_lines, 100 * self.done_lines / self.total_lines)
@@ -1,20 +1,388 @@
+import contextlib
 import csv
-import dask.dataframe as dd
+import functools
 import json
 import logging
 import os
-import pandas as pd
-from cltk.sentence.lat import LatinPunktSentenceTokenizer
-import json
-import logging
-import os
-
+import shutil
+import time
+
+import adaptive_batching
+import compact_tags
+import mqdq_stream
+import overlapped as overlapped_stages
+import run_metrics
 import tokenize_latin
 
 logger = logging.getLogger('mqdq_tokenization')
 logging.basicConfig()
 
-sentence_tokenizer = LatinPunktSentenceTokenizer()
+
+def iter_filtered_sections(data, allowed_meters: list = None):
+  '''Iterate over the sections of an MQDQ author file whose meter is in
+  allowed_meters.
+
+  Args:
+    data: Either the filename of an MQDQ author file, which is read one
+      section at a time with mqdq_stream.iter_sections(), or the file's
+      contents as already loaded with json.load.
+
+    allowed_meters: "Meters" values from MQDQ to allow. Defaults to None,
+      which allows everything.
+
+  Output: A generator of (author, work_index, work, section_index, section)
+    tuples, in file order, where author holds the "author_*" values.
+  '''
+  if isinstance(data, str):
+    sections = (
+        (author, work_index, work, section_index, section)
+        for author, work_index, work, section_index, section, _ in
+        mqdq_stream.iter_sections(data))
+  else:
+    sections = (
+        (data, work_index, work, section_index, section)
+        for work_index, work in enumerate(data.get('author_works'))
+        for section_index, section in enumerate(work.get('sections', [])))
+
+  current_work_index = None
+  current_work_matched = False
+  for author, work_index, work, section_index, section in sections:
+    if work_index != current_work_index:
+      if current_work_index is not None and not current_work_matched:
+        logger.info(
+            'No sections of this work met filter criteria. Moving on...')
+      current_work_index = work_index
+      current_work_matched = False
+
+    if allowed_meters is not None and \
+        section.get('meter') not in allowed_meters:
+      continue
+
+    current_work_matched = True
+    yield author, work_index, work, section_index, section
+
+  if current_work_index is not None and not current_work_matched:
+    logger.info(
+        'No sections of this work met filter criteria. Moving on...')
+
+
+def section_to_enumerativeness_lines(
+    section: dict,
+    excluded_parts_of_speech: list = []) -> None:
+  '''Parse and score the lines of a single section.
+
+  Line numbers restart at 0 for each section, so sections can be parsed
+  independently of one another (e.g., in separate worker processes) and the
+  output concatenated afterwards in their original order.
+
+  Args:
+    section: The section to parse.
+
+    excluded_parts_of_speech: argument to be passed to
+      tokenize_latin.enumerativeness
+
+  Output: A generator of dicts, one per line, as produced by
+    tokenize_latin.tokenize_latin, with the additional keys "line_number",
+    "enumerativeness", "tokens", and "top_case".
+  '''
+  logger.info(
+      'Processing section with href "%s"...', section.get('href'))
+
+  parsing_generator = tokenize_latin.tokenize_latin(
+      section.get('lines', []), section_href=section.get('href'))
+  for overall_i, new_line in enumerate(parsing_generator):
+    enumerativeness_dict = tokenize_latin.enumerativeness(new_line, excluded_parts_of_speech=excluded_parts_of_speech)
+    new_line.update(
+        {'line_number': overall_i, 'enumerativeness': enumerativeness_dict["enumerativeness"], 'tokens':enumerativeness_dict["tokens"], 'top_case': enumerativeness_dict["top_case"]})
+    yield new_line
+
+
+@run_metrics.timed('dataframe_building')
+def lines_to_dataframe(
+    parsed_lines: list,
+    data: dict,
+    work: dict,
+    section: dict) -> 'pd.DataFrame':
+  '''Build a DataFrame from lines from section_to_enumerativeness_lines,
+  adding the author, work, and section values as columns.'''
+  # Pandas is imported here, rather than with this module, so that checking
+  # which files need processing doesn't wait for it:
+  import pandas as pd
+
+  # (the tags are written out as dicts)
+  parsed_lines_df = pd.json_normalize([
+      dict(line, tags=compact_tags.as_dicts(line['tags']))
+      if 'tags' in line else line for line in parsed_lines])
+  parsed_lines_df['author_name'] = data.get('author_name')
+  parsed_lines_df['author_date'] = data.get('author_date')
+  parsed_lines_df['author_id'] = data.get('author_id')
+  parsed_lines_df['work_name'] = work.get('name')
+  parsed_lines_df['work_edition'] = work.get('edition')
+  parsed_lines_df['section_url'] = section.get('href')
+  parsed_lines_df['section_meter'] = section.get('meter')
+
+  return parsed_lines_df
+
+
+def section_to_enumerativeness_dataframe(
+    data: dict,
+    work: dict,
+    section: dict,
+    excluded_parts_of_speech: list = [],
+    batch_size: int = 10) -> None:
+  '''Parse the lines of a single section and yield them in batches.
+
+  Args:
+    data: The full author dict (see mqdq_to_enumerativeness_dataframe); only
+      the "author_*" values are read from it.
+
+    work: The element of data["author_works"] that section belongs to.
+
+    section: The section to parse.
+
+    excluded_parts_of_speech: argument to be passed to
+      tokenize_latin.enumerativeness
+
+    batch_size: The number of output parsed lines to batch before yielding,
+      or an adaptive_batching.AdaptiveBatchSize. Defaults to 10.
+
+  Output: A generator of Pandas DataFrames, with the same headers as
+    mqdq_to_enumerativeness_dataframe. The last DataFrame holds the
+    remaining lines, and may be empty.
+  '''
+  for parsed_lines in section_to_line_batches(
+      section, excluded_parts_of_speech=excluded_parts_of_speech,
+      batch_size=batch_size):
+    yield lines_to_dataframe(parsed_lines, data, work, section)
+
+  return
+
+
+def section_to_line_batches(
+    section: dict,
+    excluded_parts_of_speech: list = [],
+    batch_size: int = 10,
+    record_batches: bool = True) -> None:
+  '''Parse the lines of a single section and yield them in batches, as lists
+  of lines from section_to_enumerativeness_lines (see
+  section_to_enumerativeness_dataframe). The last batch holds the remaining
+  lines, and may be empty.
+
+  If batch_size is an adaptive_batching.AdaptiveBatchSize, the time taken to
+  parse each batch, and to write it (i.e., until the next batch is asked
+  for), is recorded with it, and it chooses the size of the next batch.
+  With record_batches False, batches aren't recorded here, for a caller
+  that writes them elsewhere (e.g., in another thread) to record them with
+  the time that writing them took.'''
+  adaptive = isinstance(batch_size, adaptive_batching.AdaptiveBatchSize)
+
+  # Write the output file in batches
+  parsed_lines = []
+  batch_started = time.perf_counter()
+  for new_line in section_to_enumerativeness_lines(
+      section, excluded_parts_of_speech=excluded_parts_of_speech):
+    parsed_lines.append(new_line)
+    if len(parsed_lines) >= (batch_size.size if adaptive else batch_size):
+      logger.info('Yielding batch of lines...')
+      yielded = time.perf_counter()
+      yield parsed_lines
+      if adaptive and record_batches:
+        batch_size.record(
+            len(parsed_lines), yielded - batch_started,
+            time.perf_counter() - yielded)
+      parsed_lines = []
+      batch_started = time.perf_counter()
+
+  logger.info('Yielding batch of lines...')
+  yielded = time.perf_counter()
+  yield parsed_lines
+  if adaptive and record_batches:
+    batch_size.record(
+        len(parsed_lines), yielded - batch_started,
+        time.perf_counter() - yielded)
+
+
+def write_batches_to_csv(
+    row_generator,
+    output_file: str,
+    write_header: bool = True) -> bool:
+  '''Append each DataFrame from row_generator to output_file as CSV.
+
+  Args:
+    row_generator: A generator of Pandas DataFrames, e.g., from
+      mqdq_to_enumerativeness_dataframe.
+
+    output_file: The name of a file to append to.
+
+    write_header: Whether to write a header row before the first batch.
+      Defaults to True.
+
+  Output: Whether a header row still needs to be written, i.e., False once
+    any batch has been written.
+  '''
+  for batch in row_generator:
+    with run_metrics.stage('csv_writing'):
+      batch.to_csv(
+        output_file,
+        mode='a',
+        header=write_header,
+        quoting=csv.QUOTE_NONNUMERIC,
+        index=False)
+    write_header = False
+
+  return write_header
+
+
+def write_lines_to_csv(
+    parsed_lines: list,
+    data: dict,
+    work: dict,
+    section: dict,
+    output_file: str,
+    write_header: bool = True) -> None:
+  '''Build a DataFrame from a batch of lines (see lines_to_dataframe()) and
+  append it to output_file, as write_batches_to_csv() would.'''
+  write_batches_to_csv(
+      [lines_to_dataframe(parsed_lines, data, work, section)], output_file,
+      write_header=write_header)
+
+
+def output_file_name(
+    data_file: str,
+    output_directory: str,
+    output_format: str = 'csv') -> str:
+  '''The output file for data_file: the same base name in output_directory,
+  ending in ".csv" or ".parquet" depending on output_format.'''
+  if output_format not in ('csv', 'parquet'):
+    raise ValueError(f'Unknown output format "{output_format}".')
+
+  return os.path.join(
+      output_directory,
+      f'{os.path.splitext(os.path.basename(data_file))[0]}.{output_format}')
+
+
+def checkpoint_file_name(output_file: str) -> str:
+  '''The manifest file recording which sections of output_file are done.'''
+  return f'{output_file}.manifest.json'
+
+
+def read_checkpoint(output_file: str) -> dict:
+  '''Read the manifest for output_file.
+
+  Output: None if there is no manifest, or else a dict of the form
+
+      {
+        "data_file": "/path/to/author.json",
+        "complete": false,
+        "sections": [
+          {
+            "work_index": 0,
+            "section_index": 2,
+            "href": "http://mizar.unive.it/mqdq/public/testo/testo/...",
+            "lines": 57,
+            "csv_bytes": 48213
+          }
+        ]
+      }
+
+    where "sections" lists the finished sections in the order they were
+    written, and "csv_bytes" is the size of output_file just after each
+    section was written.
+  '''
+  try:
+    with open(checkpoint_file_name(output_file)) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return None
+
+
+def write_checkpoint(output_file: str, checkpoint: dict) -> None:
+  '''Atomically replace the manifest for output_file with checkpoint.'''
+  temporary_checkpoint_file = f'{checkpoint_file_name(output_file)}.tmp'
+  with open(temporary_checkpoint_file, 'w') as f:
+    json.dump(checkpoint, f, indent=2)
+  os.replace(temporary_checkpoint_file, checkpoint_file_name(output_file))
+
+
+def output_is_complete(output_file: str) -> bool:
+  '''Whether output_file has been fully written. An output file without a
+  manifest (e.g., from before manifests were written) counts as complete.'''
+  if not os.path.exists(output_file):
+    return False
+
+  checkpoint = read_checkpoint(output_file)
+  return checkpoint is None or checkpoint.get('complete', False)
+
+
+def remove_output(output_file: str) -> None:
+  '''Remove output_file, its manifest, and any sections written for it by
+  an interrupted section_pool run.'''
+  for path in (output_file, checkpoint_file_name(output_file)):
+    if os.path.lexists(path):
+      os.remove(path)
+  shutil.rmtree(f'{output_file}.parts', ignore_errors=True)
+
+
+def resume_checkpoint(output_file: str, data_file: str,
+                      artifact_key: str = None) -> dict:
+  '''Prepare output_file for appending the sections that are not yet done.
+
+  Any rows after the last finished section (i.e., from a section that was
+  interrupted) are cut from the end of output_file; rows of finished sections
+  are left as they are. If output_file has no manifest, a new one is started
+  and output_file, if it exists, is appended to as before.
+
+  Args:
+    output_file: The file being written. (A Parquet output is only written
+      once every section is done, so lists no sections.)
+
+    data_file: The JSON file that output_file is being written from.
+
+    artifact_key: The key of the output in the artifact store (see
+      artifact_store.artifact_key()), recorded in the manifest. If the
+      manifest records another key, or none, output_file was started from
+      other input, settings, or code, so it is removed (see remove_output())
+      and started again. Defaults to None, which resumes output_file
+      whatever its key, and removes the key from its manifest, since the
+      rest of the file isn't checked against it.
+
+  Output: The checkpoint (see read_checkpoint()) to continue from.
+  '''
+  checkpoint = read_checkpoint(output_file)
+  started = checkpoint is not None or os.path.exists(output_file) or \
+      os.path.isdir(f'{output_file}.parts')
+  if artifact_key is not None and started and (
+      checkpoint is None or checkpoint.get('artifact_key') != artifact_key):
+    logger.warning(
+        '"%s" was started from other input, settings, or code; starting it '
+        'again...', output_file)
+    remove_output(output_file)
+    checkpoint = None
+
+  if checkpoint is None or not os.path.exists(output_file):
+    # Record that output_file is in progress before anything is written to it:
+    checkpoint = {'data_file': data_file, 'complete': False, 'sections': []}
+    if artifact_key is not None:
+      checkpoint['artifact_key'] = artifact_key
+    write_checkpoint(output_file, checkpoint)
+    return checkpoint
+
+  if checkpoint.get('artifact_key') != artifact_key:
+    del checkpoint['artifact_key']
+    write_checkpoint(output_file, checkpoint)
+
+  csv_bytes = checkpoint['sections'][-1]['csv_bytes'] if \
+      len(checkpoint['sections']) > 0 else 0
+  if os.path.getsize(output_file) > csv_bytes:
+    logger.info(
+        'Removing rows of an interrupted section from "%s"...', output_file)
+    with open(output_file, 'r+b') as f:
+      f.truncate(csv_bytes)
+
+  logger.info(
+      'Resuming "%s" after %d finished sections...',
+      output_file, len(checkpoint['sections']))
+  return checkpoint
 
 
 def mqdq_to_enumerativeness_dataframe(
@@ -26,8 +394,9 @@ def mqdq_to_enumerativeness_dataframe(
   and parsing its lines.
 
   Args:
-    data: Data read from output that was created by
-    download_mqdq_author_works.download_mqdq_author_works(). Should have
+    data: The filename of a JSON file created by
+    download_mqdq_author_works.download_mqdq_author_works(), which is read
+    one section at a time, or data already read from such a file. Should have
     the following form:
 
       {
@@ -57,8 +426,8 @@ def mqdq_to_enumerativeness_dataframe(
 
     excluded_parts_of_speech: arguyment to be passed to tokenize_latin.enumerativeness    
     
-    batch_size: The number of output parsed lines to batch before yielding.
-      Defaults to 10.
+    batch_size: The number of output parsed lines to batch before yielding,
+      or an adaptive_batching.AdaptiveBatchSize. Defaults to 10.
 
   Output: A generator of rows from a Pandas DataFrame, with the following
     headers:
@@ -66,61 +435,14 @@ def mqdq_to_enumerativeness_dataframe(
       author_id, work_name, work_edition, section_url, section_meter
 
   '''
-  # logger.info('Opening "%s"...', data_file)
-  # with open(data_file) as f:
-  #     data = json.load(f)
-
-  for work in data.get('author_works'):
-    filtered_sections = [s for s in work.get('sections', []) if s.get(
-        'meter') in allowed_meters] if allowed_meters is not None else [
-        s for s in work.get('sections', [])]
-
-    if not len(filtered_sections) > 0:
-        logger.info(
-            'No sections of this work met filter criteria. Moving on...')
-        continue
-
-    for section in filtered_sections:
-      finished_parsing = False
-      logger.info(
-          'Processing section with href "%s"...', section.get('href'))
-
-      parsing_generator = tokenize_latin.tokenize_latin(
-          section.get('lines', []))
-      # Write the output file in batches
-      i = 0
-      overall_i = 0
-      parsed_lines = []
-      while finished_parsing is not True:
-        logging.info(
-            'Parsing next sentence for section with href "%s"...',
-            section.get('href'))
-        try:
-          new_line = next(parsing_generator)
-          enumerativeness_dict = tokenize_latin.enumerativeness(new_line, excluded_parts_of_speech=excluded_parts_of_speech)
-          new_line.update(
-              {'line_number': overall_i, 'enumerativeness': enumerativeness_dict["enumerativeness"], 'tokens':enumerativeness_dict["tokens"], 'top_case': enumerativeness_dict["top_case"]})
-          parsed_lines.append(new_line)
-        except StopIteration:
-          finished_parsing = True
-        if i >= batch_size - 1 or finished_parsing is True:
-          logger.info('Yielding batch of lines...')
-
-          parsed_lines_df = pd.json_normalize(parsed_lines)
-          parsed_lines_df['author_name'] = data.get('author_name')
-          parsed_lines_df['author_date'] = data.get('author_date')
-          parsed_lines_df['author_id'] = data.get('author_id')
-          parsed_lines_df['work_name'] = work.get('name')
-          parsed_lines_df['work_edition'] = work.get('edition')
-          parsed_lines_df['section_url'] = section.get('href')
-          parsed_lines_df['section_meter'] = section.get('meter')
-
-          i = 0
-          parsed_lines = []
-          yield parsed_lines_df
-
-        i += 1
-        overall_i += 1
+  for author, _, work, _, section in iter_filtered_sections(
+      data, allowed_meters):
+    yield from section_to_enumerativeness_dataframe(
+        author,
+        work,
+        section,
+        excluded_parts_of_speech=excluded_parts_of_speech,
+        batch_size=batch_size)
 
   return
 
@@ -139,7 +461,9 @@ def mqdq_to_csv(
         output_file: str,
         allowed_meters: list = None,
         excluded_parts_of_speech:list = [],
-        write_lines: int = 10) -> None:
+        write_lines: int = 10,
+        overlapped: bool = False,
+        artifact_key: str = None) -> None:
   '''A wrapper function for taking an input JSON file of Latin poetry, parsing
   its lines, and writing the output to a CSV file.
 
@@ -158,17 +482,27 @@ def mqdq_to_csv(
     excluded_parts_of_speech: to be passed to tokenize_latin.enumerativeness within call to mqdq_to_enumerativeness_dataframe 
 
     write_lines: The number of output parsed lines to batch before writing to
-      output_file. Defaults to 10.
+      output_file, or an adaptive_batching.AdaptiveBatchSize. Defaults to 10.
+
+    overlapped: Whether to read the next sections, and build and write the
+      output, in background threads while lines are parsed in this one (see
+      overlapped.py). The output is the same either way. Defaults to False.
+
+    artifact_key: The output's key in the artifact store, if one is used;
+      see resume_checkpoint(). Defaults to None.
 
   Output: None. This function will write to output_file, comprising a CSV with
     headers:
       text, text_parsed, tags, line_number, author_name, author_date,
       author_id, work_name, work_edition, section_url, section_meter
 
+    Alongside it, a manifest (see read_checkpoint()) records each section
+    as it is finished. If output_file was left unfinished by an earlier call,
+    its finished sections are kept and skipped, and only the remaining
+    sections are parsed.
+
   '''
   logger.info('Opening "%s"...', data_file)
-  with open(data_file) as f:
-      data = json.load(f)
 
   output_directory = os.path.dirname(output_file)
 
@@ -177,117 +511,91 @@ def mqdq_to_csv(
         'Creating directory "%s" for output...', output_directory)
     os.makedirs(output_directory)
 
-  output_file_exists = os.path.isfile(output_file)
-  write_header = True if not output_file_exists else False
-  existing_output = dd.read_csv(output_file) if output_file_exists else None
-
-  row_generator = mqdq_to_enumerativeness_dataframe(
-    data,
-    batch_size=write_lines,
-    allowed_meters=allowed_meters,
-    excluded_parts_of_speech=excluded_parts_of_speech
-  )
-  
-  for batch in row_generator:
-    # Discard rows that are already present in output_file, and write the
-    # remaining lines to output_file:
-    # if existing_output is not None:
-    #   breakpoint()
-    #   batch = batch[~batch.isin(existing_output)].dropna(how='all')
-    batch.to_csv(
-      output_file,
-      mode='a',
-      header=write_header,
-      quoting=csv.QUOTE_NONNUMERIC,
-      index=False)
-    write_header = False
+  # Pick up after the last finished section, if a previous run was
+  # interrupted:
+  checkpoint = resume_checkpoint(output_file, data_file, artifact_key)
+  finished_sections = set(
+      (s['work_index'], s['section_index']) for s in checkpoint['sections'])
+  write_header = not os.path.exists(output_file) or \
+      os.path.getsize(output_file) == 0
+
+  def write_batch(parsed_lines, parse_seconds, author, work, section,
+                  write_header):
+    # Run in the writer thread, which times the write itself for an
+    # adaptive batch size, rather than the time to hand the batch over:
+    started = time.perf_counter()
+    write_lines_to_csv(
+        parsed_lines, author, work, section, output_file, write_header)
+    if isinstance(write_lines, adaptive_batching.AdaptiveBatchSize):
+      write_lines.record(
+          len(parsed_lines), parse_seconds, time.perf_counter() - started)
+
+  def record_section(work_index, section_index, section):
+    checkpoint['sections'].append({
+        'work_index': work_index,
+        'section_index': section_index,
+        'href': section.get('href'),
+        'lines': len(section.get('lines', [])),
+        'csv_bytes': os.path.getsize(output_file) if os.path.exists(
+            output_file) else 0,
+    })
+    write_checkpoint(output_file, checkpoint)
+
+  # The file is read one section at a time, rather than all at once:
+  sections = iter_filtered_sections(data_file, allowed_meters)
+  if overlapped:
+    sections = overlapped_stages.prefetch(sections)
+    writer = overlapped_stages.BackgroundWriter(
+        lambda write: write())
+  else:
+    writer = contextlib.nullcontext()
+
+  # (closing sections stops the prefetching thread, if this fails)
+  with writer, contextlib.closing(sections):
+    for author, work_index, work, section_index, section in sections:
+      if (work_index, section_index) in finished_sections:
+        logger.info(
+            'Section with href "%s" is already complete. Moving on...',
+            section.get('href'))
+        continue
 
+      if not overlapped:
+        with run_metrics.section(
+            data_file, work_index, section_index, href=section.get('href'),
+            meter=section.get('meter')):
+          write_header = write_batches_to_csv(
+              section_to_enumerativeness_dataframe(
+                  author,
+                  work,
+                  section,
+                  excluded_parts_of_speech=excluded_parts_of_speech,
+                  batch_size=write_lines),
+              output_file,
+              write_header=write_header)
+        record_section(work_index, section_index, section)
+        continue
 
-  # for work in data.get('author_works'):
-  #   filtered_sections = [s for s in work.get('sections', []) if s.get(
-  #       'meter') in allowed_meters] if allowed_meters is not None else [
-  #       s for s in work.get('sections', [])]
-
-  #   if not len(filtered_sections) > 0:
-  #       logger.info(
-  #           'No sections of this work met filter criteria. Moving on...')
-  #       continue
-
-  #   for section in filtered_sections:
-  #     finished_parsing = False
-  #     logger.info(
-  #         'Processing section with href "%s"...', section.get('href'))
-
-  #     if existing_output is not None:
-  #       existing_lines_parsed = existing_output[
-  #           existing_output.section_url == section.get('href')].size.compute()
-
-  #       if len(section.get('lines', [])) == existing_lines_parsed:
-  #         logger.info(
-  #             ('Processing section with href "%s"... is already complete. '
-  #              'Moving on...'), section.get('href'))
-  #         continue
-  #       else:
-  #         logger.info('Section with href "%s" incomplete. Restarting it...',
-  #                     section.get('href'))
-  #         # Restart the section. We can't restart it midway, because lines !=
-  #         # sentences, which are used to parse:
-  #         data_to_overwrite = dd.read_csv(output_file)
-
-  #         data_to_overwrite = data_to_overwrite[
-  #             data_to_overwrite.section_url != section.get('href')
-  #         ]
-  #         data_to_overwrite.to_csv(
-  #             output_file,
-  #             single_file=True,
-  #             header=True,
-  #             quoting=csv.QUOTE_NONNUMERIC,
-  #             index=False,
-  #             mode='w'
-  #         )
-
-  #     parsing_generator = tokenize_latin.tokenize_latin(
-  #         section.get('lines', []))data_file
-  #     # Write the output file in batches
-  #     i = 0
-  #     overall_i = 0
-  #     parsed_lines = []
-  #     while finished_parsing is not True:
-  #       logging.info(
-  #           'Parsing next sentence for section with href "%s"...',
-  #           section.get('href'))
-  #       try:
-  #         new_line = next(parsing_generator)
-  #         new_line.update({'line_number': overall_i})
-  #         parsed_lines.append(new_line)
-  #       except StopIteration:
-  #         finished_parsing = True
-  #       if i == write_lines - 1 or finished_parsing is True:
-  #         logger.info(f'Saving batch of lines to "{output_file}"...')
-
-  #         parsed_lines_df = pd.json_normalize(parsed_lines)
-  #         parsed_lines_df['author_name'] = data.get('author_name')
-  #         parsed_lines_df['author_date'] = data.get('author_date')
-  #         parsed_lines_df['author_id'] = data.get('author_id')
-  #         parsed_lines_df['work_name'] = work.get('name')
-  #         parsed_lines_df['work_edition'] = work.get('edition')
-  #         parsed_lines_df['section_url'] = section.get('href')
-  #         parsed_lines_df['section_meter'] = section.get('meter')
-  #         parsed_lines_df.to_csv(
-  #             output_file,
-  #             mode='a',
-  #             header=write_header,
-  #             quoting=csv.QUOTE_NONNUMERIC,
-  #             index=False)
-
-  #         write_header = False
-
-  #         i = 0
-  #         parsed_lines = []
-  #         continue
-
-  #       i += 1
-  #       overall_i += 1
+      # Each batch (and then the section's checkpoint) is handed to the
+      # writer thread, which builds its DataFrame and writes it while the
+      # next batch is parsed here:
+      with run_metrics.section(
+          data_file, work_index, section_index, href=section.get('href'),
+          meter=section.get('meter')):
+        batch_started = time.perf_counter()
+        for parsed_lines in section_to_line_batches(
+            section, excluded_parts_of_speech=excluded_parts_of_speech,
+            batch_size=write_lines, record_batches=False):
+          writer.put(functools.partial(
+              write_batch, parsed_lines,
+              time.perf_counter() - batch_started, author, work, section,
+              write_header))
+          write_header = False
+          batch_started = time.perf_counter()
+      writer.put(functools.partial(
+          record_section, work_index, section_index, section))
+
+  checkpoint['complete'] = True
+  write_checkpoint(output_file, checkpoint)
 
   return
 
@@ -0,0 +1,357 @@
+'''Keep one sentence that CLTK can't parse from failing a whole author.
+
+Any exception from cltk_nlp.analyze (e.g., 'CLTKException: Reference:
+Unrecognized value for UD feature NumForm'; see the CHANGELOG) used to end
+create_csvs.mqdq_to_csv, and a sentence that CLTK took pathologically long
+over held up its worker indefinitely. tokenize_latin now parses each
+sentence through tokenize_latin.analyze_text_isolated(), which:
+
+  1. parses the sentence, within a time limit, if one is set: the sentence
+     is then parsed in a separate process (see ParseProcess), which is
+     killed if it runs over, since a signal can't interrupt a long call
+     into the model's native code;
+  2. if that fails or times out, parses it again with strict_normalize()
+     applied, which leaves only ASCII letters, spaces, and sentence
+     punctuation (see restore_strings() for how those tokens are matched
+     back to the text);
+  3. if that fails too, gives the sentence unparsed_tags(): one token per
+     word, with part of speech "unparsed", so the lines after it are still
+     aligned with their own tokens. The sentence is added to the quarantine
+     file (see Quarantine), with the reason ("error" or "timeout") and the
+     error.
+
+Only errors in parsing a sentence are handled this way. If the parser
+itself can't be loaded (e.g., CLTK isn't installed, or a ParseProcess can't
+start), every sentence would fail, so the error is raised, and the run
+stops, instead.
+
+Quarantined sentences can be parsed again separately, e.g., after a fix or
+with a longer time limit, with:
+
+  python3 fault_isolation.py QUARANTINE_FILE --parse-cache parse_cache.sqlite \\
+    [--timeout 600] [--profile minimal] [--batch-size 1]
+
+Sentences that now parse are added to the parse cache (so that re-running the
+pipeline over their authors, with the same --profile and --batch-size, uses
+them), and are removed from the quarantine file.
+'''
+
+import argparse
+import json
+import logging
+import os
+import re
+import select
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+# Part of speech given to the tokens of sentences that couldn't be parsed:
+unparsed_pos = 'unparsed'
+
+
+class SentenceTimeout(Exception):
+  '''Parsing a sentence took longer than its time limit.'''
+
+
+class ParseError(RuntimeError):
+  '''A ParseProcess failed to parse text, or exited.'''
+
+
+class ParserLoadError(RuntimeError):
+  '''A ParseProcess could not load the parser (e.g., CLTK isn't installed,
+  or its models couldn't be loaded).'''
+
+
+class ParseProcess():
+  '''A child process that loads the CLTK models and parses text sent to it,
+  so that a parse that takes too long can be stopped by killing it.
+
+  The child is started (and its models loaded) by start(), or on the first
+  call to analyze(), outside of any time limit, and started again after it
+  is killed. It is a plain subprocess, rather than a multiprocessing one, so
+  that it can be started from section_pool's and parse_server's (daemonic)
+  worker processes. Text and tokens are sent as lines of JSON on its stdin
+  and stdout; anything else it prints goes to stderr. Waiting on it uses
+  select(), so this only works on Unix-like systems.
+
+  Args:
+    pipeline_profile: The CLTK pipeline for the child to build; see
+      tokenize_latin.build_nlp().
+  '''
+
+  def __init__(self, pipeline_profile: str):
+    self.pipeline_profile = pipeline_profile
+    self._process = None
+
+  @property
+  def running(self) -> bool:
+    return self._process is not None
+
+  def start(self) -> None:
+    '''Start the child and load its models, if it isn't running.'''
+    if self._process is not None:
+      return
+
+    code = (
+        f'import sys; sys.path[:0] = {sys.path!r}; import fault_isolation; '
+        f'fault_isolation._serve_parses({self.pipeline_profile!r})')
+    self._process = subprocess.Popen(
+        [sys.executable, '-c', code], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, encoding='utf-8')
+    # (the models are loaded before any time limit starts)
+    try:
+      response = self._read(None)
+    except ParseError as e:
+      raise ParserLoadError(f'The parse process did not start ({e}).')
+    if 'error' in response:
+      self.close()
+      raise ParserLoadError(
+          f'The parse process could not load the parser: '
+          f'{response["error"]}')
+
+  def _read(self, timeout_seconds: float) -> dict:
+    readable, _, _ = select.select(
+        [self._process.stdout], [], [], timeout_seconds)
+    if not readable:
+      self.close()
+      raise SentenceTimeout(
+          f'Parsing took longer than {timeout_seconds} seconds.')
+
+    response = self._process.stdout.readline()
+    if response == '':
+      code = self._process.wait()
+      self.close()
+      raise ParseError(f'The parse process exited with code {code}.')
+    return json.loads(response)
+
+  def analyze(self, text: str, timeout_seconds: float = None) -> list:
+    '''Parse prepared text in the child, as tokenize_latin.analyze_text()
+    would in this process.
+
+    Output: A list of token dicts (see compact_tags.as_dicts()).
+
+    Raises SentenceTimeout if parsing takes longer than timeout_seconds
+    (the child is then killed), ParseError if parsing fails, or
+    ParserLoadError if the child had to be started and couldn't load the
+    parser.
+    '''
+    self.start()
+    try:
+      self._process.stdin.write(json.dumps({'text': text}) + '\n')
+      self._process.stdin.flush()
+    except OSError as e:
+      self.close()
+      raise ParseError(f'The parse process exited ({e}).')
+
+    response = self._read(timeout_seconds)
+    if 'error' in response:
+      raise ParseError(response['error'])
+    return response['tags']
+
+  def close(self) -> None:
+    '''Stop the child, if it is running.'''
+    if self._process is not None:
+      self._process.kill()
+      self._process.wait()
+      for pipe in (self._process.stdin, self._process.stdout):
+        try:
+          pipe.close()
+        except OSError:
+          pass
+      self._process = None
+
+
+def _serve_parses(pipeline_profile: str) -> None:
+  '''Run in a ParseProcess's child: parse each line of JSON from stdin.'''
+  import compact_tags
+  import tokenize_latin
+
+  # Responses go to the original stdout, and anything printed (e.g., by CLTK)
+  # to stderr:
+  responses = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+  os.dup2(2, 1)
+
+  try:
+    tokenize_latin.use_pipeline_profile(pipeline_profile)
+    tokenize_latin.get_nlp()
+  except Exception as e:
+    responses.write(json.dumps({'error': f'{type(e).__name__}: {e}'}) + '\n')
+    responses.flush()
+    return
+  responses.write(json.dumps({'ready': True}) + '\n')
+  responses.flush()
+
+  for request in sys.stdin:
+    try:
+      response = {'tags': compact_tags.as_dicts(
+          tokenize_latin.analyze_text(json.loads(request)['text']))}
+    except Exception as e:
+      response = {'error': f'{type(e).__name__}: {e}'}
+    responses.write(json.dumps(response) + '\n')
+    responses.flush()
+
+
+_strict_removed = re.compile(r'[^A-Za-z .,;:?!]')
+_spaces = re.compile(r' +')
+
+
+def strict_normalize(text: str) -> str:
+  '''Remove everything from prepared text but ASCII letters, spaces, and
+  sentence punctuation (.,;:?!), for a second attempt at parsing it.'''
+  return _spaces.sub(' ', _strict_removed.sub('', text)).strip()
+
+
+def restore_strings(tags: list, text: str) -> list:
+  '''Give the tokens of strict_normalize(text) the strings they came from in
+  text, with the characters strict_normalize() removed put back, so that they
+  can be aligned with text's lines.
+
+  Output: A list of new tokens, or tags unchanged if their strings aren't
+    those of strict_normalize(text).
+  '''
+  import compact_tags
+
+  original = text.replace(' ', '')
+  restored = []
+  position = 0
+  for tag in tags:
+    start = position
+    for character in tag.string:
+      while position < len(original) and \
+          _strict_removed.match(original, position):
+        position += 1
+      if position == len(original) or original[position] != character:
+        return tags
+      position += 1
+    restored.append(compact_tags.Token(
+        original[start:position], tag.lemma, tag.pos, tag.case))
+
+  # (anything left can only be removed characters)
+  if restored and position < len(original):
+    restored[-1].string += original[position:]
+  return restored
+
+
+def unparsed_tags(text: str) -> list:
+  '''Tokens for a sentence that couldn't be parsed: one per word of text,
+  with no lemma or case, and part of speech unparsed_pos.'''
+  import compact_tags
+
+  return [compact_tags.Token(word, None, unparsed_pos, None)
+          for word in text.split()]
+
+
+class Quarantine():
+  '''A JSON Lines file of sentences that couldn't be parsed.
+
+  Each line is a dict with keys "time", "section_href" (the section the
+  sentence is from, if known), "sentence" (as split from the section),
+  "text" (as prepared for parsing), "reason" ("error" or "timeout"), and
+  "error". Several processes can add to the same file, since each record is
+  appended in a single write.
+
+  Args:
+    path: The file to append to.
+  '''
+
+  def __init__(self, path: str):
+    self.path = path
+    directory = os.path.dirname(path)
+    if directory != '':
+      os.makedirs(directory, exist_ok=True)
+
+  def add(self, sentence: str, text: str, error: BaseException,
+          section_href: str = None) -> None:
+    record = {
+        'time': round(time.time(), 3),
+        'section_href': section_href,
+        'sentence': sentence,
+        'text': text,
+        'reason': 'timeout' if isinstance(error, SentenceTimeout) else
+                  'error',
+        'error': f'{type(error).__name__}: {error}',
+    }
+    with open(self.path, 'a', encoding='utf-8') as f:
+      f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+  def records(self) -> list:
+    '''All of the records in the file.'''
+    if not os.path.exists(self.path):
+      return []
+    with open(self.path, encoding='utf-8') as f:
+      return [json.loads(line) for line in f if line.strip() != '']
+
+  def replace(self, records: list) -> None:
+    '''Replace the file's records with records.'''
+    temporary_path = f'{self.path}.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+      for record in records:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(temporary_path, self.path)
+
+
+def reprocess(quarantine_file: str, timeout_seconds: float = None) -> int:
+  '''Try to parse each sentence in quarantine_file again (with the parse
+  cache, pipeline profile, etc. already set in tokenize_latin), adding those
+  that parse to the parse cache and keeping the rest in the file.
+
+  Output: The number of sentences that now parse.
+  '''
+  import compact_tags
+  import tokenize_latin
+
+  if tokenize_latin.parse_cache is None:
+    raise ValueError(
+        'Set a parse cache (tokenize_latin.use_parse_cache()) to keep the '
+        'sentences that now parse in.')
+
+  quarantine = Quarantine(quarantine_file)
+  remaining = []
+  parsed = 0
+  for record in quarantine.records():
+    # (a parser that can't be loaded stops this, rather than failing every
+    # sentence)
+    tokenize_latin.load_parser(timeout_seconds)
+    try:
+      tags = tokenize_latin.analyze_text(record['text'], timeout_seconds)
+    except Exception as e:
+      logger.info('Still cannot parse "%s": %s', record['text'], e)
+      remaining.append(dict(
+          record, time=round(time.time(), 3),
+          reason='timeout' if isinstance(e, SentenceTimeout) else 'error',
+          error=f'{type(e).__name__}: {e}'))
+      continue
+
+    parsed += 1
+    tokenize_latin.parse_cache.put(record['text'], compact_tags.as_dicts(tags))
+
+  quarantine.replace(remaining)
+  logger.info(
+      'Parsed %d quarantined sentences; %d remain in "%s".', parsed,
+      len(remaining), quarantine_file)
+  return parsed
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('quarantine_file')
+  parser.add_argument('--parse-cache', required=True)
+  parser.add_argument('--timeout', type=float, default=None)
+  parser.add_argument(
+      '--profile', default='minimal', choices=['default', 'minimal'])
+  parser.add_argument(
+      '--batch-size', type=int, default=1,
+      help='The batch size of the runs that should use the parses.')
+  args = parser.parse_args()
+
+  import tokenize_latin
+
+  logger.setLevel(logging.INFO)
+  tokenize_latin.use_pipeline_profile(
+      args.profile, batch_size=args.batch_size)
+  tokenize_latin.use_parse_cache(args.parse_cache)
+  reprocess(args.quarantine_file, timeout_seconds=args.timeout)
@@ -0,0 +1,371 @@
+'''An inverted index from lemmas, cases, and parts of speech to output lines.
+
+Finding every line that uses a lemma, or every highly enumerative line in
+which ablatives dominate, used to mean reading every output file and
+scanning its "tags" column. A LineIndex is a SQLite file with, for every line
+of a set of output files (CSV or Parquet), its file, section_url,
+line_number, enumerativeness, tokens, and top_case, and postings from each
+term to the lines it occurs in. The terms are, by field:
+
+  - "lemma": each token's lemma (other than punctuation's);
+  - "pos": each token's part of speech;
+  - "case": each of each token's cases;
+  - "top_case": the case (or, if tied, cases) with the most tokens in the
+    line, over all of its tokens;
+  - "meter": the section's meter.
+
+query() finds the lines that have every term asked for, optionally within a
+range of enumerativeness. update() indexes only files that are new or have
+changed since they were last indexed (and drops those that are gone), so it
+can be run after every pipeline run (as pipeline.py does, with
+line_index_file). Usage:
+
+  python3 line_index.py update LINE_INDEX OUTPUT_DIRECTORY
+
+  python3 line_index.py query LINE_INDEX [--lemma arma] [--case ablative] \\
+    [--pos noun] [--top-case ablative] [--meter Hexameters] \\
+    [--min-enumerativeness 0.8] [--max-enumerativeness 1] [--limit 100]
+'''
+
+import argparse
+import csv
+from glob import glob
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import create_csvs
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+fields = ['lemma', 'pos', 'case', 'top_case', 'meter']
+
+# The columns of pipeline output that the index needs:
+used_columns = [
+    'tags', 'line_number', 'enumerativeness', 'tokens', 'top_case',
+    'section_url', 'section_meter']
+
+# The "tags" column is written by Pandas as the repr() of a list of dicts,
+# with keys in the order string, lemma, pos, case (see rescore.tag_pattern):
+tag_pattern = re.compile(
+    r"'lemma': (?P<lemma>None|'[^']*'|\"[^\"]*\"), 'pos': '(?P<pos>[^']*)', "
+    r"'case': (?P<case>None|\[[^\]]*\])")
+case_value_pattern = re.compile(r"'([^']*)'")
+
+
+def line_terms(tags, meter: str) -> set:
+  '''The (field, value) terms of one line.
+
+  Args:
+    tags: The line's tags, as a list of dicts or as their string
+      representation (as read back from the pipeline's CSVs).
+
+    meter: The line's section_meter.
+  '''
+  if isinstance(tags, str):
+    tokens = [
+        (None if lemma == 'None' else lemma[1:-1], pos,
+         None if case == 'None' else case_value_pattern.findall(case))
+        for lemma, pos, case in tag_pattern.findall(tags)]
+  else:
+    tokens = [
+        (tag.get('lemma'), tag.get('pos'),
+         list(tag['case']) if tag.get('case') is not None else None)
+        for tag in (tags if tags is not None else [])]
+
+  terms = set()
+  case_counts = {}
+  for lemma, pos, cases in tokens:
+    terms.add(('pos', pos))
+    if lemma is not None and pos != 'punctuation':
+      terms.add(('lemma', lemma))
+    for case in cases or []:
+      terms.add(('case', case))
+      case_counts[case] = case_counts.get(case, 0) + 1
+
+  if case_counts:
+    top = max(case_counts.values())
+    terms.update(
+        ('top_case', case) for case, n in case_counts.items() if n == top)
+  if isinstance(meter, str):
+    terms.add(('meter', meter))
+  return terms
+
+
+def read_output_chunks(path: str, chunk_lines: int = 20000):
+  '''Read the used_columns of a pipeline output file (CSV or Parquet) in
+  chunks of up to chunk_lines lines.'''
+  if path.endswith('.parquet'):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(
+        batch_size=chunk_lines, columns=used_columns):
+      yield batch.to_pandas()
+    return
+
+  # Pandas is imported here, rather than with this module, so that starting
+  # pipeline.py doesn't wait for it:
+  import pandas as pd
+
+  header = pd.read_csv(path, nrows=0).columns
+  if not set(used_columns).issubset(header):
+    logger.warning('"%s" is missing expected columns. Skipping it...', path)
+    return
+  yield from pd.read_csv(
+      path, usecols=used_columns, chunksize=chunk_lines,
+      dtype={'section_url': str, 'section_meter': str, 'tags': str},
+      keep_default_na=False, na_values=['', 'NA'])
+
+
+class LineIndex():
+  '''An inverted index of output lines, in a SQLite file.
+
+  Args:
+    path: The SQLite file. It is created if it does not exist.
+  '''
+
+  def __init__(self, path: str):
+    self.path = path
+    self._connection = sqlite3.connect(path, timeout=60)
+    self._connection.executescript('''
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS files (
+            file_id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+            first_line INTEGER, last_line INTEGER);
+        CREATE TABLE IF NOT EXISTS lines (
+            line_id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL,
+            section_url TEXT, line_number INTEGER, enumerativeness REAL,
+            tokens INTEGER, top_case INTEGER);
+        CREATE TABLE IF NOT EXISTS terms (
+            term_id INTEGER PRIMARY KEY, field TEXT NOT NULL,
+            value TEXT NOT NULL, UNIQUE (field, value));
+        CREATE TABLE IF NOT EXISTS postings (
+            term_id INTEGER NOT NULL, line_id INTEGER NOT NULL,
+            PRIMARY KEY (term_id, line_id)) WITHOUT ROWID;
+    ''')
+    self._term_ids = {
+        (field, value): term_id for term_id, field, value in
+        self._connection.execute('SELECT term_id, field, value FROM terms')}
+
+  def _term_id(self, term: tuple) -> int:
+    term_id = self._term_ids.get(term)
+    if term_id is None:
+      term_id = self._term_ids[term] = self._connection.execute(
+          'INSERT INTO terms (field, value) VALUES (?, ?)', term).lastrowid
+    return term_id
+
+  def _remove(self, file_id: int, first_line: int, last_line: int) -> None:
+    if first_line is not None:
+      # (a file's lines have consecutive ids, so its postings are found by
+      # a range of line_id within each term)
+      self._connection.execute(
+          'DELETE FROM postings WHERE term_id IN (SELECT term_id FROM terms) '
+          'AND line_id BETWEEN ? AND ?', (first_line, last_line))
+    self._connection.execute('DELETE FROM lines WHERE file_id = ?', (file_id,))
+    self._connection.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+
+  def _add(self, path: str, size: int, mtime_ns: int) -> int:
+    import pandas as pd
+
+    file_id = self._connection.execute(
+        'INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)',
+        (path, size, mtime_ns)).lastrowid
+    line_id = first_line = (self._connection.execute(
+        'SELECT MAX(line_id) FROM lines').fetchone()[0] or 0) + 1
+
+    for chunk in read_output_chunks(path):
+      lines = []
+      postings = []
+      for tags, line_number, enumerativeness, tokens, top_case, \
+          section_url, meter in chunk[used_columns].itertuples(
+              index=False, name=None):
+        lines.append((
+            line_id, file_id, section_url, int(line_number),
+            None if pd.isna(enumerativeness) else float(enumerativeness),
+            int(tokens), int(top_case)))
+        postings.extend(
+            (self._term_id(term), line_id)
+            for term in line_terms(tags, meter))
+        line_id += 1
+      self._connection.executemany(
+          'INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?, ?)', lines)
+      self._connection.executemany(
+          'INSERT INTO postings VALUES (?, ?)', postings)
+
+    if line_id > first_line:
+      self._connection.execute(
+          'UPDATE files SET first_line = ?, last_line = ? WHERE file_id = ?',
+          (first_line, line_id - 1, file_id))
+    return line_id - first_line
+
+  def update(self, output_files: list) -> dict:
+    '''Index the output files that are new or have changed since they were
+    indexed, and drop the indexed files not in output_files.
+
+    Output: A dict with the numbers of files "indexed", "unchanged", and
+      "removed", and of "lines" indexed.
+    '''
+    indexed = {
+        path: (file_id, size, mtime_ns, first_line, last_line)
+        for file_id, path, size, mtime_ns, first_line, last_line in
+        self._connection.execute('SELECT * FROM files')}
+    wanted = set(os.path.abspath(path) for path in output_files)
+    counts = {'indexed': 0, 'unchanged': 0, 'removed': 0, 'lines': 0}
+
+    for path, (file_id, _, _, first_line, last_line) in indexed.items():
+      if path not in wanted:
+        with self._connection:
+          self._remove(file_id, first_line, last_line)
+        counts['removed'] += 1
+
+    for path in sorted(wanted):
+      status = os.stat(path)
+      if path in indexed:
+        file_id, size, mtime_ns, first_line, last_line = indexed[path]
+        if (size, mtime_ns) == (status.st_size, status.st_mtime_ns):
+          counts['unchanged'] += 1
+          continue
+      # Each file is replaced in one transaction, so an interrupted update
+      # leaves it either indexed or not:
+      with self._connection:
+        if path in indexed:
+          self._remove(file_id, first_line, last_line)
+        counts['lines'] += self._add(
+            path, status.st_size, status.st_mtime_ns)
+      counts['indexed'] += 1
+
+    logger.info(
+        'Line index "%s": %d files indexed (%d lines), %d unchanged, %d '
+        'removed.', self.path, counts['indexed'], counts['lines'],
+        counts['unchanged'], counts['removed'])
+    return counts
+
+  def query(
+      self,
+      min_enumerativeness: float = None,
+      max_enumerativeness: float = None,
+      limit: int = None,
+      **terms) -> list:
+    '''Find the lines that have every term given.
+
+    Args:
+      min_enumerativeness, max_enumerativeness: Only lines whose
+        enumerativeness is within this range (inclusive) are returned.
+        Defaults to None, for no bound.
+
+      limit: The largest number of lines to return. Defaults to None, for
+        all of them.
+
+      terms: For any of fields, a value or list of values that lines must
+        all have, e.g., lemma='arma', top_case=['ablative'].
+
+    Output: A list of dicts with keys "file", "section_url", "line_number",
+      "enumerativeness", "tokens", and "top_case", in file and line order.
+    '''
+    term_ids = []
+    for field, values in terms.items():
+      if field not in fields:
+        raise ValueError(f'Unknown field "{field}".')
+      for value in [values] if isinstance(values, str) else values:
+        term_id = self._term_ids.get((field, value))
+        if term_id is None:
+          return []
+        term_ids.append(term_id)
+
+    conditions = []
+    parameters = []
+    if term_ids:
+      # Most selective first, so that SQLite intersects from the shortest
+      # postings:
+      conditions.append('lines.line_id IN (' + ' INTERSECT '.join(
+          ['SELECT line_id FROM postings WHERE term_id = ?'] *
+          len(term_ids)) + ')')
+      parameters += sorted(term_ids, key=self._postings_count)
+    if min_enumerativeness is not None:
+      conditions.append('enumerativeness >= ?')
+      parameters.append(min_enumerativeness)
+    if max_enumerativeness is not None:
+      conditions.append('enumerativeness <= ?')
+      parameters.append(max_enumerativeness)
+
+    sql = ('SELECT files.path, section_url, line_number, enumerativeness, '
+           'tokens, top_case FROM lines JOIN files USING (file_id)')
+    if conditions:
+      sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY lines.line_id'
+    if limit is not None:
+      sql += ' LIMIT ?'
+      parameters.append(limit)
+
+    return [
+        dict(zip(['file', 'section_url', 'line_number', 'enumerativeness',
+                  'tokens', 'top_case'], row))
+        for row in self._connection.execute(sql, parameters)]
+
+  def _postings_count(self, term_id: int) -> int:
+    return self._connection.execute(
+        'SELECT COUNT(*) FROM postings WHERE term_id = ?',
+        (term_id,)).fetchone()[0]
+
+  def close(self) -> None:
+    self._connection.close()
+
+
+def output_files(output_directory: str) -> list:
+  '''The complete output files (see create_csvs.output_is_complete()) in
+  output_directory.'''
+  return sorted(
+      path for path in
+      glob(os.path.join(output_directory, '*.csv')) +
+      glob(os.path.join(output_directory, '*.parquet'))
+      if not os.path.basename(path).startswith('_') and
+      create_csvs.output_is_complete(path))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  update_parser = subparsers.add_parser(
+      'update', help='Index new and changed output files.')
+  update_parser.add_argument('line_index')
+  update_parser.add_argument('output_directory')
+
+  query_parser = subparsers.add_parser(
+      'query', help='Find the lines with every term given, as CSV.')
+  query_parser.add_argument('line_index')
+  for field in fields:
+    query_parser.add_argument(
+        f'--{field.replace("_", "-")}', action='append', dest=field,
+        help='May be repeated.')
+  query_parser.add_argument('--min-enumerativeness', type=float)
+  query_parser.add_argument('--max-enumerativeness', type=float)
+  query_parser.add_argument('--limit', type=int)
+  args = parser.parse_args()
+
+  logger.setLevel(logging.INFO)
+  index = LineIndex(args.line_index)
+  if args.command == 'update':
+    index.update(output_files(args.output_directory))
+  else:
+    start = time.perf_counter()
+    lines = index.query(
+        min_enumerativeness=args.min_enumerativeness,
+        max_enumerativeness=args.max_enumerativeness,
+        limit=args.limit,
+        **{field: getattr(args, field) for field in fields
+           if getattr(args, field) is not None})
+    logger.info(
+        '%d lines found in %.1f ms.', len(lines),
+        (time.perf_counter() - start) * 1000)
+    writer = csv.DictWriter(sys.stdout, fieldnames=[
+        'file', 'section_url', 'line_number', 'enumerativeness', 'tokens',
+        'top_case'])
+    writer.writeheader()
+    writer.writerows(lines)
+  index.close()
@@ -0,0 +1,428 @@
+'''Remember how CLTK has analyzed each word form, and optionally reuse it.
+
+Latin verse repeats the same word forms (particles, pronouns, common nouns)
+across the whole corpus, yet every occurrence is parsed again, in context,
+by CLTK. A MorphologyMemo counts, for each token string CLTK has returned,
+how often it was given each (lemma, part of speech, case) analysis, and, for
+each word of the text it parsed, how often it was split into each sequence
+of tokens (Stanza splits enclitics off, e.g., "uirumque" into "uirum" and
+"que", and reorders some, e.g., "mecum" into "cum" and "me"). It keeps the
+forms it has looked up most recently in memory, and all of the counts in a
+SQLite file shared by every process, so the counts build up over runs.
+
+With the memo in fast mode (see tokenize_latin.use_morphology_memo()), a
+sentence is not parsed at all if every one of its words has a split that
+has never varied, into tokens whose analyses have never varied: each seen
+at least min_count times, with its most common split or analysis making up
+at least min_share of them. Its tokens are then given those splits and
+analyses, without context. Other sentences are parsed as usual (and
+counted). Since a form's analysis can depend on its context in ways the memo
+hasn't seen, fast mode can change scores; to measure how much, on a
+reference corpus:
+
+  python3 morphology_memo.py report MEMO_FILE FILE.json [FILE.json ...] \\
+    [--parse-cache parse_cache.sqlite] [--profile minimal] [--min-count 10]
+
+which parses every line both ways and compares their enumerativeness (the
+parse cache, if given, only speeds up the full parses). To build a memo's
+analyses from the parses already in a parse cache (e.g., from earlier runs),
+rather than only from sentences parsed from now on:
+
+  python3 morphology_memo.py build MEMO_FILE --parse-cache parse_cache.sqlite
+
+(the parse cache doesn't keep the text of its sentences, so words' splits
+are only counted as sentences are parsed).
+'''
+
+import argparse
+import collections
+import json
+import logging
+import re
+import sqlite3
+
+import compact_tags
+import parse_cache as parse_cache_module
+import run_metrics
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+# Splits prepared text into words: runs of word characters, and each
+# punctuation mark on its own (CLTK may split a word further, into the tokens
+# counted in the memo's splits)
+_word_pattern = re.compile(r'\w+|[^\w\s]')
+
+
+def analysis_of(tag) -> tuple:
+  '''The (lemma, part of speech, case) analysis of a token, where case is a
+  tuple, or None.'''
+  case = tag.case
+  return (tag.lemma, tag.pos, tuple(case) if case is not None else None)
+
+
+def word_splits(text: str, tags: list) -> list:
+  '''Match the tokens CLTK gave prepared text to its words.
+
+  Output: A list of (word, tokens) pairs, where tokens is a tuple of the
+    strings of the tokens the word was split into, or None if the tokens
+    can't be matched to the words (each word's tokens must have the same
+    characters as the word, in any order).
+  '''
+  splits = []
+  tag_index = 0
+  for word in _word_pattern.findall(text):
+    tokens = []
+    length = 0
+    while length < len(word):
+      if tag_index == len(tags) or tags[tag_index].string == '':
+        return None
+      tokens.append(tags[tag_index].string)
+      length += len(tags[tag_index].string)
+      tag_index += 1
+    if sorted(''.join(tokens)) != sorted(word):
+      return None
+    splits.append((word, tuple(tokens)))
+
+  if tag_index != len(tags):
+    return None
+  return splits
+
+
+def _encode_analysis(analysis: tuple) -> str:
+  lemma, pos, case = analysis
+  return json.dumps(
+      [lemma, pos, list(case) if case is not None else None],
+      ensure_ascii=False)
+
+
+def _decode_analysis(value: str) -> tuple:
+  lemma, pos, case = json.loads(value)
+  return (lemma, pos, tuple(case) if case is not None else None)
+
+
+def _encode_split(tokens: tuple) -> str:
+  return json.dumps(list(tokens), ensure_ascii=False)
+
+
+def _decode_split(value: str) -> tuple:
+  return tuple(json.loads(value))
+
+
+# For each kind of count: its table, and how its values are stored there
+_kinds = {
+    'analyses': ('form', 'analysis', _encode_analysis, _decode_analysis),
+    'splits': ('word', 'tokens', _encode_split, _decode_split),
+}
+
+
+class MorphologyMemo():
+  '''Counts of the analyses CLTK has given each word form, and of the
+  tokens it has split each word into.
+
+  Args:
+    path: The SQLite file to keep the counts in. It is created if it does
+      not exist, and several processes can share it. Defaults to None, which
+      keeps them only in memory.
+
+    max_forms: The number of forms (and of words) to keep in memory; the
+      least recently used are dropped (but stay in path). Defaults to
+      100,000.
+
+    min_count: The number of times a form (or word) must have been seen for
+      it to be used without parsing. Defaults to 10.
+
+    min_share: The share of those times that its most common analysis (or
+      split) must make up. Defaults to 1, i.e., it has never varied.
+
+    version: A string identifying the parser; counts from other versions are
+      ignored. Defaults to the installed CLTK version.
+  '''
+
+  def __init__(self, path: str = None, max_forms: int = 100000,
+               min_count: int = 10, min_share: float = 1.0,
+               version: str = None):
+    self.path = path
+    self.max_forms = max_forms
+    self.min_count = min_count
+    self.min_share = min_share
+    self.version = version if version is not None else \
+        parse_cache_module.cltk_version()
+    self.fast_sentences = 0
+    self.parsed_sentences = 0
+
+    # For each kind, key -> {value: count}, least recently used first:
+    self._counts = {kind: collections.OrderedDict() for kind in _kinds}
+    # (kind, key, value) -> count, not yet written to path:
+    self._pending = collections.Counter()
+    self._pending_tokens = 0
+
+    self._connection = None
+    if path is not None:
+      self._connection = sqlite3.connect(path, timeout=60)
+      self._connection.execute('PRAGMA journal_mode=WAL')
+      self._connection.execute('PRAGMA synchronous=NORMAL')
+      for kind, (key, value, _, _) in _kinds.items():
+        self._connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {kind} ('
+            f'version TEXT NOT NULL, {key} TEXT NOT NULL, '
+            f'{value} TEXT NOT NULL, count INTEGER NOT NULL, '
+            f'PRIMARY KEY (version, {key}, {value}))')
+      self._connection.commit()
+
+  def _lookup(self, kind: str, key: str) -> dict:
+    counts = self._counts[kind]
+    values = counts.get(key)
+    if values is not None:
+      counts.move_to_end(key)
+      return values
+
+    values = {}
+    if self._connection is not None:
+      key_column, value_column, _, decode = _kinds[kind]
+      for value, count in self._connection.execute(
+          f'SELECT {value_column}, count FROM {kind} '
+          f'WHERE version = ? AND {key_column} = ?', (self.version, key)):
+        values[decode(value)] = count
+
+    counts[key] = values
+    if len(counts) > self.max_forms:
+      counts.popitem(last=False)
+    return values
+
+  def _add(self, kind: str, key: str, value) -> None:
+    if self._connection is not None:
+      self._pending[(kind, key, value)] += 1
+      # (keys that aren't in memory are read from path when next needed)
+      values = self._counts[kind].get(key)
+    else:
+      values = self._lookup(kind, key)
+    if values is not None:
+      values[value] = values.get(value, 0) + 1
+
+  def _confident(self, values: dict):
+    if len(values) == 0:
+      return None
+
+    total = sum(values.values())
+    value, count = max(values.items(), key=lambda item: item[1])
+    if total < self.min_count or count < self.min_share * total:
+      return None
+    return value
+
+  def analyses(self, form: str) -> dict:
+    '''The analyses form has been given, as a dict from (lemma, part of
+    speech, case) tuples to counts.'''
+    return self._lookup('analyses', form)
+
+  def splits(self, word: str) -> dict:
+    '''The tokens word has been split into, as a dict from tuples of token
+    strings to counts.'''
+    return self._lookup('splits', word)
+
+  def confident_analysis(self, form: str) -> tuple:
+    '''The analysis of form, if it is certain enough (see min_count and
+    min_share) to use without parsing, or None.'''
+    return self._confident(self.analyses(form))
+
+  def confident_split(self, word: str) -> tuple:
+    '''The tokens word is split into, if that is certain enough (see
+    min_count and min_share) to use without parsing, or None.'''
+    return self._confident(self.splits(word))
+
+  def fast_tags(self, text: str) -> list:
+    '''Tokens for a prepared sentence from the memo alone, without parsing.
+
+    Output: A list of compact_tags.Tokens, or None if any of text's words
+      has no confident_split(), or any of their tokens no
+      confident_analysis().
+    '''
+    with run_metrics.stage('morphology_memo'):
+      tags = []
+      for word in _word_pattern.findall(text):
+        tokens = self.confident_split(word)
+        if tokens is None:
+          self.parsed_sentences += 1
+          return None
+        for form in tokens:
+          analysis = self.confident_analysis(form)
+          if analysis is None:
+            self.parsed_sentences += 1
+            return None
+          lemma, pos, case = analysis
+          tags.append(compact_tags.Token(
+              form, lemma, pos, list(case) if case is not None else None))
+
+    self.fast_sentences += 1
+    return tags
+
+  def record(self, tags: list, text: str = None) -> None:
+    '''Count the analyses of a parsed sentence's tokens, and, if text (the
+    prepared text they were parsed from) is given, how its words were split
+    into them.'''
+    with run_metrics.stage('morphology_memo'):
+      for tag in tags:
+        self._add('analyses', tag.string, analysis_of(tag))
+      if text is not None:
+        for word, tokens in word_splits(text, tags) or []:
+          self._add('splits', word, tokens)
+      self._pending_tokens += len(tags)
+
+    # Writing each sentence's tokens separately would be slow, so they are
+    # written in batches:
+    if self._pending_tokens >= 5000:
+      self.flush()
+
+  def flush(self) -> None:
+    '''Add the counts recorded since the last flush to path.'''
+    if self._connection is None or len(self._pending) == 0:
+      return
+
+    with run_metrics.stage('morphology_memo'):
+      for kind, (key_column, value_column, encode, _) in _kinds.items():
+        self._connection.executemany(
+            f'INSERT INTO {kind} (version, {key_column}, {value_column}, '
+            f'count) VALUES (?, ?, ?, ?) '
+            f'ON CONFLICT (version, {key_column}, {value_column}) '
+            f'DO UPDATE SET count = count + excluded.count',
+            [(self.version, key, encode(value), count)
+             for (pending_kind, key, value), count in self._pending.items()
+             if pending_kind == kind])
+      self._connection.commit()
+    self._pending.clear()
+    self._pending_tokens = 0
+
+  def stats(self) -> dict:
+    '''How many sentences fast_tags() has answered, and how many it left to
+    be parsed, since this memo was opened.'''
+    lookups = self.fast_sentences + self.parsed_sentences
+    return {
+        'fast_sentences': self.fast_sentences,
+        'parsed_sentences': self.parsed_sentences,
+        'fast_rate': round(self.fast_sentences / lookups, 3)
+                     if lookups > 0 else None,
+    }
+
+  def close(self) -> None:
+    '''Write any pending counts and close path.'''
+    self.flush()
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
+
+
+def build_from_parse_cache(memo: MorphologyMemo, parse_cache_file: str) -> int:
+  '''Count the analyses of every sentence in a parse cache (see
+  parse_cache.py) in memo (but not their words' splits, since the cache
+  doesn't keep the sentences' text).
+
+  Output: The number of sentences counted.
+  '''
+  connection = sqlite3.connect(parse_cache_file, timeout=60)
+  sentences = 0
+  try:
+    for (tags,) in connection.execute('SELECT tags FROM parses'):
+      memo.record(compact_tags.from_dicts(json.loads(tags)))
+      sentences += 1
+  finally:
+    connection.close()
+  memo.flush()
+  return sentences
+
+
+def drift_report(data_files: list, excluded_parts_of_speech: list = [],
+                 allowed_meters: list = None) -> dict:
+  '''Compare the enumerativeness of every line of data_files with the memo
+  set in tokenize_latin in fast mode and with every sentence parsed.
+
+  Output: A dict with the number of "lines", the number scored both ways
+    ("lines_compared"), the number whose score differs ("lines_changed"),
+    the "mean_absolute_difference" and "max_absolute_difference" in score
+    over the lines compared, and the memo's stats() in fast mode.
+  '''
+  import create_csvs
+  import tokenize_latin
+
+  # The report itself shouldn't add to the memo's counts:
+  tokenize_latin.morphology_learn = False
+  lines = lines_compared = lines_changed = 0
+  total_difference = max_difference = 0
+
+  for data_file in data_files:
+    for _, _, _, _, section in create_csvs.iter_filtered_sections(
+        data_file, allowed_meters):
+      section_lines = section.get('lines', [])
+      scores = []
+      for fast in (False, True):
+        tokenize_latin.morphology_fast_mode = fast
+        scores.append([
+            tokenize_latin.enumerativeness(
+                line, excluded_parts_of_speech=excluded_parts_of_speech
+            )['enumerativeness']
+            for line in tokenize_latin.tokenize_latin(section_lines)])
+
+      for full, fast in zip(*scores):
+        lines += 1
+        if full is None or fast is None:
+          lines_changed += full != fast
+          continue
+        lines_compared += 1
+        difference = abs(full - fast)
+        lines_changed += difference > 0
+        total_difference += difference
+        max_difference = max(max_difference, difference)
+
+  return {
+      'lines': lines,
+      'lines_compared': lines_compared,
+      'lines_changed': lines_changed,
+      'mean_absolute_difference': round(
+          total_difference / lines_compared, 4) if lines_compared > 0
+                                  else None,
+      'max_absolute_difference': round(max_difference, 4),
+      'memo': tokenize_latin.morphology_memo.stats(),
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  build_parser = subparsers.add_parser(
+      'build', help='Count the analyses in a parse cache.')
+  build_parser.add_argument('memo_file')
+  build_parser.add_argument('--parse-cache', required=True)
+
+  report_parser = subparsers.add_parser(
+      'report', help='Compare fast-mode scores with full parsing.')
+  report_parser.add_argument('memo_file')
+  report_parser.add_argument('data_files', nargs='+')
+  report_parser.add_argument('--parse-cache', default=None)
+  report_parser.add_argument(
+      '--profile', default='minimal', choices=['default', 'minimal'])
+  report_parser.add_argument('--min-count', type=int, default=10)
+  report_parser.add_argument('--min-share', type=float, default=1.0)
+  report_parser.add_argument(
+      '--exclude', nargs='*', default=[],
+      help='Parts of speech to exclude from scoring.')
+  args = parser.parse_args()
+
+  logger.setLevel(logging.INFO)
+  if args.command == 'build':
+    memo = MorphologyMemo(args.memo_file)
+    sentences = build_from_parse_cache(memo, args.parse_cache)
+    memo.close()
+    logger.info(
+        'Counted the analyses of %d sentences into "%s".', sentences,
+        args.memo_file)
+  else:
+    import tokenize_latin
+
+    tokenize_latin.use_pipeline_profile(args.profile)
+    if args.parse_cache is not None:
+      tokenize_latin.use_parse_cache(args.parse_cache)
+    tokenize_latin.use_morphology_memo(
+        args.memo_file, min_count=args.min_count, min_share=args.min_share)
+    print(json.dumps(drift_report(
+        args.data_files, excluded_parts_of_speech=args.exclude), indent=2))
+    tokenize_latin.use_morphology_memo(None)
@@ -0,0 +1,197 @@
+'''Read MQDQ author files one section at a time.
+
+json.load builds the whole author file as Python objects before the first
+line can be parsed, so the memory needed to process an author grows with the
+size of the author's largest file. The reader here walks the file's
+structure incrementally, decoding the "author_*" values, each work's values,
+and then each element of "author_works[*].sections" as a separate JSON value,
+so only one section is held in memory at a time.
+
+Files are expected to list "author_works" after the "author_*" values, and
+each work's "sections" after its other values, as the files written by
+download_mqdq_author.download_mqdq_author_works() and "Renaming Greek.py" do.
+Values that come later are still read, but are not available to the sections
+before them.
+'''
+
+import codecs
+import json
+
+# Characters are read from the file this many bytes at a time:
+chunk_size = 1024 * 64
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+class JSONStream():
+  '''An incremental reader of JSON values from a UTF-8 file.
+
+  Args:
+    f: A file opened in binary mode.
+  '''
+
+  def __init__(self, f):
+    self._file = f
+    self._file_offset = f.tell()
+    self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+    self._buffer = ''
+    self._position = 0
+    # The number of bytes of the file before self._buffer[0]:
+    self._buffer_offset = self._file_offset
+    # The number of bytes in self._buffer[:self._counted_position]:
+    self._counted_position = 0
+    self._counted_bytes = 0
+    self._at_end = False
+
+  def _read(self, minimum: int = chunk_size) -> bool:
+    '''Append at least minimum bytes from the file to the buffer, first
+    dropping the part of the buffer that has already been consumed.
+
+    Output: False if the end of the file had already been reached.
+    '''
+    if self._at_end:
+      return False
+
+    if self._position > 0:
+      self._buffer_offset = self.byte_offset()
+      self._buffer = self._buffer[self._position:]
+      self._position = 0
+      self._counted_position = 0
+      self._counted_bytes = 0
+
+    data = self._file.read(max(minimum, chunk_size))
+    self._at_end = len(data) == 0
+    self._buffer += self._text_decoder.decode(data, final=self._at_end)
+    return not self._at_end
+
+  def byte_offset(self) -> int:
+    '''The position in the file of the next unread character, in bytes.'''
+    self._counted_bytes += len(self._buffer[
+        self._counted_position:self._position].encode('utf-8'))
+    self._counted_position = self._position
+    return self._buffer_offset + self._counted_bytes
+
+  def peek(self) -> str:
+    '''The next character that is not whitespace, without consuming it, or
+    "" at the end of the file.'''
+    while True:
+      while self._position < len(self._buffer) and \
+          self._buffer[self._position] in _whitespace:
+        self._position += 1
+      if self._position < len(self._buffer) or not self._read():
+        return self._buffer[self._position:self._position + 1]
+
+  def expect(self, characters: str) -> str:
+    '''Consume the next non-whitespace character, which must be one of
+    characters.'''
+    character = self.peek()
+    if character == '' or character not in characters:
+      raise ValueError(
+          f'Expected one of "{characters}" at byte {self.byte_offset()}, '
+          f'found "{character}".')
+    self._position += 1
+    return character
+
+  def value(self):
+    '''Decode and consume the next complete JSON value.'''
+    self.peek()
+    while True:
+      try:
+        value, end = _decoder.raw_decode(self._buffer, self._position)
+        # A number or literal that reaches the end of the buffer may
+        # continue in the next chunk:
+        if end < len(self._buffer) or self._at_end:
+          self._position = end
+          return value
+      except json.JSONDecodeError:
+        if self._at_end:
+          raise
+      # Read at least as much again as is buffered, so that a large value is
+      # decoded a bounded number of times:
+      self._read(len(self._buffer) - self._position)
+
+  def members(self):
+    '''Consume a JSON object, yielding each key before its value is read.
+    The caller must consume the value (e.g., with value()) before asking for
+    the next key.'''
+    self.expect('{')
+    if self.peek() == '}':
+      self.expect('}')
+      return
+    while True:
+      key = self.value()
+      self.expect(':')
+      yield key
+      if self.expect(',}') == '}':
+        return
+
+  def elements(self):
+    '''Consume a JSON array, yielding before each element. The caller must
+    consume each element before asking for the next one.'''
+    self.expect('[')
+    if self.peek() == ']':
+      self.expect(']')
+      return
+    while True:
+      yield
+      if self.expect(',]') == ']':
+        return
+
+
+def iter_sections(data_file: str):
+  '''Read an MQDQ author file one section at a time.
+
+  Args:
+    data_file: The filename of a JSON file, in the format described in
+      create_csvs.mqdq_to_enumerativeness_dataframe.
+
+  Output: A generator of (author, work_index, work, section_index, section,
+    byte_offset) tuples, one per section, in file order, where:
+      - author is a dict of the file's values other than "author_works"
+      - work is a dict of the work's values other than "sections"
+      - section is the section's dict
+      - byte_offset is where the section starts in data_file (see
+        read_section())
+    The same author and work dicts are shared by all of their sections.
+  '''
+  with open(data_file, 'rb') as f:
+    stream = JSONStream(f)
+    author = {}
+    for key in stream.members():
+      if key != 'author_works':
+        author[key] = stream.value()
+        continue
+
+      for work_index, _ in enumerate(stream.elements()):
+        work = {}
+        for work_key in stream.members():
+          if work_key != 'sections':
+            work[work_key] = stream.value()
+            continue
+
+          for section_index, _ in enumerate(stream.elements()):
+            byte_offset = stream.byte_offset()
+            yield (author, work_index, work, section_index, stream.value(),
+                   byte_offset)
+
+
+def read_author(data_file: str) -> dict:
+  '''Read the values of an MQDQ author file that come before "author_works".
+  '''
+  with open(data_file, 'rb') as f:
+    stream = JSONStream(f)
+    author = {}
+    for key in stream.members():
+      if key == 'author_works':
+        break
+      author[key] = stream.value()
+  return author
+
+
+def read_section(data_file: str, byte_offset: int) -> dict:
+  '''Read the single section that starts at byte_offset in data_file, as
+  given by iter_sections().'''
+  with open(data_file, 'rb') as f:
+    f.seek(byte_offset)
+    return JSONStream(f).value()
@@ -0,0 +1,150 @@
+'''Run the stages of processing an author file at the same time, in threads.
+
+create_csvs.mqdq_to_csv reads a section, parses and scores its lines, builds
+DataFrames from them, and writes them out, all in sequence, so CLTK sits idle
+while each batch is written. With overlapped=True, it runs three stages at
+once instead: prefetch() reads and decodes the next sections in one thread,
+the calling thread parses and scores, and a BackgroundWriter builds the
+DataFrames and writes them in another. Each stage hands its results to the
+next through a bounded queue, so a slow stage holds the others back rather
+than letting results pile up in memory. If any stage fails, the others are
+stopped (the writer once it has written what it was already given, so that
+the sections finished before the failure are kept), and the failure is
+raised in the calling thread.
+
+CLTK (through Stanza and PyTorch) releases the GIL while it parses, so the
+reading and writing threads mostly run while the parser is busy.
+'''
+
+import queue
+import threading
+
+# Seconds to wait on a full queue before checking whether to stop:
+poll_seconds = 0.1
+
+# Marks the end of a queue:
+_end = object()
+
+
+def _put(items: queue.Queue, item, stopped: threading.Event) -> bool:
+  '''Put item on items, unless stopped is set first.
+
+  Output: Whether item was put.
+  '''
+  while not stopped.is_set():
+    try:
+      items.put(item, timeout=poll_seconds)
+      return True
+    except queue.Full:
+      continue
+  return False
+
+
+def prefetch(iterable, max_items: int = 2):
+  '''Iterate over iterable in a background thread, up to max_items ahead of
+  the caller.
+
+  Args:
+    iterable: An iterable, e.g., create_csvs.iter_filtered_sections().
+
+    max_items: The number of items to read ahead. Defaults to 2.
+
+  Output: A generator of the items of iterable, in order. An exception
+    raised by iterable is raised here. If the generator is closed early
+    (e.g., because the caller failed), the background thread stops.
+  '''
+  items = queue.Queue(max_items)
+  stopped = threading.Event()
+
+  def produce():
+    try:
+      for item in iterable:
+        if not _put(items, (item, None), stopped):
+          return
+      _put(items, (_end, None), stopped)
+    except BaseException as e:
+      _put(items, (_end, e), stopped)
+
+  thread = threading.Thread(target=produce, name='prefetch', daemon=True)
+  thread.start()
+  try:
+    while True:
+      item, error = items.get()
+      if item is _end:
+        if error is not None:
+          raise error
+        return
+      yield item
+  finally:
+    stopped.set()
+    thread.join()
+
+
+class BackgroundWriter():
+  '''Call write on each item put, in order, in a background thread.
+
+  Use as a context manager: on leaving the block, the remaining items are
+  written, even if the block raises (e.g., so that a section finished before
+  an interruption is still recorded), and the thread has stopped. The
+  writer's own exception is raised if the block didn't raise one.
+
+  Args:
+    write: A function of one item.
+
+    max_items: The number of items that can wait to be written before put()
+      blocks. Defaults to 4.
+  '''
+
+  def __init__(self, write, max_items: int = 4):
+    self._write = write
+    self._items = queue.Queue(max_items)
+    self._error = None
+    self._thread = threading.Thread(
+        target=self._run, name='writer', daemon=True)
+    self._thread.start()
+
+  def _run(self) -> None:
+    while True:
+      item = self._items.get()
+      if item is _end:
+        return
+      # After a failure, the rest is drained unwritten:
+      if self._error is not None:
+        continue
+      try:
+        self._write(item)
+      except BaseException as e:
+        self._error = e
+
+  def _raise_error(self) -> None:
+    if self._error is not None:
+      raise self._error
+
+  def put(self, item) -> None:
+    '''Queue item to be written, waiting while the queue is full. Raises the
+    writer's exception if an earlier item failed to be written.'''
+    while True:
+      self._raise_error()
+      try:
+        self._items.put(item, timeout=poll_seconds)
+        return
+      except queue.Full:
+        continue
+
+  def close(self) -> None:
+    '''Wait for every item to be written, then raise the writer's exception,
+    if any.'''
+    self._items.put(_end)
+    self._thread.join()
+    self._raise_error()
+
+  def __enter__(self) -> 'BackgroundWriter':
+    return self
+
+  def __exit__(self, exception_type, exception, traceback) -> None:
+    if exception_type is None:
+      self.close()
+      return
+
+    self._items.put(_end)
+    self._thread.join()
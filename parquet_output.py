@@ -0,0 +1,276 @@
+'''Write pipeline output as Parquet, in large row groups, instead of CSV.
+
+create_csvs.mqdq_to_csv builds a new DataFrame for every few lines, stamps
+the seven author/work/section columns onto it, and appends it to a CSV with
+the tags turned into a string. Here, parsed lines are added straight to
+column buffers, which are written out as one Parquet row group every
+row_group_lines lines. The tags are stored as a nested list column (so they
+can be read back without parsing strings), and the author/work/section
+columns are dictionary-encoded, since they repeat on every line of a section.
+
+The columns are the same as those of the CSVs. Writing Parquet needs pyarrow
+(pip3 install pyarrow); CSV output does not.
+'''
+
+import logging
+import os
+
+import compact_tags
+import create_csvs
+import mqdq_stream
+import run_metrics
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+# The author, work, and section values repeated on every line, as
+# (output column, source, key):
+metadata_columns = [
+    ('author_name', 'author', 'author_name'),
+    ('author_date', 'author', 'author_date'),
+    ('author_id', 'author', 'author_id'),
+    ('work_name', 'work', 'name'),
+    ('work_edition', 'work', 'edition'),
+    ('section_url', 'section', 'href'),
+    ('section_meter', 'section', 'meter'),
+]
+
+
+def _import_pyarrow():
+  '''Import pyarrow, with a clearer error if it is not installed.'''
+  try:
+    import pyarrow
+    import pyarrow.parquet
+  except ImportError as e:
+    raise ImportError(
+        'Writing Parquet output requires pyarrow; install it with '
+        '"pip3 install pyarrow", or write CSV output instead.') from e
+  return pyarrow, pyarrow.parquet
+
+
+def schema():
+  '''The Arrow schema of the Parquet output.'''
+  pa, _ = _import_pyarrow()
+
+  dictionary_string = pa.dictionary(pa.int32(), pa.string())
+  return pa.schema([
+      ('text', pa.string()),
+      ('text_parsed', pa.string()),
+      ('tags', pa.list_(pa.struct([
+          ('string', pa.string()),
+          ('lemma', pa.string()),
+          ('pos', pa.string()),
+          ('case', pa.list_(pa.string())),
+      ]))),
+      ('line_number', pa.int64()),
+      ('enumerativeness', pa.float64()),
+      ('tokens', pa.int64()),
+      ('top_case', pa.int64()),
+      ('author_name', dictionary_string),
+      ('author_date', dictionary_string),
+      ('author_id', pa.int64()),
+      ('work_name', dictionary_string),
+      ('work_edition', dictionary_string),
+      ('section_url', dictionary_string),
+      ('section_meter', dictionary_string),
+  ])
+
+
+class ParquetLineWriter():
+  '''Buffer parsed lines and write them to a Parquet file in row groups.
+
+  The file is written under a temporary name, and only given the name
+  output_file by close(), so output_file is never left half-written.
+
+  Args:
+    output_file: The Parquet file to write.
+
+    row_group_lines: The number of lines to buffer before writing a row
+      group. Defaults to 100,000.
+  '''
+
+  def __init__(self, output_file: str, row_group_lines: int = 100000):
+    self.pa, self.pq = _import_pyarrow()
+    self.output_file = output_file
+    self.row_group_lines = row_group_lines
+    self.schema = schema()
+    self.lines_written = 0
+    self._temporary_output_file = f'{output_file}.tmp'
+    self._writer = self.pq.ParquetWriter(
+        self._temporary_output_file, self.schema, compression='zstd')
+    self._columns = {field.name: [] for field in self.schema}
+
+  def add_line(self, line: dict, author: dict, work: dict,
+               section: dict) -> None:
+    '''Add one line, from create_csvs.section_to_enumerativeness_lines.'''
+    for column in ('text', 'text_parsed', 'line_number',
+                   'enumerativeness', 'tokens', 'top_case'):
+      self._columns[column].append(line.get(column))
+    self._columns['tags'].append(compact_tags.as_dicts(line.get('tags', [])))
+
+    sources = {'author': author, 'work': work, 'section': section}
+    for column, source, key in metadata_columns:
+      self._columns[column].append(sources[source].get(key))
+
+    if len(self._columns['text']) >= self.row_group_lines:
+      self.flush()
+
+  def add_table(self, table) -> None:
+    '''Add the lines of an Arrow table with the same schema.'''
+    self.flush()
+    self._writer.write_table(table.cast(self.schema))
+    self.lines_written += table.num_rows
+
+  def flush(self) -> None:
+    '''Write the buffered lines as a row group.'''
+    if len(self._columns['text']) == 0:
+      return
+
+    with run_metrics.stage('parquet_writing'):
+      table = self.pa.Table.from_pydict(self._columns, schema=self.schema)
+      self._writer.write_table(table, row_group_size=table.num_rows)
+    self.lines_written += table.num_rows
+    self._columns = {field.name: [] for field in self.schema}
+
+  def close(self) -> None:
+    '''Write any buffered lines and give the file its final name.'''
+    self.flush()
+    self._writer.close()
+    os.replace(self._temporary_output_file, self.output_file)
+
+  def abort(self) -> None:
+    '''Stop writing and remove the temporary file.'''
+    self._writer.close()
+    os.remove(self._temporary_output_file)
+
+
+def mqdq_to_parquet(
+    data_file: str,
+    output_file: str,
+    allowed_meters: list = None,
+    excluded_parts_of_speech: list = [],
+    row_group_lines: int = 100000,
+    artifact_key: str = None) -> None:
+  '''A wrapper function for taking an input JSON file of Latin poetry, parsing
+  its lines, and writing the output to a Parquet file.
+
+  Args:
+    data_file: The filename of a JSON file; see
+      create_csvs.mqdq_to_enumerativeness_dataframe for the expected format.
+
+    output_file: The name of the Parquet file to write.
+
+    allowed_meters: "Meters" values from MQDQ to allow. Defaults to None,
+      which allows everything.
+
+    excluded_parts_of_speech: to be passed to tokenize_latin.enumerativeness
+
+    row_group_lines: The number of lines per Parquet row group. Defaults to
+      100,000.
+
+    artifact_key: The output's key in the artifact store, if one is used;
+      see create_csvs.resume_checkpoint(). Defaults to None.
+
+  Output: None. The columns of output_file are those listed for
+    create_csvs.mqdq_to_csv. Unlike CSV output, the file is only written
+    once every section has been parsed, and its manifest (see
+    create_csvs.read_checkpoint()) lists no sections.
+  '''
+  logger.info('Opening "%s"...', data_file)
+
+  output_directory = os.path.dirname(output_file)
+  if output_directory != '' and not os.path.exists(output_directory):
+    logger.info(
+        'Creating directory "%s" for output...', output_directory)
+    os.makedirs(output_directory)
+
+  checkpoint = create_csvs.resume_checkpoint(
+      output_file, data_file, artifact_key)
+  writer = ParquetLineWriter(output_file, row_group_lines=row_group_lines)
+  try:
+    for author, work_index, work, section_index, section in \
+        create_csvs.iter_filtered_sections(data_file, allowed_meters):
+      with run_metrics.section(
+          data_file, work_index, section_index, href=section.get('href'),
+          meter=section.get('meter')):
+        for line in create_csvs.section_to_enumerativeness_lines(
+            section, excluded_parts_of_speech=excluded_parts_of_speech):
+          writer.add_line(line, author, work, section)
+  except BaseException:
+    writer.abort()
+    raise
+
+  writer.close()
+  checkpoint['complete'] = True
+  create_csvs.write_checkpoint(output_file, checkpoint)
+
+
+def read_parquet(input_file: str, columns: list = None):
+  '''Read a Parquet file written by mqdq_to_parquet() into a Pandas
+  DataFrame.
+
+  Args:
+    input_file: The Parquet file to read.
+
+    columns: The columns to read. Defaults to None, which reads them all.
+
+  Output: A DataFrame with the columns of input_file. Its "tags" column, if
+    read, holds lists of dicts, as produced by tokenize_latin.tokenize_latin
+    (rather than the arrays Arrow turns nested lists into).
+  '''
+  _, pq = _import_pyarrow()
+
+  data = pq.read_table(input_file, columns=columns).to_pandas()
+  if 'tags' in data.columns:
+    data['tags'] = [
+        [{**tag, 'case': None if tag['case'] is None else list(tag['case'])}
+         for tag in tags] if tags is not None else []
+        for tags in data['tags']]
+  return data
+
+
+def write_section_parquet(
+    task: dict,
+    output_file: str,
+    excluded_parts_of_speech: list = []) -> None:
+  '''Parse a single section (a task from section_pool.section_tasks) and
+  write it to its own Parquet file, for merge_parquet_files() to combine.'''
+  author = mqdq_stream.read_author(task['data_file'])
+  section = mqdq_stream.read_section(task['data_file'], task['byte_offset'])
+
+  writer = ParquetLineWriter(output_file)
+  try:
+    for line in create_csvs.section_to_enumerativeness_lines(
+        section, excluded_parts_of_speech=excluded_parts_of_speech):
+      writer.add_line(line, author, task['work'], section)
+  except BaseException:
+    writer.abort()
+    raise
+
+  writer.close()
+
+
+def merge_parquet_files(part_files: list, output_file: str,
+                        row_group_lines: int = 100000) -> None:
+  '''Concatenate Parquet files written by write_section_parquet, in order,
+  into output_file, regrouping their rows into row groups of
+  row_group_lines.'''
+  pa, pq = _import_pyarrow()
+
+  writer = ParquetLineWriter(output_file, row_group_lines=row_group_lines)
+  buffered = []
+  buffered_lines = 0
+  for part_file in part_files:
+    table = pq.read_table(part_file)
+    if table.num_rows == 0:
+      continue
+    buffered.append(table)
+    buffered_lines += table.num_rows
+    if buffered_lines >= row_group_lines:
+      writer.add_table(pa.concat_tables(buffered).combine_chunks())
+      buffered = []
+      buffered_lines = 0
+
+  if buffered:
+    writer.add_table(pa.concat_tables(buffered).combine_chunks())
+  writer.close()
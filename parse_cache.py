@@ -0,0 +1,163 @@
+'''A persistent, content-addressed cache of CLTK parses.
+
+Re-running the pipeline over an unchanged corpus (e.g., into a new output
+directory, or with a different set of excluded parts of speech) repeats the
+exact same cltk_nlp.analyze calls. This cache stores the token records that
+tokenize_latin builds from each parsed sentence in a local SQLite file, keyed
+by a hash of the prepared sentence text and a version: the CLTK version,
+with the pipeline profile and batch size (see
+tokenize_latin.parse_cache_version()), which also change a sentence's tokens.
+A warm re-run with the same settings only needs to read them back.
+'''
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+import run_metrics
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+
+def cltk_version() -> str:
+  '''The installed CLTK version, or "unknown" if it can't be determined.'''
+  try:
+    from importlib.metadata import version, PackageNotFoundError
+  except ImportError:  # Python < 3.8
+    return 'unknown'
+
+  try:
+    return version('cltk')
+  except PackageNotFoundError:
+    return 'unknown'
+
+
+class ParseCache():
+  '''A size-capped SQLite cache from prepared sentence text to token records.
+
+  Args:
+    path: The SQLite file to store the cache in. It is created if it does
+      not exist. Several processes can share the same file.
+
+    max_entries: The maximum number of sentences to keep. When the cache
+      grows past this, the least recently used entries are evicted (with
+      the times of recent hits written in batches, by flush()). Defaults to
+      2,000,000.
+
+    version: A string identifying the parser and its settings, included in
+      every key so that parses from a different CLTK version, or with other
+      settings, are never returned. Defaults to the installed CLTK version.
+  '''
+
+  def __init__(self, path: str, max_entries: int = 2000000,
+               version: str = None):
+    self.path = path
+    self.max_entries = max_entries
+    self.version = version if version is not None else cltk_version()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._writes_since_check = 0
+    # The times entries were last read, to be written by flush(), by key:
+    self._pending_last_used = {}
+
+    self._connection = sqlite3.connect(path, timeout=60)
+    self._connection.execute('PRAGMA journal_mode=WAL')
+    self._connection.execute('PRAGMA synchronous=NORMAL')
+    self._connection.execute(
+        'CREATE TABLE IF NOT EXISTS parses ('
+        'key TEXT PRIMARY KEY, tags TEXT NOT NULL, last_used REAL NOT NULL)')
+    self._connection.execute(
+        'CREATE INDEX IF NOT EXISTS parses_last_used ON parses (last_used)')
+    self._connection.commit()
+
+  def key(self, text: str) -> str:
+    '''The cache key for a prepared sentence.'''
+    return hashlib.sha256(
+        f'{self.version}\n{text}'.encode('utf-8')).hexdigest()
+
+  def get(self, text: str) -> list:
+    '''Look up the token records for a prepared sentence.
+
+    Output: A list of token dicts (see tokenize_latin.analyze_sentence), or
+      None if text has not been cached.
+    '''
+    with run_metrics.stage('parse_cache'):
+      key = self.key(text)
+      row = self._connection.execute(
+          'SELECT tags FROM parses WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+
+      self.hits += 1
+      # Writing last_used on every hit would make each read a write
+      # transaction, so the times are written in batches:
+      self._pending_last_used[key] = time.time()
+      tags = json.loads(row[0])
+
+    if len(self._pending_last_used) >= 1000:
+      self.flush()
+    return tags
+
+  def put(self, text: str, tags: list) -> None:
+    '''Store the token records for a prepared sentence.'''
+    with run_metrics.stage('parse_cache'):
+      self._connection.execute(
+          'INSERT OR REPLACE INTO parses (key, tags, last_used) '
+          'VALUES (?, ?, ?)',
+          (self.key(text), json.dumps(tags, ensure_ascii=False), time.time()))
+      self._connection.commit()
+
+    # Counting rows is not free, so only check the size cap occasionally:
+    self._writes_since_check += 1
+    if self._writes_since_check >= 1000:
+      self._writes_since_check = 0
+      self.evict()
+
+  def flush(self) -> None:
+    '''Write the times of the hits since the last flush to path.'''
+    if len(self._pending_last_used) == 0:
+      return
+
+    with run_metrics.stage('parse_cache'):
+      self._connection.executemany(
+          'UPDATE parses SET last_used = ? WHERE key = ?',
+          [(last_used, key)
+           for key, last_used in self._pending_last_used.items()])
+      self._connection.commit()
+    self._pending_last_used.clear()
+
+  def evict(self) -> None:
+    '''Remove the least recently used entries beyond max_entries.'''
+    self.flush()
+    count = self._connection.execute(
+        'SELECT COUNT(*) FROM parses').fetchone()[0]
+    excess = count - self.max_entries
+    if excess <= 0:
+      return
+
+    self._connection.execute(
+        'DELETE FROM parses WHERE key IN ('
+        'SELECT key FROM parses ORDER BY last_used LIMIT ?)', (excess,))
+    self._connection.commit()
+    self.evictions += excess
+    logger.info('Evicted %d entries from parse cache "%s".', excess, self.path)
+
+  def stats(self) -> dict:
+    '''Hit, miss, and eviction counts since this cache was opened.'''
+    lookups = self.hits + self.misses
+    return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': round(self.hits / lookups, 3) if lookups > 0 else None,
+    }
+
+  def close(self) -> None:
+    '''Enforce the size cap and close the underlying SQLite file.'''
+    self.evict()
+    self._connection.close()
@@ -0,0 +1,344 @@
+'''A local server that keeps CLTK models loaded between pipeline runs.
+
+Every run of pipeline.py (and every worker it starts) loads the Stanza/CLTK
+Latin models from scratch, which takes longer than parsing a small author.
+Run this script once, and leave it running: it starts a small pool of worker
+processes, each of which loads the models once, and serves
+tokenize_latin.tokenize_latin requests on a Unix socket. While it is
+running, pipeline.py (through tokenize_latin.use_parse_server()) sends each
+section's lines to it, and gets back each line's text, text_parsed, and tags,
+exactly as tokenize_latin.tokenize_latin would give them. When no server is
+running, pipeline.py parses in its own processes, as before.
+
+Each request carries the client's parser settings (see
+tokenize_latin.parser_settings()), and the server refuses requests whose
+settings differ from its own, since it would parse them differently; the
+client then parses in its own process.
+
+Requests and responses are single lines of JSON:
+
+  {"lines": ["Arma uirumque cano, Troiae qui primus ab oris", ...],
+   "section_href": ..., "settings": {"pipeline_profile": "minimal", ...}}
+
+  {"lines": [{"text": ..., "text_parsed": ..., "tags": [...]}, ...],
+   "sentences": 3}
+
+or {"error": "..."} if parsing fails, with the server's "settings" if they
+don't match the request's.
+
+Usage, from the root of this repository:
+
+  python3 parse_server.py [--socket parse_server.sock] [--workers 2] \\
+    [--profile minimal] [--batch-size 1] [--parse-cache parse_cache.sqlite] \\
+    [--transliterate-greek] [--quarantine _quarantine.jsonl] [--timeout 120] \\
+    [--morphology-memo morphology_memo.sqlite [--fast]]
+'''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+
+class ServerError(RuntimeError):
+  '''Raised when a parse server could not parse a request.'''
+
+
+class SettingsMismatch(ServerError):
+  '''Raised when a parse server's parser settings differ from a request's.
+
+  Attributes:
+    server_settings: The server's settings.
+  '''
+
+  def __init__(self, message: str, server_settings: dict):
+    super().__init__(message)
+    self.server_settings = server_settings
+
+
+class ParseClient():
+  '''A connection to a running parse server.
+
+  Args:
+    socket_path: The server's Unix socket.
+
+  Raises OSError if no server is listening on socket_path.
+  '''
+
+  def __init__(self, socket_path: str):
+    self.socket_path = socket_path
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self._socket.connect(socket_path)
+    except OSError:
+      self._socket.close()
+      raise
+    self._file = self._socket.makefile('rwb')
+
+  def tokenize_latin(self, lines: list, section_href: str = None,
+                     settings: dict = None) -> dict:
+    '''Parse a section's lines on the server.
+
+    Args:
+      lines: The section's lines.
+
+      section_href: The section's href, recorded with any sentences that
+        can't be parsed. Defaults to None.
+
+      settings: The parser settings the lines should be parsed with (see
+        tokenize_latin.parser_settings()). Defaults to None, which accepts
+        the server's.
+
+    Output: A dict with "lines", a list of dicts as from
+      tokenize_latin.tokenize_latin, and "sentences", the number of
+      sentences parsed.
+
+    Raises OSError if the connection to the server is lost,
+    SettingsMismatch if the server's settings differ from settings, or
+    ServerError if the server could not parse lines.
+    '''
+    request = {'lines': lines, 'section_href': section_href,
+               'settings': settings}
+    self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+    self._file.flush()
+
+    response = self._file.readline()
+    if response == b'':
+      raise ConnectionError(
+          f'The parse server at "{self.socket_path}" closed the connection.')
+
+    response = json.loads(response)
+    if 'settings' in response:
+      raise SettingsMismatch(response['error'], response['settings'])
+    if 'error' in response:
+      raise ServerError(f'The parse server failed: {response["error"]}')
+    return response
+
+  def close(self) -> None:
+    try:
+      self._file.close()
+    except OSError:
+      # Anything unsent can't be sent if the server has gone.
+      pass
+    self._socket.close()
+
+
+def _init_worker(pipeline_profile: str, analyze_batch_size: int,
+                 parse_cache_file: str,
+                 parse_cache_max_entries: int,
+                 transliterate_greek: bool = False,
+                 quarantine_file: str = None,
+                 sentence_timeout_seconds: float = None,
+                 morphology_memo_file: str = None,
+                 morphology_fast_mode: bool = False) -> None:
+  '''Set up a server worker process, loading the models straight away.'''
+  import tokenize_latin
+
+  tokenize_latin.use_pipeline_profile(
+      pipeline_profile, batch_size=analyze_batch_size)
+  tokenize_latin.use_greek_transliteration(transliterate_greek)
+  tokenize_latin.use_quarantine(
+      quarantine_file, timeout_seconds=sentence_timeout_seconds)
+  if morphology_memo_file is not None:
+    tokenize_latin.use_morphology_memo(
+        morphology_memo_file, fast=morphology_fast_mode)
+  if parse_cache_file is not None:
+    tokenize_latin.use_parse_cache(
+        parse_cache_file, max_entries=parse_cache_max_entries)
+
+  tokenize_latin.load_parser(sentence_timeout_seconds)
+  tokenize_latin.get_sentence_tokenizer()
+
+
+def _worker_settings() -> dict:
+  '''The parser settings of a server worker.'''
+  import tokenize_latin
+
+  return tokenize_latin.parser_settings()
+
+
+def _tokenize_section(lines: list, section_href: str = None) -> dict:
+  '''Parse one request's lines in a server worker.'''
+  import compact_tags
+  import run_metrics
+  import tokenize_latin
+
+  parsed_lines = [
+      dict(line, tags=compact_tags.as_dicts(line['tags']))
+      for line in tokenize_latin.tokenize_latin(lines, section_href)]
+  # Only the sentence count is sent back; other metrics would only pile up:
+  sentences = run_metrics.take()['counters'].get('sentences', 0)
+  return {'lines': parsed_lines, 'sentences': sentences}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+  '''Answer each line of JSON from a client until it disconnects.'''
+
+  def handle(self):
+    for request in self.rfile:
+      try:
+        request = json.loads(request)
+        settings = request.get('settings')
+        if settings is not None and settings != self.server.settings:
+          differences = sorted(
+              key for key in set(settings) | set(self.server.settings)
+              if settings.get(key) != self.server.settings.get(key))
+          response = {
+              'error': 'The server parses with other settings ('
+                       + ', '.join(differences) + ').',
+              'settings': self.server.settings}
+        else:
+          response = self.server.pool.apply(
+              _tokenize_section,
+              (request['lines'], request.get('section_href')))
+      except Exception as e:
+        logger.exception('Could not parse request.')
+        response = {'error': f'{type(e).__name__}: {e}'}
+
+      self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+      self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def _stop(signal_number, frame):
+  raise KeyboardInterrupt()
+
+
+def server_is_running(socket_path: str) -> bool:
+  '''Whether a parse server is listening on socket_path.'''
+  try:
+    ParseClient(socket_path).close()
+  except OSError:
+    return False
+  return True
+
+
+def serve(
+    socket_path: str = 'parse_server.sock',
+    number_of_workers: int = 2,
+    pipeline_profile: str = 'minimal',
+    analyze_batch_size: int = 1,
+    parse_cache_file: str = None,
+    parse_cache_max_entries: int = 2000000,
+    transliterate_greek: bool = False,
+    quarantine_file: str = None,
+    sentence_timeout_seconds: float = 120,
+    morphology_memo_file: str = None,
+    morphology_fast_mode: bool = False) -> None:
+  '''Run a parse server until interrupted (e.g., with Ctrl-C) or
+  terminated.
+
+  Args:
+    socket_path: The Unix socket to listen on.
+
+    number_of_workers: The number of worker processes, each holding its own
+      copy of the models, and so able to parse one section at a time.
+
+    pipeline_profile: The CLTK pipeline for each worker to build; see
+      tokenize_latin.build_nlp().
+
+    analyze_batch_size: See tokenize_latin.use_pipeline_profile().
+
+    parse_cache_file: A SQLite file for tokenize_latin.use_parse_cache, shared
+      by all workers. Defaults to None, which parses every sentence.
+
+    parse_cache_max_entries: The maximum number of sentences to keep in the
+      parse cache.
+
+    transliterate_greek: Whether to transliterate Greek words rather than
+      remove them (see tokenize_latin.use_greek_transliteration()); this
+      should match the pipeline's setting.
+
+    quarantine_file: A file to record sentences that couldn't be parsed in,
+      shared by all workers (see fault_isolation.py). Defaults to None,
+      which only logs them.
+
+    sentence_timeout_seconds: The longest to spend parsing one sentence
+      before giving up on it, or None to wait indefinitely. Defaults to 120,
+      as in pipeline.py.
+
+    morphology_memo_file: A SQLite file for tokenize_latin.use_morphology_memo,
+      shared by all workers. Defaults to None, which keeps no memo.
+
+    morphology_fast_mode: Whether to skip parsing sentences whose analyses
+      are all certain in the memo (see morphology_memo.py). Defaults to
+      False.
+
+  The defaults match pipeline.py's, since the server only parses for runs
+  with the same parser settings.
+
+  Output: None.
+  '''
+  if os.path.exists(socket_path):
+    if server_is_running(socket_path):
+      raise RuntimeError(
+          f'A parse server is already running at "{socket_path}".')
+    # Left behind by a server that didn't shut down cleanly:
+    os.remove(socket_path)
+
+  logger.info(
+      'Loading models in %d workers (profile "%s")...', number_of_workers,
+      pipeline_profile)
+  with multiprocessing.Pool(
+      number_of_workers,
+      initializer=_init_worker,
+      initargs=(pipeline_profile, analyze_batch_size, parse_cache_file,
+                parse_cache_max_entries, transliterate_greek, quarantine_file,
+                sentence_timeout_seconds, morphology_memo_file,
+                morphology_fast_mode)) as pool:
+    server = _Server(socket_path, _RequestHandler)
+    server.pool = pool
+    server.settings = pool.apply(_worker_settings)
+    # Stop in the same way on SIGTERM (e.g., from kill) as on Ctrl-C:
+    signal.signal(signal.SIGTERM, _stop)
+    logger.info('Serving on "%s"; press Ctrl-C to stop.', socket_path)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      logger.info('Stopping...')
+    finally:
+      server.server_close()
+      os.remove(socket_path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--socket', default='parse_server.sock')
+  parser.add_argument('--workers', type=int, default=2)
+  parser.add_argument(
+      '--profile', default='minimal', choices=['default', 'minimal'])
+  parser.add_argument('--batch-size', type=int, default=1)
+  parser.add_argument('--parse-cache', default=None)
+  parser.add_argument('--parse-cache-max-entries', type=int, default=2000000)
+  parser.add_argument('--transliterate-greek', action='store_true')
+  parser.add_argument('--quarantine', default=None)
+  parser.add_argument(
+      '--timeout', type=float, default=120,
+      help='Seconds to spend on one sentence; 0 waits indefinitely.')
+  parser.add_argument('--morphology-memo', default=None)
+  parser.add_argument('--fast', action='store_true')
+  args = parser.parse_args()
+
+  logger.setLevel(logging.INFO)
+  serve(
+      socket_path=args.socket,
+      number_of_workers=args.workers,
+      pipeline_profile=args.profile,
+      analyze_batch_size=args.batch_size,
+      parse_cache_file=args.parse_cache,
+      parse_cache_max_entries=args.parse_cache_max_entries,
+      transliterate_greek=args.transliterate_greek,
+      quarantine_file=args.quarantine,
+      sentence_timeout_seconds=args.timeout if args.timeout > 0 else None,
+      morphology_memo_file=args.morphology_memo,
+      morphology_fast_mode=args.fast)
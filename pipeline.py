@@ -6,23 +6,30 @@ This script will process multiple files simultaneously, depending on the number
 of available cores.
 '''
 
-import dask.dataframe as dd
 from glob import glob
 import json
 import logging
-import multiprocessing
 import os
-import pandas as pd
-import psutil
 import datetime
 
+import adaptive_batching
+import artifact_store
+import corpus_index
 import create_csvs
+import line_index
+import parquet_output
+import parse_server
+import run_metrics
+import sampling
+import section_pool
+import section_profiler
+import tokenize_latin
 
 logger = logging.getLogger('mqdq_tokenization')
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
-number_of_cores = psutil.cpu_count(logical=True)
+number_of_cores = os.cpu_count() or 1
 
 data_directory = '/Users/joshuahartman/desktop/MQDQII/Temporary_Texts'
 output_directory = 'CSVS_No_Exclusion'
@@ -30,50 +37,331 @@ output_directory = 'CSVS_No_Exclusion'
 # set the excluded parts of speech here
 excluded_parts_of_speech = []
 
+# whether to transliterate Greek words (as "Renaming Greek.py" does) as text
+# is prepared for parsing, rather than remove them; the corpus itself is left
+# as it is
+transliterate_greek = False
 
-# Only process files that have not already been processed:
-files_to_process = [f for f in glob(os.path.join(
-    data_directory, '*.json')) if not os.path.exists(
-    os.path.join(output_directory,
-                 f'{os.path.splitext(os.path.basename(f))[0]}.csv'))]
+# "Meters" values from MQDQ to parse, e.g., ['Hexameters', 'Elegiac couplets'];
+# None parses every section
+allowed_meters = None
 
-# write a log file to capture parameters for  this run
-current_date_and_time = datetime.datetime.now()
-current_date_and_time_string = str(current_date_and_time)
-log_file = "_log_" +  current_date_and_time_string + ".txt"
-log = open(os.path.join(output_directory, log_file), "a")
+# each author file's sections (meters, line counts, and where they start) are
+# indexed in this file, so files without allowed meters are skipped without
+# being parsed and the largest sections are started first; a file is indexed
+# again whenever it changes
+corpus_index_file = 'corpus_index.json'
 
-log.write(output_directory + "\n")
-log.write("excluded parts of speech: " + ' '.join([str(elem) for elem in excluded_parts_of_speech]) + "\n")
-log.write("Files: " + ' '.join([str(elem) for elem in files_to_process]) + "\n\n")
+# number of worker processes to parse sections with; set to 1 to process one
+# file at a time in this process, as before
+number_of_workers = max(number_of_cores - 1, 1)
 
-# copy over the current version of each py file used
-cc = open("create_csvs.py", "r")
-log.write("\n\n*****************\n create_csvs.py \n*****************\n")
-for line in cc:
-    log.write(line)
-cc.close()
-tl = open("tokenize_latin.py", "r")
-log.write("\n\n*****************\n tokenize_latin.py \n*****************\n")
-for line in tl:
-    log.write(line)
-tl.close()
+# stop handing out new sections to workers while system memory use is above
+# this percentage
+max_memory_percent = 85
 
-log.close() # close the log file
+# approximate memory used by one worker with the CLTK model loaded, in GB;
+# the number of workers is reduced if available memory can't hold them all
+worker_memory_gb = 2
 
+# parses of each sentence are cached in this file, so re-running over the same
+# text (e.g., into a new output directory) skips CLTK; set to None to disable
+parse_cache_file = 'parse_cache.sqlite'
 
+# the maximum number of sentences to keep in the parse cache
+parse_cache_max_entries = 2000000
 
+# the analyses CLTK gives each word form are counted in this file across runs
+# (see morphology_memo.py); set to None to disable
+morphology_memo_file = 'morphology_memo.sqlite'
 
-for file in files_to_process:
+# skip parsing sentences whose every word form has only ever had one analysis
+# in the memo, giving them those analyses without context; this is faster but
+# can change scores, so check python3 morphology_memo.py report first
+morphology_fast_mode = False
 
-    create_csvs.mqdq_to_csv(
-        data_file=file,
-        output_file=os.path.join(output_directory, 
-            f'{os.path.splitext(os.path.basename(file))[0]}.csv'),
-        excluded_parts_of_speech = excluded_parts_of_speech,
-        write_lines=10
-    )
+# which CLTK pipeline to parse with: 'minimal' runs only the tokenizer and
+# Stanza morphosyntax, which give everything enumerativeness needs; 'default'
+# runs CLTK's full Latin pipeline
+cltk_pipeline_profile = 'minimal'
 
+# the number of sentences to send to CLTK in each analyze call
+analyze_batch_size = 1
+
+# if a parse server (python3 parse_server.py) is running on this socket, it
+# parses sentences with models it has already loaded, rather than each run
+# loading them again; set to None to always parse in this run's processes
+parse_server_socket = 'parse_server.sock'
+
+# the longest to spend parsing one sentence, in seconds; a sentence that takes
+# longer, or that CLTK fails on, is retried with stricter normalization and
+# then given "unparsed" tokens, so the rest of its author is still parsed (see
+# fault_isolation.py); with a limit, each process parses in a child process
+# that can be killed (Unix only); set to None to wait indefinitely, parsing in
+# the process itself
+sentence_timeout_seconds = 120
+
+# sentences that couldn't be parsed are recorded in this file in the output
+# directory, to parse again later with python3 fault_isolation.py
+quarantine_file = os.path.join(output_directory, '_quarantine.jsonl')
+
+# the number of parsed lines to batch before writing them out
+write_lines = 10
+
+# grow or shrink write_lines as the run goes, by how long writing takes, how
+# fast lines are parsed, and memory use (see adaptive_batching.py); batches
+# always end with their section, and the sizes chosen are in the run log
+adaptive_write_lines = True
+
+# when adapting write_lines, batches are made smaller while a process uses
+# more memory than this, in MB
+batch_memory_budget_mb = worker_memory_gb * 1024
+
+# when processing one file at a time (number_of_workers = 1), read the next
+# sections and write the output in background threads while CLTK parses (see
+# overlapped.py); the output is the same either way
+overlapped_io = True
+
+# finished output files are kept in this directory, keyed by a hash of their
+# input file, the settings above that change them, and the code and CLTK
+# version, so a run into a new output directory links the outputs it already
+# has rather than parsing again, and an output written (or left unfinished) by
+# other code or with other settings is parsed again (see artifact_store.py);
+# set to None to disable
+artifact_store_directory = 'artifact_store'
+
+# sample the call stacks of every section, and keep those of this many of the
+# slowest, as flame graph stacks with a ranked summary, in profile_directory
+# (see section_profiler.py); 0 turns profiling off
+profile_top_sections = 0
+profile_directory = os.path.join(output_directory, '_profiles')
+
+# after each run, index the lines of every finished output file in
+# output_directory by lemma, case, part of speech, dominant case, and meter,
+# with their enumerativeness, so lines can be looked up without reading the
+# outputs (see line_index.py); only new or changed files are indexed again;
+# set to None to disable
+line_index_file = os.path.join(output_directory, '_line_index.sqlite')
+
+# 'csv', or 'parquet' for one Parquet file per author, with the tags stored as
+# a nested column (requires pyarrow; see parquet_output.py)
+output_format = 'csv'
+
+# rather than parse every line, parse a stratified random sample of each
+# file's sentences, by meter, until each file's enumerativeness_rate8 and
+# enumerativeness_rate1 are known to within sample_target_width (at 95%
+# confidence), and write the estimates, cleaned as aggregate.py does, to
+# sample_output_file (see sampling.py); sampled lines aren't written out
+sample_mode = False
+sample_target_width = 0.02
+sample_included_meters = ['Hexameters', 'Elegiac couplets']
+sample_output_file = os.path.join(output_directory, '_sample_estimates.csv')
+
+
+# Worker processes re-import this file when they start, so only the main
+# process should write the log and hand out work:
+if __name__ == '__main__':
+    run_metrics.reset()
+    section_profiler.enable(profile_top_sections)
+
+    # Only process files that have not already been processed:
+    # (a file whose manifest shows it was interrupted is resumed, unless, with
+    # the artifact store, it was started with another key)
+    # (outputs parsed in fast mode depend on the morphology memo's counts,
+    # which the store's keys don't cover, so they aren't stored or reused)
+    if morphology_fast_mode and artifact_store_directory is not None:
+        logger.info('Not using the artifact store in morphology fast mode.')
+    # (the corpus index, which only reads new or changed files, also gives each
+    # file's hash for the artifact store)
+    data_files = glob(os.path.join(data_directory, '*.json'))
+    index = corpus_index.build_index(data_files, corpus_index_file)
+    if artifact_store_directory is not None and not sample_mode and not morphology_fast_mode:
+        # ... or whose output can be linked from the artifact store:
+        store = artifact_store.ArtifactStore(artifact_store_directory)
+        files_to_process, artifact_keys = artifact_store.reuse_outputs(
+            store, data_files, output_directory,
+            artifact_store.output_parameters(
+                allowed_meters, excluded_parts_of_speech, output_format,
+                pipeline_profile=cltk_pipeline_profile,
+                analyze_batch_size=analyze_batch_size,
+                transliterate_greek=transliterate_greek,
+                sentence_timeout_seconds=sentence_timeout_seconds),
+            output_format, index)
+    else:
+        store = None
+        artifact_keys = {}
+        files_to_process = [f for f in data_files if not create_csvs.output_is_complete(
+            create_csvs.output_file_name(f, output_directory, output_format))]
+
+    # ... and that have at least one section in an allowed meter:
+    files_to_process = [f for f in files_to_process if corpus_index.allowed_sections(index[f], allowed_meters)]
+    logger.info('%d lines to parse in %d files.', corpus_index.total_lines(index, files_to_process, allowed_meters), len(files_to_process))
+
+    # write a log file to capture parameters for  this run
+    current_date_and_time = datetime.datetime.now()
+    current_date_and_time_string = str(current_date_and_time)
+    log_file = "_log_" +  current_date_and_time_string + ".txt"
+    log = open(os.path.join(output_directory, log_file), "a")
+
+    log.write(output_directory + "\n")
+    log.write("excluded parts of speech: " + ' '.join([str(elem) for elem in excluded_parts_of_speech]) + "\n")
+    log.write("transliterate Greek: " + str(transliterate_greek) + "\n")
+    log.write("allowed meters: " + (' '.join([str(elem) for elem in allowed_meters]) if allowed_meters is not None else "all") + "\n")
+    log.write("CLTK pipeline profile: " + cltk_pipeline_profile + ", analyze batch size: " + str(analyze_batch_size) + "\n")
+    log.write("sample mode: " + (str(sample_target_width) + " target width, meters: " + ', '.join(sample_included_meters) if sample_mode else "off") + "\n")
+    log.write("artifact store: " + (artifact_store_directory + ", code version " + artifact_store.code_version() if store is not None else "none") + "\n")
+    log.write("profiled sections: " + str(profile_top_sections) + "\n")
+    log.write("line index: " + str(line_index_file if not sample_mode else None) + "\n")
+    log.write("output format: " + output_format + "\n")
+    log.write("morphology memo: " + str(morphology_memo_file) + ", fast mode: " + str(morphology_fast_mode) + "\n")
+    log.write("sentence timeout: " + str(sentence_timeout_seconds) + " seconds, quarantine file: " + quarantine_file + "\n")
+    log.write("write lines: " + str(write_lines) + (", adaptive (memory budget " + str(batch_memory_budget_mb) + " MB)" if adaptive_write_lines else "") + "\n")
+    log.write("parse server: " + (parse_server_socket if parse_server_socket is not None and parse_server.server_is_running(parse_server_socket) else "none") + "\n")
+    log.write("Files: " + ' '.join([str(elem) for elem in files_to_process]) + "\n\n")
+
+    # copy over the current version of each py file used
+    cc = open("create_csvs.py", "r")
+    log.write("\n\n*****************\n create_csvs.py \n*****************\n")
+    for line in cc:
+        log.write(line)
+    cc.close()
+    tl = open("tokenize_latin.py", "r")
+    log.write("\n\n*****************\n tokenize_latin.py \n*****************\n")
+    for line in tl:
+        log.write(line)
+    tl.close()
+    sp = open("section_pool.py", "r")
+    log.write("\n\n*****************\n section_pool.py \n*****************\n")
+    for line in sp:
+        log.write(line)
+    sp.close()
+
+    log.close() # close the log file
+
+
+
+
+    if adaptive_write_lines:
+        write_lines = adaptive_batching.AdaptiveBatchSize(
+            initial=write_lines, memory_budget_mb=batch_memory_budget_mb)
+
+    if sample_mode:
+        sampling.sample_files(
+            data_files=files_to_process,
+            output_file=sample_output_file,
+            number_of_workers=number_of_workers,
+            included_meters=sample_included_meters,
+            pipeline_profile=cltk_pipeline_profile,
+            analyze_batch_size=analyze_batch_size,
+            parse_cache_file=parse_cache_file,
+            transliterate_greek=transliterate_greek,
+            parse_server_socket=parse_server_socket,
+            excluded_parts_of_speech=excluded_parts_of_speech,
+            target_width=sample_target_width
+        )
+    elif number_of_workers > 1:
+        section_pool.mqdq_files_to_csv(
+            data_files=files_to_process,
+            output_directory=output_directory,
+            number_of_workers=number_of_workers,
+            allowed_meters=allowed_meters,
+            excluded_parts_of_speech=excluded_parts_of_speech,
+            write_lines=write_lines,
+            max_memory_percent=max_memory_percent,
+            worker_memory_gb=worker_memory_gb,
+            parse_cache_file=parse_cache_file,
+            parse_cache_max_entries=parse_cache_max_entries,
+            pipeline_profile=cltk_pipeline_profile,
+            analyze_batch_size=analyze_batch_size,
+            output_format=output_format,
+            parse_server_socket=parse_server_socket,
+            index=index,
+            transliterate_greek=transliterate_greek,
+            quarantine_file=quarantine_file,
+            sentence_timeout_seconds=sentence_timeout_seconds,
+            morphology_memo_file=morphology_memo_file,
+            morphology_fast_mode=morphology_fast_mode,
+            profile_top_sections=profile_top_sections,
+            artifact_keys=artifact_keys
+        )
+    else:
+        tokenize_latin.use_pipeline_profile(
+            cltk_pipeline_profile, batch_size=analyze_batch_size)
+        tokenize_latin.use_parse_server(parse_server_socket)
+        tokenize_latin.use_greek_transliteration(transliterate_greek)
+        tokenize_latin.use_quarantine(
+            quarantine_file, timeout_seconds=sentence_timeout_seconds)
+        if morphology_memo_file is not None:
+            tokenize_latin.use_morphology_memo(
+                morphology_memo_file, fast=morphology_fast_mode)
+
+        if parse_cache_file is not None:
+            tokenize_latin.use_parse_cache(
+                parse_cache_file, max_entries=parse_cache_max_entries)
+
+        progress = corpus_index.Progress(
+            corpus_index.total_lines(index, files_to_process, allowed_meters))
+        for file in files_to_process:
+
+            if output_format == 'parquet':
+                parquet_output.mqdq_to_parquet(
+                    data_file=file,
+                    output_file=create_csvs.output_file_name(
+                        file, output_directory, output_format),
+                    excluded_parts_of_speech=excluded_parts_of_speech,
+                    allowed_meters=allowed_meters,
+                    artifact_key=artifact_keys.get(file)
+                )
+            else:
+                create_csvs.mqdq_to_csv(
+                    data_file=file,
+                    output_file=create_csvs.output_file_name(
+                        file, output_directory, output_format),
+                    excluded_parts_of_speech = excluded_parts_of_speech,
+                    write_lines=write_lines,
+                    allowed_meters=allowed_meters,
+                    overlapped=overlapped_io,
+                    artifact_key=artifact_keys.get(file)
+                )
+
+            progress.update(corpus_index.total_lines(index, [file], allowed_meters))
+
+        if tokenize_latin.parse_cache is not None:
+            logger.info('Parse cache: %s', tokenize_latin.parse_cache.stats())
+            tokenize_latin.use_parse_cache(None)
+        if tokenize_latin.morphology_memo is not None:
+            logger.info('Morphology memo: %s', tokenize_latin.morphology_memo.stats())
+            tokenize_latin.use_morphology_memo(None)
+
+    if section_profiler.active_profiler is not None:
+        section_profiler.active_profiler.write(profile_directory)
+        logger.info('Profiles of the %d slowest sections are in "%s".', len(section_profiler.active_profiler.profiles()), profile_directory)
+
+    # keep the outputs written by this run for later runs
+    if store is not None:
+        artifact_store.store_outputs(
+            store, {f: artifact_keys[f] for f in files_to_process},
+            output_directory, output_format)
+
+    # bring the line index up to date with the outputs
+    if line_index_file is not None and not sample_mode:
+        with run_metrics.stage('line_index'):
+            lines = line_index.LineIndex(line_index_file)
+            lines.update(line_index.output_files(output_directory))
+            lines.close()
+
+    # add timing and throughput for each stage of this run to the log, as JSON
+    metrics = run_metrics.summary()
+    logger.info('Time per stage: %s', ', '.join(
+        f'{name} {stage["seconds"]:.1f}s' for name, stage in metrics['stages'].items()))
+    if metrics['counters'].get('sentences_unparsed', 0) > 0:
+        logger.warning('%d sentences could not be parsed; see "%s".', metrics['counters']['sentences_unparsed'], quarantine_file)
+    if 'batch_size' in metrics['values']:
+        logger.info('Lines per written batch: %s', metrics['values']['batch_size'])
+    log = open(os.path.join(output_directory, log_file), "a")
+    log.write("\n\n*****************\n run metrics \n*****************\n")
+    log.write(json.dumps(metrics, indent=2) + "\n")
+    log.close()
 
 # '''
 # enhance_mqdq_downloaded_data(
@@ -0,0 +1,211 @@
+'''Recompute enumerativeness from already-parsed output, without CLTK.
+
+pipeline.py applies excluded_parts_of_speech while it parses, so trying a new
+set of exclusions used to mean parsing the whole corpus again into a new
+output directory. The "tags" column of the pipeline's CSV or Parquet output
+already holds everything tokenize_latin.enumerativeness reads (each token's
+part of speech and case), so here the tags are exploded into one row per
+token and per case, and top_case, tokens, and enumerativeness are computed
+with grouped Pandas operations for any number of exclusion sets at once.
+
+Usage:
+
+  python3 rescore.py CSVS_No_Exclusion CSVS_Rescored \\
+    --exclusion-set no_exclusion= \\
+    --exclusion-set no_pronouns=pronoun \\
+    --exclusion-set no_adj_adv=adjective,adverb
+'''
+
+import argparse
+from glob import glob
+import csv
+import logging
+import os
+import re
+
+import pandas as pd
+
+import compact_tags
+import parquet_output
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+# The "tags" column is written by Pandas as the repr() of a list of dicts,
+# with keys in the order string, lemma, pos, case:
+tag_pattern = re.compile(
+    r"'pos': '(?P<pos>[^']*)', 'case': (?P<case>None|\[[^\]]*\])")
+case_value_pattern = re.compile(r"'([^']*)'")
+
+
+def explode_tags(tags: pd.Series) -> pd.DataFrame:
+  '''Turn a column of per-line tags into one row per token.
+
+  Args:
+    tags: A Series of tags, one element per line, either as lists of dicts
+      (as produced by tokenize_latin.tokenize_latin) or as their string
+      representation (as read back from the pipeline's CSVs).
+
+  Output: A DataFrame with columns "line" (the index label of the line in
+    tags), "pos", and "case" (a list of case values, or None).
+  '''
+  if len(tags) > 0 and isinstance(tags.iloc[0], str):
+    tokens = tags.str.extractall(tag_pattern).reset_index(level=1, drop=True)
+    cases = tokens['case'].where(tokens['case'] != 'None')
+    cases = cases.str.findall(case_value_pattern)
+    return pd.DataFrame({
+        'line': tokens.index,
+        'pos': tokens['pos'].to_numpy(),
+        'case': cases.to_numpy()})
+
+  tokens = tags.explode().dropna()
+  return pd.DataFrame({
+      'line': tokens.index,
+      'pos': [tag.get('pos') for tag in tokens],
+      'case': [tag.get('case') for tag in tokens]})
+
+
+def score_tags(tags: pd.Series, exclusion_sets: dict) -> pd.DataFrame:
+  '''Compute top_case, tokens, and enumerativeness for every line in tags,
+  for each set of excluded parts of speech.
+
+  The results match those of tokenize_latin.enumerativeness: a token's cases
+  count towards top_case unless its part of speech is exactly one of the
+  excluded parts of speech, while a token counts towards tokens unless its
+  part of speech is one of compact_tags.uncounted_parts_of_speech
+  (punctuation, and the tokens of sentences that couldn't be parsed) or
+  contains one of the excluded parts of speech.
+
+  Args:
+    tags: A Series of tags, one element per line (see explode_tags).
+
+    exclusion_sets: A dict from a name to a list of excluded parts of
+      speech, e.g., {'no_exclusion': [], 'no_pronouns': ['pronoun']}.
+
+  Output: A DataFrame with the same index as tags, and columns
+    "<name>_top_case", "<name>_tokens", and "<name>_enumerativeness" for each
+    name in exclusion_sets.
+  '''
+  tokens = explode_tags(tags)
+  cases = tokens.dropna(subset=['case']).explode('case').dropna(
+      subset=['case'])
+  unique_pos = pd.Series(tokens['pos'].unique())
+
+  scores = {}
+  for name, excluded_parts_of_speech in exclusion_sets.items():
+    # Decide once per distinct part of speech, rather than once per token:
+    pos_is_excluded = dict(zip(
+        unique_pos, unique_pos.isin(excluded_parts_of_speech)))
+    pos_contains_excluded = dict(zip(unique_pos, [
+        any(excluded_pos in pos for excluded_pos in excluded_parts_of_speech)
+        for pos in unique_pos]))
+
+    counted_cases = cases[~cases['pos'].map(pos_is_excluded).astype(bool)]
+    top_case = counted_cases.groupby(['line', 'case']).size().groupby(
+        level=0).max().reindex(tags.index, fill_value=0).astype(int)
+
+    counted_tokens = tokens[
+        ~tokens['pos'].isin(compact_tags.uncounted_parts_of_speech) &
+        ~tokens['pos'].map(pos_contains_excluded).astype(bool)]
+    line_tokens = counted_tokens.groupby('line').size().reindex(
+        tags.index, fill_value=0).astype(int)
+
+    scores[f'{name}_top_case'] = top_case
+    scores[f'{name}_tokens'] = line_tokens
+    # Python's round(), rather than NumPy's, to match
+    # tokenize_latin.enumerativeness exactly:
+    scores[f'{name}_enumerativeness'] = pd.Series([
+        round(top / total, 3) if total > 0 else None
+        for top, total in zip(top_case, line_tokens)],
+        index=tags.index, dtype=object)
+
+  return pd.DataFrame(scores, index=tags.index)
+
+
+def rescore_file(input_file: str, output_file: str,
+                 exclusion_sets: dict) -> None:
+  '''Rescore one output file, written by create_csvs.mqdq_to_csv or
+  parquet_output.mqdq_to_parquet.
+
+  Args:
+    input_file: The CSV or Parquet file to read.
+
+    output_file: The file to write, in the same format as input_file. It has
+      all of the columns of input_file, followed by the columns from
+      score_tags().
+
+    exclusion_sets: See score_tags().
+
+  Output: None.
+  '''
+  logger.info('Rescoring "%s"...', input_file)
+  parquet = input_file.endswith('.parquet')
+  if parquet:
+    data = parquet_output.read_parquet(input_file)
+  else:
+    data = pd.read_csv(input_file, keep_default_na=False, na_values=[''])
+  if 'tags' not in data.columns:
+    logger.warning('"%s" has no "tags" column. Skipping it...', input_file)
+    return
+
+  scores = score_tags(data['tags'].fillna('[]'), exclusion_sets)
+
+  rescored = pd.concat([data, scores], axis=1)
+  if parquet:
+    for column in scores.columns:
+      if column.endswith('_enumerativeness'):
+        rescored[column] = rescored[column].astype(float)
+    rescored.to_parquet(output_file, index=False, compression='zstd')
+  else:
+    rescored.to_csv(
+        output_file, quoting=csv.QUOTE_NONNUMERIC, index=False)
+
+
+def rescore_csv_folder(input_directory: str, output_directory: str,
+                       exclusion_sets: dict) -> None:
+  '''Rescore every output file in input_directory into output_directory.
+
+  Args:
+    input_directory: A directory of CSV or Parquet files written by
+      pipeline.py.
+
+    output_directory: The directory to write rescored files to, under the
+      same file names.
+
+    exclusion_sets: See score_tags().
+
+  Output: None.
+  '''
+  os.makedirs(output_directory, exist_ok=True)
+
+  for input_file in sorted(
+      glob(os.path.join(input_directory, '*.csv')) +
+      glob(os.path.join(input_directory, '*.parquet'))):
+    rescore_file(
+        input_file,
+        os.path.join(output_directory, os.path.basename(input_file)),
+        exclusion_sets)
+
+
+def parse_exclusion_set(value: str) -> tuple:
+  '''Parse a "name=pos1,pos2" command-line argument.'''
+  name, _, parts_of_speech = value.partition('=')
+  return name, [pos for pos in parts_of_speech.split(',') if pos != '']
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Recompute enumerativeness from parsed pipeline output.')
+  parser.add_argument('input_directory')
+  parser.add_argument('output_directory')
+  parser.add_argument(
+      '--exclusion-set', action='append', type=parse_exclusion_set,
+      default=[], metavar='NAME=POS[,POS...]',
+      help='A named set of excluded parts of speech; may be repeated.')
+  args = parser.parse_args()
+
+  logger.setLevel(logging.INFO)
+  rescore_csv_folder(
+      args.input_directory,
+      args.output_directory,
+      dict(args.exclusion_set) if args.exclusion_set else {'no_exclusion': []})
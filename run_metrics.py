@@ -0,0 +1,316 @@
+'''Per-stage timing and throughput counters for pipeline runs.
+
+The run log written by pipeline.py records a run's parameters, but not where
+its time went. The stages of parsing a line (sentence tokenization,
+tokenize_latin.prepare_input_text, cltk_nlp.analyze, aligning tokens to
+lines, tokenize_latin.enumerativeness, building DataFrames, and writing
+output) are timed here, with a call count, total time, and latency histogram
+per stage. Lines and sentences per second are recorded for every section.
+pipeline.py writes summary() to the run log as JSON.
+
+Time spent in a stage that is nested in another (e.g., CLTK parsing a
+sentence while tokens are being aligned to lines) is only counted for the
+inner stage, so the stage totals add up to the time spent in all stages.
+
+Metrics are kept per process. section_pool's workers send theirs back with
+each finished section (see take() and merge()). Within a process, they may
+be recorded from several threads (see overlapped.py), in which case stages in
+different threads overlap, and their totals can add up to more than the
+run's wall time.
+'''
+
+import bisect
+import contextlib
+import functools
+import sys
+import threading
+import time
+
+import section_profiler
+
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
+# Upper bounds, in seconds, of the buckets of each stage's latency histogram;
+# the last bucket holds everything slower:
+histogram_bounds = [0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10, 100]
+
+_stages = {}
+_counters = {}
+_values = {}
+_sections = []
+_worker_peak_rss_mb = None
+_started = time.time()
+# The stages currently being timed in each thread, as the time spent so far
+# in stages nested in each:
+_local = threading.local()
+# Held while updating _stages, _counters, and _values:
+_lock = threading.Lock()
+
+
+def reset() -> None:
+  '''Clear all metrics, and start timing the run from now.'''
+  global _stages, _counters, _values, _sections, _worker_peak_rss_mb, \
+      _started
+
+  _stages = {}
+  _counters = {}
+  _values = {}
+  _sections = []
+  _worker_peak_rss_mb = None
+  _started = time.time()
+
+
+def _empty_stage() -> dict:
+  return {
+      'calls': 0,
+      'seconds': 0.0,
+      'histogram': [0] * (len(histogram_bounds) + 1),
+  }
+
+
+def record_stage(name: str, seconds: float, calls: int = 1) -> None:
+  '''Add seconds (over calls calls) to the total for stage name.'''
+  with _lock:
+    stage_metrics = _stages.get(name)
+    if stage_metrics is None:
+      stage_metrics = _stages[name] = _empty_stage()
+
+    stage_metrics['calls'] += calls
+    stage_metrics['seconds'] += seconds
+    stage_metrics['histogram'][
+        bisect.bisect_left(histogram_bounds, seconds / calls)] += calls
+
+
+@contextlib.contextmanager
+def stage(name: str):
+  '''Time a block of code as one call of stage name.'''
+  nested_seconds = getattr(_local, 'nested_seconds', None)
+  if nested_seconds is None:
+    nested_seconds = _local.nested_seconds = []
+
+  nested_seconds.append(0.0)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    record_stage(name, elapsed - nested_seconds.pop())
+    if nested_seconds:
+      nested_seconds[-1] += elapsed
+
+
+def timed(name: str):
+  '''A decorator that times every call of a function as stage name.'''
+  def decorator(function):
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+      with stage(name):
+        return function(*args, **kwargs)
+    return timed_function
+  return decorator
+
+
+def count(name: str, n: int = 1) -> None:
+  '''Add n to the counter name (e.g., "lines" or "sentences").'''
+  with _lock:
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def _empty_value() -> dict:
+  return {'count': 0, 'total': 0, 'min': None, 'max': None, 'counts': {}}
+
+
+def observe(name: str, value: int, n: int = 1) -> None:
+  '''Record that value (e.g., a batch size chosen by adaptive_batching) was
+  used n times.'''
+  with _lock:
+    value_metrics = _values.get(name)
+    if value_metrics is None:
+      value_metrics = _values[name] = _empty_value()
+
+    value_metrics['count'] += n
+    value_metrics['total'] += value * n
+    value_metrics['min'] = value if value_metrics['min'] is None else min(
+        value_metrics['min'], value)
+    value_metrics['max'] = value if value_metrics['max'] is None else max(
+        value_metrics['max'], value)
+    # (keyed by strings, so that JSON gives back the same keys)
+    value_metrics['counts'][str(value)] = value_metrics['counts'].get(
+        str(value), 0) + n
+
+
+@contextlib.contextmanager
+def section(data_file: str, work_index: int, section_index: int,
+            href: str = None, meter: str = None):
+  '''Record the time taken, and the lines and sentences parsed, by a block
+  of code that processes one section, and sample its call stacks if a
+  section_profiler is enabled (which is told the section's href and
+  meter).'''
+  profiler = section_profiler.active_profiler
+  sampling = profiler.start() if profiler is not None else None
+  lines_before = _counters.get('lines', 0)
+  sentences_before = _counters.get('sentences', 0)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    record = {
+        'data_file': data_file,
+        'work_index': work_index,
+        'section_index': section_index,
+        'lines': _counters.get('lines', 0) - lines_before,
+        'sentences': _counters.get('sentences', 0) - sentences_before,
+        'seconds': time.perf_counter() - start,
+    }
+    _sections.append(record)
+    if sampling is not None:
+      profiler.finish(sampling, dict(record, href=href, meter=meter))
+
+
+def peak_rss_mb() -> float:
+  '''The peak resident memory of this process so far, in MB, or None if it
+  can't be determined.'''
+  if resource is None:
+    return None
+
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS, and in KB elsewhere:
+  return round(peak / 1024 ** (2 if sys.platform == 'darwin' else 1), 1)
+
+
+def take() -> dict:
+  '''The metrics recorded in this process since the last take(), which are
+  then cleared. For merge() in another process.'''
+  global _stages, _counters, _values, _sections
+
+  metrics = {
+      'stages': _stages,
+      'counters': _counters,
+      'values': _values,
+      'sections': _sections,
+      'profiles': section_profiler.take(),
+      'peak_rss_mb': peak_rss_mb(),
+  }
+  _stages = {}
+  _counters = {}
+  _values = {}
+  _sections = []
+  return metrics
+
+
+def merge(metrics: dict) -> None:
+  '''Add metrics from take() in another process (e.g., a worker) to this
+  process's.'''
+  global _worker_peak_rss_mb
+
+  for name, stage_metrics in metrics['stages'].items():
+    if name not in _stages:
+      _stages[name] = _empty_stage()
+    _stages[name]['calls'] += stage_metrics['calls']
+    _stages[name]['seconds'] += stage_metrics['seconds']
+    _stages[name]['histogram'] = [
+        a + b for a, b in zip(
+            _stages[name]['histogram'], stage_metrics['histogram'])]
+
+  for name, n in metrics['counters'].items():
+    count(name, n)
+
+  for name, value_metrics in metrics.get('values', {}).items():
+    for value, n in value_metrics['counts'].items():
+      observe(name, int(value), n)
+
+  _sections.extend(metrics['sections'])
+  section_profiler.merge(metrics.get('profiles', []))
+
+  if metrics['peak_rss_mb'] is not None:
+    _worker_peak_rss_mb = max(
+        _worker_peak_rss_mb or 0, metrics['peak_rss_mb'])
+
+
+def _rate(n: int, seconds: float) -> float:
+  return round(n / seconds, 2) if seconds > 0 else None
+
+
+def summary() -> dict:
+  '''All metrics recorded (and merged) so far, as a JSON-serializable dict:
+
+    - "wall_seconds": The time since the run started (see reset()).
+    - "stages": For each stage, its number of calls, total seconds, share of
+      the total time of all stages, mean milliseconds per call, and a
+      histogram of call latencies, keyed by each bucket's upper bound in
+      seconds.
+    - "counters": e.g., the number of lines and sentences parsed.
+    - "values": For each name given to observe() (e.g., "batch_size"), the
+      number of observations, their minimum, maximum, and mean, and how
+      many times each value was observed.
+    - "files": For each input file, the lines, sentences, and seconds of
+      its sections, with lines and sentences per second. With several
+      workers, the seconds of sections parsed at the same time add up.
+    - "sections": The same, for each section.
+    - "peak_rss_mb": The peak resident memory of this process, and of the
+      largest worker process, if any.
+  '''
+  total_stage_seconds = sum(s['seconds'] for s in _stages.values())
+  bucket_names = [f'<={bound:g}s' for bound in histogram_bounds] + [
+      f'>{histogram_bounds[-1]:g}s']
+
+  stages = {}
+  for name, stage_metrics in sorted(
+      _stages.items(), key=lambda item: -item[1]['seconds']):
+    stages[name] = {
+        'calls': stage_metrics['calls'],
+        'seconds': round(stage_metrics['seconds'], 6),
+        'share': round(stage_metrics['seconds'] / total_stage_seconds, 4)
+        if total_stage_seconds > 0 else None,
+        'mean_ms': round(
+            1000 * stage_metrics['seconds'] / stage_metrics['calls'], 4),
+        'histogram': {
+            bucket: n for bucket, n in zip(
+                bucket_names, stage_metrics['histogram']) if n > 0},
+    }
+
+  files = {}
+  sections = []
+  for s in _sections:
+    file_metrics = files.setdefault(
+        s['data_file'], {'lines': 0, 'sentences': 0, 'seconds': 0.0})
+    for key in ('lines', 'sentences', 'seconds'):
+      file_metrics[key] += s[key]
+    sections.append(dict(
+        s,
+        seconds=round(s['seconds'], 6),
+        lines_per_second=_rate(s['lines'], s['seconds']),
+        sentences_per_second=_rate(s['sentences'], s['seconds'])))
+
+  for file_metrics in files.values():
+    file_metrics['lines_per_second'] = _rate(
+        file_metrics['lines'], file_metrics['seconds'])
+    file_metrics['sentences_per_second'] = _rate(
+        file_metrics['sentences'], file_metrics['seconds'])
+    file_metrics['seconds'] = round(file_metrics['seconds'], 6)
+
+  return {
+      'wall_seconds': round(time.time() - _started, 3),
+      'stages': stages,
+      'counters': dict(_counters),
+      'values': {
+          name: {
+              'count': value_metrics['count'],
+              'min': value_metrics['min'],
+              'max': value_metrics['max'],
+              'mean': round(
+                  value_metrics['total'] / value_metrics['count'], 2),
+              'counts': dict(sorted(
+                  value_metrics['counts'].items(),
+                  key=lambda item: float(item[0]))),
+          } for name, value_metrics in _values.items()},
+      'files': files,
+      'sections': sections,
+      'peak_rss_mb': {
+          'main': peak_rss_mb(),
+          'largest_worker': _worker_peak_rss_mb,
+      },
+  }
@@ -0,0 +1,502 @@
+'''Estimate each file's enumerativeness rates from a sample of its text.
+
+aggregate.py (like analysis/01_cleaning.r) computes each file's
+enumerativeness_rate8 and enumerativeness_rate1 from pipeline output, so
+every line of every file must be parsed first. To check a question quickly
+(e.g., whether a trend holds for one meter), this parses a stratified random
+sample instead, and gives each rate with a confidence interval.
+
+Each section is split into blocks: runs of whole lines that start and end at
+sentence boundaries (so a block is parsed just as it would be within its
+section). Each file is sampled and estimated on its own, with its blocks
+stratified by meter (after analysis/meter_cleaning.csv's corrections; only
+included_meters are kept), and drawn at random, without replacement, a round
+at a time from every stratum. Sections aren't strata of their own: most are
+only a few blocks long, so drawing from every section each round would parse
+most of a file before the first estimate, and a section's variance can't be
+estimated from the one or two blocks drawn from it. Blocks are instead drawn
+from across all of a meter's sections.
+
+After each round, the file's rates are estimated, as the ratio of lines
+above the threshold to lines with more than tokens_threshold tokens, each
+total estimated per stratum from its sampled lines. Each rate's interval is
+the wider of a percentile bootstrap interval (over blocks, within strata)
+and a Wilson score interval (over the sampled lines kept): the bootstrap
+alone gives a zero-width interval while no sampled line is above the
+threshold, however few lines have been sampled. Sampling stops once both
+intervals are narrower than target_width, or every block has been parsed (in
+which case the rates are exact).
+
+Usage, from the root of this repository:
+
+  python3 sampling.py OUTPUT_FILE FILE.json [FILE.json ...] \\
+    [--target-width 0.02] [--included-meter Hexameters ...]
+
+or set sample_mode in pipeline.py. The output has one row per file, with
+aggregate.py's columns (n being the estimated number of lines kept), a
+"_low" and "_high" column for each rate, and the numbers of lines in and
+sampled from the file, and a last row, for file "(all)", that pools every
+file's sample.
+'''
+
+import argparse
+import csv
+import functools
+import logging
+import multiprocessing
+import math
+import os
+import random
+import statistics
+import zlib
+
+import create_csvs
+import run_metrics
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+sample_columns = [
+    'file', 'author_name', 'author_date', 'meters', 'n',
+    'enumerativeness_rate8', 'enumerativeness_rate8_low',
+    'enumerativeness_rate8_high', 'enumerativeness_rate1',
+    'enumerativeness_rate1_low', 'enumerativeness_rate1_high',
+    'total_lines', 'sampled_lines']
+
+# The totals kept for each sampled block, in order:
+_lines, _kept, _high, _one = range(4)
+
+
+def sentence_blocks(lines: list, tokenize) -> list:
+  '''Split a section's lines into blocks that start and end at sentence
+  boundaries.
+
+  Args:
+    lines: The section's lines.
+
+    tokenize: A function from a string to a list of sentences, each a
+      substring of it, in order (e.g., tokenize_latin.timed_sentence_tokenize).
+
+  Output: A list of (first line, last line + 1) pairs, covering lines in
+    order.
+  '''
+  text = ' '.join(lines)
+  line_ends = []
+  position = 0
+  for line in lines:
+    position += len(line)
+    line_ends.append(position)
+    position += 1
+
+  sentence_ends = set()
+  position = 0
+  for sentence in tokenize(text):
+    start = text.find(sentence, position)
+    if start < 0:
+      # The tokenizer changed the text, so the sentence ends aren't known,
+      # and the section is one block:
+      return [(0, len(lines))]
+    position = start + len(sentence)
+    sentence_ends.add(position)
+
+  blocks = []
+  start = 0
+  for i, end in enumerate(line_ends):
+    if end in sentence_ends or i == len(lines) - 1:
+      blocks.append((start, i + 1))
+      start = i + 1
+  return blocks
+
+
+def file_strata(data_file: str, meter_corrections: dict,
+                included_meters: tuple) -> tuple:
+  '''The blocks of a file's sections in included_meters, by meter.
+
+  Output: A (strata, author) pair, where strata is a dict from meter to a
+    list of (section, first line, last line + 1) blocks, and author is the
+    file's "author_*" values.
+  '''
+  import tokenize_latin
+
+  strata = {}
+  author = {}
+  for author, _, work, _, section in create_csvs.iter_filtered_sections(
+      data_file):
+    # (keyed on trimmed values, as aggregate.py reads them)
+    key = tuple(
+        value.strip() if isinstance(value, str) else value
+        for value in (author.get('author_name'), work.get('name'),
+                      section.get('meter')))
+    meter = meter_corrections.get(key, key[2])
+    if meter not in included_meters or not section.get('lines'):
+      continue
+    strata.setdefault(meter, []).extend(
+        (section, start, end) for start, end in sentence_blocks(
+            section['lines'], tokenize_latin.timed_sentence_tokenize))
+  return strata, author
+
+
+def score_block(section: dict, start: int, end: int,
+                excluded_parts_of_speech: list,
+                tokens_threshold: int) -> list:
+  '''Parse a block of a section, and count its lines: all of them, those
+  with more than tokens_threshold tokens, and of those, the lines with
+  enumerativeness above .8 and equal to 1.'''
+  block = dict(section, lines=section['lines'][start:end])
+  totals = [0, 0, 0, 0]
+  for line in create_csvs.section_to_enumerativeness_lines(
+      block, excluded_parts_of_speech=excluded_parts_of_speech):
+    totals[_lines] += 1
+    if line['tokens'] > tokens_threshold:
+      totals[_kept] += 1
+      totals[_high] += line['enumerativeness'] > .8
+      totals[_one] += line['enumerativeness'] == 1
+  return totals
+
+
+def wilson_interval(rate: float, n: float, confidence: float = .95) -> tuple:
+  '''The Wilson score interval for a proportion rate observed in n trials, as
+  a (low, high) pair.'''
+  z = statistics.NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+  denominator = 1 + z * z / n
+  centre = (rate + z * z / (2 * n)) / denominator
+  half_width = z * math.sqrt(
+      rate * (1 - rate) / n + z * z / (4 * n * n)) / denominator
+  return max(0., centre - half_width), min(1., centre + half_width)
+
+
+def estimate_rates(strata: list, bootstrap_samples: int = 1000,
+                   confidence: float = .95, rng=None) -> dict:
+  '''Estimate the rates from sampled blocks, with intervals: the wider of
+  the bootstrap and Wilson intervals described above, or the estimates
+  themselves, if every stratum is complete.
+
+  Args:
+    strata: A list of (total lines, block totals, complete) tuples, one per
+      stratum, where block totals is an array with a row of totals (as from
+      score_block()) per sampled block, and complete is whether every block
+      of the stratum was sampled (so it isn't resampled).
+
+    bootstrap_samples: The number of bootstrap resamples. Defaults to 1000.
+
+    confidence: The confidence level of the intervals. Defaults to .95.
+
+    rng: A numpy.random.Generator. Defaults to a new one, seeded with 0.
+
+  Output: A dict with the estimated "n", and for "rate8" and "rate1", the
+    estimate and its "_low" and "_high" bounds (all None if no sampled line
+    was kept).
+  '''
+  import numpy as np
+
+  rng = rng if rng is not None else np.random.default_rng(0)
+
+  def rates(totals: np.ndarray) -> np.ndarray:
+    # totals: (samples, strata, 4) sums; each stratum's sample is scaled up
+    # to its total lines
+    lines = np.array([total_lines for total_lines, _, _ in strata])
+    with np.errstate(divide='ignore', invalid='ignore'):
+      scaled = totals * (lines[:, None] / totals[..., _lines:_lines + 1])
+    scaled = np.nan_to_num(scaled).sum(axis=-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return np.stack([
+          scaled[..., _kept], scaled[..., _high] / scaled[..., _kept],
+          scaled[..., _one] / scaled[..., _kept]], axis=-1)
+
+  point = rates(np.array([blocks.sum(axis=0) for _, blocks, _ in strata]))
+
+  resampled = []
+  for _, blocks, complete in strata:
+    if complete:
+      resampled.append(np.broadcast_to(
+          blocks.sum(axis=0), (bootstrap_samples, blocks.shape[1])))
+    else:
+      picks = rng.integers(
+          0, len(blocks), size=(bootstrap_samples, len(blocks)))
+      resampled.append(blocks[picks].sum(axis=1))
+  bootstrap = rates(np.stack(resampled, axis=1))
+
+  tail = (1 - confidence) / 2 * 100
+  sampled_kept = sum(blocks[:, _kept].sum() for _, blocks, _ in strata)
+  estimate = {'n': float(point[0])}
+  for column, name in ((1, 'rate8'), (2, 'rate1')):
+    if not point[0] > 0:
+      estimate.update({name: None, f'{name}_low': None, f'{name}_high': None})
+      continue
+    values = bootstrap[:, column]
+    values = values[~np.isnan(values)]
+    low, high = np.percentile(values, [tail, 100 - tail])
+    if sampled_kept > 0 and not all(complete for _, _, complete in strata):
+      wilson_low, wilson_high = wilson_interval(
+          point[column], sampled_kept, confidence)
+      low, high = min(low, wilson_low), max(high, wilson_high)
+    estimate.update({
+        name: float(point[column]), f'{name}_low': float(low),
+        f'{name}_high': float(high)})
+  return estimate
+
+
+def sample_file(
+    data_file: str,
+    meter_corrections: dict,
+    included_meters: tuple = ('Hexameters', 'Elegiac couplets'),
+    excluded_parts_of_speech: list = [],
+    tokens_threshold: int = 3,
+    target_width: float = .02,
+    confidence: float = .95,
+    round_blocks: int = 20,
+    bootstrap_samples: int = 1000,
+    seed: int = 0) -> tuple:
+  '''Estimate one file's rates from a sample, as described above.
+
+  Args:
+    data_file: An MQDQ author file.
+
+    meter_corrections: A dict from (author_name, work_name, meter) to the
+      corrected meter (see read_meter_corrections()).
+
+    included_meters: The meters (after correction) to sample.
+
+    excluded_parts_of_speech: Passed to tokenize_latin.enumerativeness.
+
+    tokens_threshold: Only lines with more than this many tokens are
+      counted, as in aggregate.summarize_file().
+
+    target_width: Stop once both rates' intervals are narrower than this.
+
+    confidence: The confidence level of the intervals.
+
+    round_blocks: The number of blocks to add from each stratum per round.
+
+    bootstrap_samples: The number of bootstrap resamples.
+
+    seed: Seeds the sample (with the file name), so that it is repeatable.
+
+  Output: A (row, strata) pair, where row is a dict with the keys in
+    sample_columns (or None, if the file has no lines in included_meters),
+    and strata are the arguments to estimate_rates() it was estimated from.
+  '''
+  import numpy as np
+
+  strata, author = file_strata(data_file, meter_corrections, included_meters)
+  if len(strata) == 0:
+    return None, []
+
+  file_seed = seed ^ zlib.crc32(os.path.basename(data_file).encode('utf-8'))
+  sample_rng = random.Random(file_seed)
+  bootstrap_rng = np.random.default_rng(file_seed)
+  meters = sorted(strata)
+  for meter in meters:
+    sample_rng.shuffle(strata[meter])
+  total_lines = {
+      meter: sum(end - start for _, start, end in strata[meter])
+      for meter in meters}
+  sampled = {meter: [] for meter in meters}
+
+  while True:
+    for meter in meters:
+      for section, start, end in strata[meter][
+          len(sampled[meter]):len(sampled[meter]) + round_blocks]:
+        sampled[meter].append(score_block(
+            section, start, end, excluded_parts_of_speech, tokens_threshold))
+
+    estimate_strata = [
+        (total_lines[meter], np.array(sampled[meter], dtype=float),
+         len(sampled[meter]) == len(strata[meter])) for meter in meters]
+    estimate = estimate_rates(
+        estimate_strata, bootstrap_samples, confidence, bootstrap_rng)
+    if all(complete for _, _, complete in estimate_strata):
+      break
+    if estimate['rate8'] is not None and \
+        estimate['rate8_high'] - estimate['rate8_low'] < target_width and \
+        estimate['rate1_high'] - estimate['rate1_low'] < target_width:
+      break
+
+  sampled_lines = int(sum(
+      blocks[:, _lines].sum() for _, blocks, _ in estimate_strata))
+  logger.info(
+      'Sampled %d of %d lines of "%s": rate8 %s [%s, %s].', sampled_lines,
+      sum(total_lines.values()), data_file, estimate['rate8'],
+      estimate['rate8_low'], estimate['rate8_high'])
+  return _row(
+      os.path.basename(data_file), author.get('author_name'),
+      author.get('author_date'), meters, estimate,
+      sum(total_lines.values()), sampled_lines), estimate_strata
+
+
+def _row(file: str, author_name: str, author_date: str, meters: list,
+         estimate: dict, total_lines: int, sampled_lines: int) -> dict:
+  return {
+      'file': file,
+      'author_name': author_name,
+      'author_date': author_date,
+      'meters': '; '.join(meters),
+      'n': round(estimate['n']),
+      'enumerativeness_rate8': estimate['rate8'],
+      'enumerativeness_rate8_low': estimate['rate8_low'],
+      'enumerativeness_rate8_high': estimate['rate8_high'],
+      'enumerativeness_rate1': estimate['rate1'],
+      'enumerativeness_rate1_low': estimate['rate1_low'],
+      'enumerativeness_rate1_high': estimate['rate1_high'],
+      'total_lines': total_lines,
+      'sampled_lines': sampled_lines,
+  }
+
+
+def read_meter_corrections(meter_cleaning_file: str = None) -> dict:
+  '''analysis/meter_cleaning.csv (or meter_cleaning_file), as a dict from
+  (author_name, work_name, section_meter) to the corrected meter.'''
+  # aggregate (and so pandas) is imported here, rather than with this module,
+  # so that starting pipeline.py doesn't wait for it:
+  import aggregate
+
+  if meter_cleaning_file is None:
+    meter_cleaning_file = os.path.join(
+        aggregate.analysis_directory, 'meter_cleaning.csv')
+  corrections = aggregate.read_cleaning_csv(meter_cleaning_file)
+  corrections = corrections[corrections['Corrected_meter'].notna()]
+  return {
+      (author_name, work_name, meter): corrected
+      for author_name, work_name, meter, corrected in corrections[[
+          'author_name', 'work_name', 'section_meter',
+          'Corrected_meter']].itertuples(index=False)}
+
+
+def _init_worker(pipeline_profile: str, analyze_batch_size: int,
+                 parse_cache_file: str, transliterate_greek: bool,
+                 parse_server_socket: str) -> None:
+  '''Set up a worker process, as section_pool._init_worker does.'''
+  import tokenize_latin
+
+  tokenize_latin.use_pipeline_profile(
+      pipeline_profile, batch_size=analyze_batch_size)
+  tokenize_latin.use_parse_server(parse_server_socket)
+  tokenize_latin.use_greek_transliteration(transliterate_greek)
+  if parse_cache_file is not None:
+    tokenize_latin.use_parse_cache(parse_cache_file)
+
+
+def _sample_in_worker(data_file: str, **options) -> tuple:
+  '''Run sample_file() in a worker process, returning its metrics too.'''
+  row, strata = sample_file(data_file, **options)
+  return row, strata, run_metrics.take()
+
+
+def sample_files(
+    data_files: list,
+    output_file: str,
+    number_of_workers: int = 1,
+    included_meters: tuple = ('Hexameters', 'Elegiac couplets'),
+    lines_threshold: int = 500,
+    meter_cleaning_file: str = None,
+    pipeline_profile: str = 'minimal',
+    analyze_batch_size: int = 1,
+    parse_cache_file: str = None,
+    transliterate_greek: bool = False,
+    parse_server_socket: str = None,
+    **options) -> 'pd.DataFrame':
+  '''Estimate the rates of each of data_files from a sample, and pooled over
+  all of them, into output_file.
+
+  Args:
+    data_files: MQDQ author files.
+
+    output_file: The CSV to write.
+
+    number_of_workers: The number of processes to sample files with.
+      Defaults to 1.
+
+    included_meters: See sample_file().
+
+    lines_threshold: Files with no more than this many lines kept (as
+      estimated) are left out, as in aggregate.summarize_file().
+
+    meter_cleaning_file: The meter corrections. Defaults to None, for
+      analysis/meter_cleaning.csv.
+
+    pipeline_profile, analyze_batch_size, parse_cache_file,
+    transliterate_greek, parse_server_socket: The tokenize_latin settings to
+      parse with, as in section_pool.mqdq_files_to_csv().
+
+    options: Passed to sample_file() (e.g., target_width).
+
+  Output: The estimates, as a DataFrame, which is also written to
+    output_file.
+  '''
+  sample = functools.partial(
+      _sample_in_worker,
+      meter_corrections=read_meter_corrections(meter_cleaning_file),
+      included_meters=tuple(included_meters), **options)
+
+  logger.info('Sampling %d files...', len(data_files))
+  with multiprocessing.Pool(
+      number_of_workers,
+      initializer=_init_worker,
+      initargs=(pipeline_profile, analyze_batch_size, parse_cache_file,
+                transliterate_greek, parse_server_socket)) as pool:
+    results = pool.map(sample, data_files, chunksize=1)
+
+  rows = []
+  pooled_strata = []
+  for row, strata, metrics in results:
+    run_metrics.merge(metrics)
+    if row is not None and row['n'] > lines_threshold:
+      rows.append(row)
+      pooled_strata += strata
+
+  if len(pooled_strata) > 0:
+    estimate = estimate_rates(
+        pooled_strata, options.get('bootstrap_samples', 1000),
+        options.get('confidence', .95))
+    rows.append(_row(
+        '(all)', None, None, sorted(set(
+            meter for row in rows for meter in row['meters'].split('; '))),
+        estimate, sum(row['total_lines'] for row in rows),
+        sum(row['sampled_lines'] for row in rows)))
+    logger.info(
+        'All files: rate8 %.4f [%.4f, %.4f], rate1 %.4f [%.4f, %.4f].',
+        estimate['rate8'], estimate['rate8_low'], estimate['rate8_high'],
+        estimate['rate1'], estimate['rate1_low'], estimate['rate1_high'])
+
+  import pandas as pd
+
+  estimates = pd.DataFrame(rows, columns=sample_columns)
+  output_directory = os.path.dirname(output_file)
+  if output_directory != '':
+    os.makedirs(output_directory, exist_ok=True)
+  estimates.to_csv(output_file, quoting=csv.QUOTE_NONNUMERIC, index=False)
+  return estimates
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('output_file')
+  parser.add_argument('data_files', nargs='+')
+  parser.add_argument('--target-width', type=float, default=.02)
+  parser.add_argument('--confidence', type=float, default=.95)
+  parser.add_argument('--tokens-threshold', type=int, default=3)
+  parser.add_argument('--lines-threshold', type=int, default=500)
+  parser.add_argument(
+      '--included-meter', action='append', dest='included_meters',
+      help='A meter to include (may be repeated). Defaults to Hexameters '
+      'and Elegiac couplets.')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int, default=1)
+  parser.add_argument(
+      '--profile', default='minimal', choices=['default', 'minimal'])
+  parser.add_argument('--parse-cache', default=None)
+  args = parser.parse_args()
+
+  logger.setLevel(logging.INFO)
+  sample_files(
+      args.data_files, args.output_file,
+      number_of_workers=args.workers,
+      included_meters=args.included_meters or (
+          'Hexameters', 'Elegiac couplets'),
+      lines_threshold=args.lines_threshold,
+      pipeline_profile=args.profile,
+      parse_cache_file=args.parse_cache,
+      tokens_threshold=args.tokens_threshold,
+      target_width=args.target_width,
+      confidence=args.confidence,
+      seed=args.seed)
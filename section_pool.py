@@ -0,0 +1,477 @@
+'''Process MQDQ author files in parallel, one section at a time.
+
+create_csvs.mqdq_to_csv works through a whole author file in a single process,
+so a large author (e.g., Ovid or Statius) keeps one core busy long after the
+other files are finished. Here, each (file, work, section) is a separate task
+handed to a pool of worker processes. Each worker loads the CLTK model once,
+for its first section, and keeps it for every section it parses. Sections are
+written to temporary part files, which are concatenated in their original
+order into one CSV per input file once every section of that file is done, so
+the output is the same as that of create_csvs.mqdq_to_csv.
+'''
+
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+
+import corpus_index
+import create_csvs
+import mqdq_stream
+import parquet_output
+import run_metrics
+import section_profiler
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+# Per-worker state, set by _init_worker():
+_worker_settings = {}
+_worker_author = {'data_file': None, 'author': None}
+
+
+def section_tasks(data_file: str, allowed_meters: list = None) -> list:
+  '''List the sections of an MQDQ author file that need to be parsed. The
+  file is read one section at a time (see mqdq_stream.iter_sections()).
+
+  Args:
+    data_file: The filename of a JSON file, as for create_csvs.mqdq_to_csv.
+
+    allowed_meters: "Meters" values from MQDQ to allow. Defaults to None,
+      which allows everything.
+
+  Output: A list of dicts, one per section, in the order in which the
+    sections appear in data_file, each with keys "data_file", "work_index",
+    "section_index", "byte_offset" (where the section starts in data_file),
+    "work" (the work's values other than its sections), "href", "meter", and
+    "lines" (the number of lines in the section).
+  '''
+  tasks = []
+  for _, work_index, work, section_index, section, byte_offset in \
+      mqdq_stream.iter_sections(data_file):
+    if allowed_meters is not None and \
+        section.get('meter') not in allowed_meters:
+      continue
+    tasks.append({
+        'data_file': data_file,
+        'work_index': work_index,
+        'section_index': section_index,
+        'byte_offset': byte_offset,
+        'work': work,
+        'href': section.get('href'),
+        'meter': section.get('meter'),
+        'lines': len(section.get('lines', [])),
+    })
+
+  return tasks
+
+
+def part_file_name(output_file: str, work_index: int,
+                   section_index: int) -> str:
+  '''The temporary file that a single section's output is written to, in the
+  same format as output_file.'''
+  return os.path.join(
+      f'{output_file}.parts',
+      f'{work_index:05d}_{section_index:05d}{os.path.splitext(output_file)[1]}')
+
+
+def _is_parquet(output_file: str) -> bool:
+  return output_file.endswith('.parquet')
+
+
+def _init_worker(excluded_parts_of_speech: list, write_lines: int,
+                 parse_cache_file: str = None,
+                 parse_cache_max_entries: int = 2000000,
+                 pipeline_profile: str = 'default',
+                 analyze_batch_size: int = 1,
+                 parse_server_socket: str = None,
+                 transliterate_greek: bool = False,
+                 quarantine_file: str = None,
+                 sentence_timeout_seconds: float = None,
+                 morphology_memo_file: str = None,
+                 morphology_fast_mode: bool = False,
+                 profile_top_sections: int = 0) -> None:
+  '''Set up a worker process. The CLTK model is loaded once, when the
+  worker parses its first sentence, and kept for every section after that.'''
+  import tokenize_latin
+
+  tokenize_latin.use_pipeline_profile(
+      pipeline_profile, batch_size=analyze_batch_size)
+  tokenize_latin.use_parse_server(parse_server_socket)
+  tokenize_latin.use_greek_transliteration(transliterate_greek)
+  tokenize_latin.use_quarantine(
+      quarantine_file, timeout_seconds=sentence_timeout_seconds)
+  if morphology_memo_file is not None:
+    tokenize_latin.use_morphology_memo(
+        morphology_memo_file, fast=morphology_fast_mode)
+
+  if parse_cache_file is not None:
+    tokenize_latin.use_parse_cache(
+        parse_cache_file, max_entries=parse_cache_max_entries)
+
+  # Each worker sends its slowest sections' profiles back with its metrics:
+  section_profiler.enable(profile_top_sections)
+
+  _worker_settings['excluded_parts_of_speech'] = excluded_parts_of_speech
+  _worker_settings['write_lines'] = write_lines
+
+
+def _load_author(data_file: str) -> dict:
+  '''Read the "author_*" values of data_file, keeping those of the most
+  recently read file, since a worker will often receive several sections of
+  the same file in a row.'''
+  if _worker_author['data_file'] != data_file:
+    _worker_author['author'] = mqdq_stream.read_author(data_file)
+    _worker_author['data_file'] = data_file
+
+  return _worker_author['author']
+
+
+def _process_section(task: dict, output_file: str) -> tuple:
+  '''Parse one section and write it to its part file. Only this section is
+  read from the task's data file.
+
+  Output: A (task, output_file, metrics) tuple, so the parent process knows
+    which section finished, where metrics are this worker's run_metrics since
+    its last section.
+  '''
+  import tokenize_latin
+
+  part_file = part_file_name(
+      output_file, task['work_index'], task['section_index'])
+
+  with run_metrics.section(
+      task['data_file'], task['work_index'], task['section_index'],
+      href=task.get('href'), meter=task.get('meter')):
+    _write_part_file(task, output_file, part_file)
+
+  if tokenize_latin.parse_cache is not None:
+    logger.info('Parse cache: %s', tokenize_latin.parse_cache.stats())
+
+  return task, output_file, run_metrics.take()
+
+
+def _write_part_file(task: dict, output_file: str, part_file: str) -> None:
+  '''Parse one section into part_file, in the format of output_file.'''
+  if _is_parquet(output_file):
+    # ParquetLineWriter only gives the part file its name once it's complete:
+    parquet_output.write_section_parquet(
+        task, part_file, excluded_parts_of_speech=_worker_settings[
+            'excluded_parts_of_speech'])
+    return
+
+  temporary_part_file = f'{part_file}.tmp'
+  if os.path.exists(temporary_part_file):
+    os.remove(temporary_part_file)
+
+  author = _load_author(task['data_file'])
+  section = mqdq_stream.read_section(
+      task['data_file'], task['byte_offset'])
+
+  create_csvs.write_batches_to_csv(
+      create_csvs.section_to_enumerativeness_dataframe(
+          author,
+          task['work'],
+          section,
+          excluded_parts_of_speech=_worker_settings[
+              'excluded_parts_of_speech'],
+          batch_size=_worker_settings['write_lines']),
+      temporary_part_file)
+
+  # Only a complete part file gets its final name:
+  if not os.path.exists(temporary_part_file):
+    open(temporary_part_file, 'w').close()
+  os.replace(temporary_part_file, part_file)
+
+
+def merge_part_files(output_file: str, tasks: list,
+                     checkpoint: dict) -> None:
+  '''Append the part files for tasks, in order, to output_file, recording
+  each section in output_file's manifest (see create_csvs.read_checkpoint())
+  as it is appended, then remove the part files.
+
+  Args:
+    output_file: The CSV file to write. Sections already in it (per
+      checkpoint) are kept.
+
+    tasks: The tasks (from section_tasks()) for this file, in their original
+      order.
+
+    checkpoint: The manifest for output_file, from
+      create_csvs.resume_checkpoint(). Parquet output lists no sections in
+      its manifest, and is written in one go once every part file is done.
+  '''
+  if _is_parquet(output_file):
+    with run_metrics.stage('merging'):
+      parquet_output.merge_parquet_files(
+          [part_file_name(output_file, task['work_index'],
+                          task['section_index']) for task in tasks],
+          output_file)
+    checkpoint['complete'] = True
+    create_csvs.write_checkpoint(output_file, checkpoint)
+    shutil.rmtree(f'{output_file}.parts', ignore_errors=True)
+    return
+
+  finished_sections = set(
+      (s['work_index'], s['section_index']) for s in checkpoint['sections'])
+  header_written = os.path.exists(output_file) and \
+      os.path.getsize(output_file) > 0
+
+  for task in tasks:
+    work_index, section_index = task['work_index'], task['section_index']
+    if (work_index, section_index) in finished_sections:
+      continue
+
+    with run_metrics.stage('merging'), open(
+        part_file_name(output_file, work_index, section_index)) as part:
+      header = part.readline()
+      if header != '':
+        with open(output_file, 'a') as output:
+          if not header_written:
+            output.write(header)
+            header_written = True
+          shutil.copyfileobj(part, output)
+
+    checkpoint['sections'].append({
+        'work_index': work_index,
+        'section_index': section_index,
+        'href': task['href'],
+        'lines': task['lines'],
+        'csv_bytes': os.path.getsize(output_file) if os.path.exists(
+            output_file) else 0,
+    })
+    create_csvs.write_checkpoint(output_file, checkpoint)
+
+  checkpoint['complete'] = True
+  create_csvs.write_checkpoint(output_file, checkpoint)
+  shutil.rmtree(f'{output_file}.parts', ignore_errors=True)
+
+
+def worker_count(
+    number_of_workers: int,
+    worker_memory_gb: float = 2) -> int:
+  '''Limit number_of_workers to what the available memory can hold.
+
+  Args:
+    number_of_workers: The number of workers requested.
+
+    worker_memory_gb: The approximate resident memory of one worker with the
+      CLTK model loaded, in GB. Defaults to 2.
+
+  Output: An int of at least 1.
+  '''
+  import psutil
+
+  available_gb = psutil.virtual_memory().available / 1024 ** 3
+  return max(1, min(number_of_workers, int(available_gb // worker_memory_gb)))
+
+
+def mqdq_files_to_csv(
+    data_files: list,
+    output_directory: str,
+    number_of_workers: int,
+    allowed_meters: list = None,
+    excluded_parts_of_speech: list = [],
+    write_lines: int = 10,
+    max_memory_percent: float = 85,
+    worker_memory_gb: float = 2,
+    parse_cache_file: str = None,
+    parse_cache_max_entries: int = 2000000,
+    pipeline_profile: str = 'default',
+    analyze_batch_size: int = 1,
+    output_format: str = 'csv',
+    parse_server_socket: str = None,
+    index: dict = None,
+    transliterate_greek: bool = False,
+    quarantine_file: str = None,
+    sentence_timeout_seconds: float = None,
+    morphology_memo_file: str = None,
+    morphology_fast_mode: bool = False,
+    profile_top_sections: int = 0,
+    artifact_keys: dict = None) -> None:
+  '''Run create_csvs.mqdq_to_csv over data_files with a pool of worker
+  processes, scheduling work one section at a time, largest first.
+
+  Args:
+    data_files: A list of JSON filenames, as for create_csvs.mqdq_to_csv.
+
+    output_directory: The directory to write one CSV per input file to.
+
+    number_of_workers: The maximum number of worker processes to run.
+
+    allowed_meters: "Meters" values from MQDQ to allow. Defaults to None,
+      which allows everything.
+
+    excluded_parts_of_speech: to be passed to tokenize_latin.enumerativeness
+
+    write_lines: The number of output parsed lines to batch before writing,
+      or an adaptive_batching.AdaptiveBatchSize (of which each worker adapts
+      its own copy). Defaults to 10.
+
+    max_memory_percent: No new sections are handed out while system memory
+      use (per psutil) is above this percentage, unless no section is
+      running. Defaults to 85.
+
+    worker_memory_gb: The approximate memory of one worker, used to cap the
+      number of workers at startup. Defaults to 2.
+
+    parse_cache_file: A SQLite file for tokenize_latin.use_parse_cache, shared
+      by all workers. Defaults to None, which parses every sentence.
+
+    parse_cache_max_entries: The maximum number of sentences to keep in the
+      parse cache.
+
+    pipeline_profile: The CLTK pipeline for each worker to build; see
+      tokenize_latin.build_nlp(). Defaults to "default".
+
+    analyze_batch_size: The number of sentences to parse in one CLTK call;
+      see tokenize_latin.use_pipeline_profile(). Defaults to 1.
+
+    output_format: "csv" or "parquet" (see parquet_output). Defaults to
+      "csv".
+
+    parse_server_socket: The socket of a parse server (see parse_server.py)
+      for workers to send sections to, if one is running. Defaults to None,
+      which parses in the workers.
+
+    index: A corpus index of data_files (see corpus_index.build_index()),
+      to list their sections from. Defaults to None, which reads each file.
+
+    transliterate_greek: Whether to transliterate Greek words rather than
+      remove them; see tokenize_latin.use_greek_transliteration(). Defaults
+      to False.
+
+    quarantine_file: A file to record sentences that couldn't be parsed in,
+      shared by all workers (see fault_isolation.py). Defaults to None,
+      which only logs them.
+
+    sentence_timeout_seconds: The longest to spend parsing one sentence
+      before giving up on it. Defaults to None, which waits indefinitely.
+
+    morphology_memo_file: A SQLite file for tokenize_latin.use_morphology_memo,
+      shared by all workers. Defaults to None, which keeps no memo.
+
+    morphology_fast_mode: Whether to skip parsing sentences whose analyses
+      are all certain in the memo (see morphology_memo.py). Defaults to
+      False.
+
+    profile_top_sections: The number of slowest sections whose call stacks
+      each worker keeps (see section_profiler.py); they are merged into this
+      process's profiler, if section_profiler.enable() was called. Defaults
+      to 0, which doesn't profile.
+
+    artifact_keys: A dict from each of data_files to its output's key in the
+      artifact store, if one is used (see create_csvs.resume_checkpoint()).
+      Defaults to None.
+
+  Output: None. One CSV (or Parquet file) per input file is written to
+    output_directory.
+  '''
+  if output_directory != '' and not os.path.exists(output_directory):
+    logger.info(
+        'Creating directory "%s" for output...', output_directory)
+    os.makedirs(output_directory)
+
+  pending = []
+  tasks_by_output_file = {}
+  checkpoints = {}
+  remaining_by_output_file = {}
+  for data_file in data_files:
+    output_file = create_csvs.output_file_name(
+        data_file, output_directory, output_format)
+    if index is not None:
+      tasks = corpus_index.section_tasks(index, data_file, allowed_meters)
+    else:
+      tasks = section_tasks(data_file, allowed_meters=allowed_meters)
+    tasks_by_output_file[output_file] = tasks
+
+    # Skip sections already in output_file, or already written to a part
+    # file, by an earlier, interrupted run:
+    checkpoints[output_file] = create_csvs.resume_checkpoint(
+        output_file, data_file,
+        artifact_keys.get(data_file) if artifact_keys is not None else None)
+    os.makedirs(f'{output_file}.parts', exist_ok=True)
+    finished_sections = set(
+        (s['work_index'], s['section_index'])
+        for s in checkpoints[output_file]['sections'])
+    file_pending = [
+        (task, output_file) for task in tasks
+        if (task['work_index'], task['section_index']) not in
+        finished_sections and not os.path.exists(part_file_name(
+            output_file, task['work_index'], task['section_index']))]
+    pending += file_pending
+    remaining_by_output_file[output_file] = len(file_pending)
+
+  for output_file, remaining in remaining_by_output_file.items():
+    if remaining == 0:
+      merge_part_files(
+          output_file, tasks_by_output_file[output_file],
+          checkpoints[output_file])
+
+  # Don't start (and load models into) any workers if there's nothing to
+  # parse:
+  if not pending:
+    logger.info('No sections left to parse.')
+    return
+
+  import psutil
+
+  number_of_workers = worker_count(
+      number_of_workers, worker_memory_gb=worker_memory_gb)
+  logger.info(
+      'Parsing %d sections from %d files with %d workers...',
+      len(pending), len(data_files), number_of_workers)
+
+  finished = queue.Queue()
+  # Hand out the sections with the most lines first (pending.pop() takes
+  # from the end), so that no long section is left running on its own at
+  # the end of the run:
+  pending.sort(key=lambda pending_task: pending_task[0]['lines'])
+  progress = corpus_index.Progress(
+      sum(task['lines'] for task, _ in pending))
+  in_flight = 0
+
+  with multiprocessing.Pool(
+      number_of_workers,
+      initializer=_init_worker,
+      initargs=(excluded_parts_of_speech, write_lines, parse_cache_file,
+                parse_cache_max_entries, pipeline_profile,
+                analyze_batch_size, parse_server_socket,
+                transliterate_greek, quarantine_file,
+                sentence_timeout_seconds, morphology_memo_file,
+                morphology_fast_mode, profile_top_sections)) as pool:
+    while pending or in_flight > 0:
+      while pending and in_flight < number_of_workers:
+        if in_flight > 0 and \
+            psutil.virtual_memory().percent > max_memory_percent:
+          logger.info(
+              'Memory use above %s%%; waiting for running sections...',
+              max_memory_percent)
+          break
+        pool.apply_async(
+            _process_section,
+            pending.pop(),
+            callback=finished.put,
+            error_callback=finished.put)
+        in_flight += 1
+
+      try:
+        result = finished.get(timeout=5)
+      except queue.Empty:
+        continue
+      in_flight -= 1
+
+      if isinstance(result, BaseException):
+        pool.terminate()
+        raise result
+
+      task, output_file, metrics = result
+      run_metrics.merge(metrics)
+      progress.update(task['lines'])
+      remaining_by_output_file[output_file] -= 1
+      if remaining_by_output_file[output_file] == 0:
+        logger.info('Merging sections into "%s"...', output_file)
+        merge_part_files(
+            output_file, tasks_by_output_file[output_file],
+            checkpoints[output_file])
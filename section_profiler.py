@@ -0,0 +1,224 @@
+'''Sample the call stacks of the slowest sections of a run.
+
+run_metrics records how long each section took, but not where the time went
+within it. With a SectionProfiler enabled (see enable(), or
+profile_top_sections in pipeline.py), every section timed with
+run_metrics.section() is also sampled: a background thread records the
+section's thread's call stack every interval_seconds, and the stacks of the
+top_n slowest sections are kept, with each section's href, meter, and line
+and sentence counts. The sampling thread backs off so that it takes no more
+than max_overhead of a core; when no profiler is enabled, nothing is
+sampled.
+
+write() saves each kept section's stacks in the collapsed format read by
+flamegraph.pl and speedscope ("frame;frame;frame count" per line, outermost
+frame first), and a ranked summary of the sections, with the functions each
+spent most samples in.
+'''
+
+import collections
+import functools
+import heapq
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# The profiler in use in this process, if any (see enable()):
+active_profiler = None
+
+
+@functools.lru_cache(maxsize=4096)
+def _frame_name(code) -> str:
+  return re.sub(r'[; ]', '_', (
+      f'{os.path.basename(code.co_filename)}:{code.co_name}:'
+      f'{code.co_firstlineno}'))
+
+
+def collapse_stack(frame) -> str:
+  '''A frame's call stack, outermost first, joined with ";".'''
+  names = []
+  while frame is not None:
+    names.append(_frame_name(frame.f_code))
+    frame = frame.f_back
+  return ';'.join(reversed(names))
+
+
+class SectionProfiler():
+  '''Sample the stacks of sections, keeping the top_n slowest.
+
+  Args:
+    top_n: The number of sections to keep. Defaults to 10.
+
+    interval_seconds: The time between samples. Defaults to 0.005.
+
+    max_overhead: The largest share of a core that sampling may take; the
+      interval is lengthened as needed. Defaults to 0.02.
+  '''
+
+  def __init__(self, top_n: int = 10, interval_seconds: float = 0.005,
+               max_overhead: float = 0.02):
+    self.top_n = top_n
+    self.interval_seconds = interval_seconds
+    self.max_overhead = max_overhead
+    # (seconds, sequence, profile), slowest last:
+    self._profiles = []
+    self._sequence = itertools.count()
+    # thread id -> stack counts, for each section being sampled:
+    self._active = {}
+    self._lock = threading.Lock()
+    self._wake = threading.Event()
+    self._thread = None
+
+  def start(self) -> tuple:
+    '''Start sampling the current thread, for a section.
+
+    Output: A token for finish().
+    '''
+    stacks = collections.Counter()
+    with self._lock:
+      self._active[threading.get_ident()] = stacks
+      if self._thread is None:
+        self._thread = threading.Thread(
+            target=self._sample, name='section-profiler', daemon=True)
+        self._thread.start()
+    self._wake.set()
+    return threading.get_ident(), stacks
+
+  def _sample(self) -> None:
+    while True:
+      with self._lock:
+        active = list(self._active.items())
+      if not active:
+        self._wake.clear()
+        # (a section may have started since active was read)
+        with self._lock:
+          waiting = not self._active
+        if waiting:
+          self._wake.wait()
+        continue
+
+      start = time.perf_counter()
+      frames = sys._current_frames()
+      for thread_id, stacks in active:
+        frame = frames.get(thread_id)
+        if frame is not None:
+          stacks[collapse_stack(frame)] += 1
+      del frames
+      elapsed = time.perf_counter() - start
+      time.sleep(max(self.interval_seconds, elapsed / self.max_overhead))
+
+  def finish(self, token: tuple, section: dict) -> None:
+    '''Stop sampling a section, and keep its profile if it is among the
+    slowest.
+
+    Args:
+      token: From start().
+
+      section: The section's record, with at least "seconds" (e.g., from
+        run_metrics.section(), with "href" and "meter" added).
+    '''
+    thread_id, stacks = token
+    with self._lock:
+      if self._active.get(thread_id) is stacks:
+        del self._active[thread_id]
+    self._keep(dict(
+        section, samples=sum(stacks.values()), stacks=dict(stacks)))
+
+  def _keep(self, profile: dict) -> None:
+    with self._lock:
+      item = (profile['seconds'], next(self._sequence), profile)
+      if len(self._profiles) < self.top_n:
+        heapq.heappush(self._profiles, item)
+      elif item[0] > self._profiles[0][0]:
+        heapq.heapreplace(self._profiles, item)
+
+  def take(self) -> list:
+    '''The profiles kept since the last take(), which are then cleared. For
+    merge() in another process.'''
+    with self._lock:
+      profiles = [profile for _, _, profile in self._profiles]
+      self._profiles = []
+    return profiles
+
+  def merge(self, profiles: list) -> None:
+    '''Add profiles from take() in another process (e.g., a worker).'''
+    for profile in profiles:
+      self._keep(profile)
+
+  def profiles(self) -> list:
+    '''The profiles kept, slowest first.'''
+    with self._lock:
+      return [profile for _, _, profile in sorted(
+          self._profiles, key=lambda item: item[:2], reverse=True)]
+
+  def write(self, directory: str, top_functions: int = 5) -> list:
+    '''Write each kept profile as collapsed stacks, and a ranked summary
+    (summary.txt, and summary.json), to directory.
+
+    Args:
+      directory: The directory to write to. It is created if it does not
+        exist.
+
+      top_functions: The number of functions to list per section in the
+        summary, by the samples in which each was running. Defaults to 5.
+
+    Output: The summary, as a list of dicts, slowest section first.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    summary = []
+    for rank, profile in enumerate(self.profiles(), 1):
+      slug = re.sub(r'[^A-Za-z0-9]+', '_', str(profile.get('href')))[-60:]
+      stacks_file = f'{rank:02d}_{slug.strip("_")}.collapsed'
+      with open(os.path.join(directory, stacks_file), 'w') as f:
+        for stack, count in sorted(profile['stacks'].items()):
+          f.write(f'{stack} {count}\n')
+
+      leaf_counts = collections.Counter()
+      for stack, count in profile['stacks'].items():
+        leaf_counts[stack.rsplit(';', 1)[-1]] += count
+      summary.append(dict(
+          {key: value for key, value in profile.items() if key != 'stacks'},
+          rank=rank,
+          seconds=round(profile['seconds'], 3),
+          stacks_file=stacks_file,
+          top_functions=[
+              [name, count]
+              for name, count in leaf_counts.most_common(top_functions)]))
+
+    with open(os.path.join(directory, 'summary.json'), 'w') as f:
+      json.dump(summary, f, indent=2)
+    with open(os.path.join(directory, 'summary.txt'), 'w') as f:
+      for entry in summary:
+        f.write(
+            f'{entry["rank"]}. {entry["seconds"]:.3f}s  {entry.get("href")}  '
+            f'({entry.get("meter")}; {entry.get("lines")} lines, '
+            f'{entry.get("sentences")} sentences, {entry["samples"]} samples)'
+            f'  {entry["stacks_file"]}\n')
+        for name, count in entry['top_functions']:
+          share = count / entry['samples'] if entry['samples'] > 0 else 0
+          f.write(f'     {share:6.1%}  {name}\n')
+    return summary
+
+
+def enable(top_n: int = 10, interval_seconds: float = 0.005) -> None:
+  '''Profile sections in this process from now on (see SectionProfiler), or
+  stop, if top_n is 0.'''
+  global active_profiler
+
+  active_profiler = SectionProfiler(
+      top_n, interval_seconds=interval_seconds) if top_n > 0 else None
+
+
+def take() -> list:
+  '''active_profiler.take(), or an empty list if there is none.'''
+  return active_profiler.take() if active_profiler is not None else []
+
+
+def merge(profiles: list) -> None:
+  '''active_profiler.merge(profiles), if there is an active profiler.'''
+  if active_profiler is not None:
+    active_profiler.merge(profiles)
@@ -0,0 +1,142 @@
+'''Split a section's lines into sentences as the lines are read.
+
+tokenize_latin.tokenize_latin used to join all of a section's lines into one
+string and split all of it into sentences before parsing the first one, so
+the longest sections built a large string and sentence list before any line
+was output. iter_sentences() instead keeps only a window of text that hasn't
+been split off yet: lines are added to it, it is split with the same
+sentence tokenizer, and every sentence but the last few is yielded straight
+away. The rest stay in the window, as lookahead, in case more text would
+change where they end.
+
+Punkt (the algorithm of CLTK's Latin sentence tokenizer) decides whether
+each full stop ends a sentence from the words just before and after it, so a
+boundary that has a whole sentence of text after it won't move, and the
+sentences are the same as from splitting the whole text at once (with a
+lookahead of at least 1; see iter_sentences()). To check this on a corpus:
+
+  python3 sentence_stream.py FILE.json [FILE.json ...]
+
+which splits every section both ways, and lists any section where they
+differ.
+'''
+
+import argparse
+import logging
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+
+def iter_sentences(lines, tokenize, lookahead: int = 2,
+                   chunk_characters: int = 2000):
+  '''Split lines into sentences, as tokenize(' '.join(lines)) would, reading
+  lines only as sentences are needed.
+
+  Args:
+    lines: An iterable of text lines.
+
+    tokenize: A function from a string to a list of sentences, each a
+      substring of it, in order (e.g., the tokenize method of
+      tokenize_latin.get_sentence_tokenizer()).
+
+    lookahead: The number of sentences to keep in the window after each
+      split, in case text after them changes where they end. With 0, every
+      sentence is yielded as soon as the window is split, including the last
+      one, which may not be finished yet: a sentence that runs across lines
+      is then cut where the window was split, so the sentences don't match
+      splitting the whole text at once. Defaults to 2.
+
+    chunk_characters: The window is split again once it has at least this
+      many characters, and at least twice as many as after the last split,
+      so that a very long sentence isn't split again for every line.
+      Defaults to 2000.
+
+  Output: A generator of sentences.
+  '''
+  if lookahead < 0:
+    raise ValueError(f'lookahead must be at least 0, not {lookahead}.')
+
+  window = None
+  split_at = chunk_characters
+
+  for line in lines:
+    window = line if window is None else f'{window} {line}'
+    if len(window) < split_at:
+      continue
+
+    sentences = tokenize(window)
+    ready = len(sentences) - lookahead
+    if ready > 0 and lookahead == 0:
+      yield from sentences
+      window = None
+      split_at = chunk_characters
+      continue
+
+    if ready > 0:
+      # Find where the first sentence kept as lookahead starts:
+      position = 0
+      for sentence in sentences[:ready]:
+        position = window.find(sentence, position)
+        if position < 0:
+          break
+        position += len(sentence)
+      if position >= 0:
+        position = window.find(sentences[ready], position)
+
+      if position < 0:
+        # The tokenizer changed the text, so the window can't be cut where
+        # a sentence starts; it is all split at the end instead.
+        split_at = float('inf')
+        continue
+
+      yield from sentences[:ready]
+      window = window[position:]
+
+    split_at = max(chunk_characters, 2 * len(window))
+
+  if window is not None:
+    yield from tokenize(window)
+
+
+def check_file(data_file: str, tokenize, lookahead: int = 2,
+               chunk_characters: int = 2000) -> list:
+  '''Compare iter_sentences() with splitting each whole section at once.
+
+  Output: A list of the hrefs of the sections of data_file whose sentences
+    differ.
+  '''
+  import mqdq_stream
+
+  differing = []
+  for _, _, _, _, section, _ in mqdq_stream.iter_sections(data_file):
+    lines = section.get('lines', [])
+    if lines and list(iter_sentences(
+        lines, tokenize, lookahead, chunk_characters)) != tokenize(
+            ' '.join(lines)):
+      differing.append(section.get('href'))
+  return differing
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('data_files', nargs='+')
+  parser.add_argument('--lookahead', type=int, default=2)
+  parser.add_argument(
+      '--chunk-characters', type=int, default=2000,
+      help='Use a small value (e.g., 1) to split after every line.')
+  args = parser.parse_args()
+
+  import tokenize_latin
+
+  logger.setLevel(logging.INFO)
+  tokenize = tokenize_latin.get_sentence_tokenizer().tokenize
+  differing_sections = 0
+  for data_file in args.data_files:
+    for href in check_file(
+        data_file, tokenize, args.lookahead, args.chunk_characters):
+      logger.warning('Sentences differ in "%s" (%s).', href, data_file)
+      differing_sections += 1
+  logger.info(
+      '%d sections in %d files differ.', differing_sections,
+      len(args.data_files))
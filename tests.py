@@ -0,0 +1,1051 @@
+'''Unit tests, for python3 -m unittest tests.'''
+
+import json
+import os
+import pickle
+import re
+import subprocess
+import sys
+import inspect
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+import adaptive_batching
+import aggregate
+import artifact_store
+import compact_tags
+import corpus_index
+import create_csvs
+import fault_isolation
+import line_index
+import morphology_memo
+import mqdq_stream
+import parquet_output
+import parse_cache
+import parse_server
+import pipeline
+import rescore
+import run_metrics
+import sampling
+import section_pool
+import section_profiler
+import sentence_stream
+import text_normalization
+import tokenize_latin
+
+
+def split_at_full_stops(text: str) -> list:
+  '''A stand-in sentence tokenizer: every full stop ends a sentence.'''
+  return re.findall(r'\S[^.]*\.?', text)
+
+
+class IterSentencesTest(unittest.TestCase):
+
+  lines = ['Arma uirumque cano.', 'Troiae qui primus ab oris.',
+           'Italiam fato profugus.', 'Lauinaque uenit litora.']
+
+  # A sentence that runs across lines:
+  spanning_lines = ['Arma uirumque cano, Troiae qui primus ab oris',
+                    'Italiam fato profugus.', 'Lauinaque uenit litora.']
+
+  def test_matches_whole_text(self):
+    for lines in (self.lines, self.spanning_lines):
+      for lookahead in (1, 2, 5):
+        self.assertEqual(
+            list(sentence_stream.iter_sentences(
+                lines, split_at_full_stops, lookahead=lookahead,
+                chunk_characters=1)),
+            split_at_full_stops(' '.join(lines)))
+
+  def test_no_lookahead_cuts_sentences_across_lines(self):
+    self.assertEqual(
+        list(sentence_stream.iter_sentences(
+            self.spanning_lines, split_at_full_stops, lookahead=0,
+            chunk_characters=1)),
+        ['Arma uirumque cano, Troiae qui primus ab oris',
+         'Italiam fato profugus.', 'Lauinaque uenit litora.'])
+
+  def test_no_lookahead_yields_before_the_end(self):
+    read = []
+
+    def reading(lines):
+      for line in lines:
+        read.append(line)
+        yield line
+
+    sentences = sentence_stream.iter_sentences(
+        reading(self.lines), split_at_full_stops, lookahead=0,
+        chunk_characters=1)
+    self.assertEqual(next(sentences), 'Arma uirumque cano.')
+    self.assertEqual(read, self.lines[:1])
+
+  def test_negative_lookahead(self):
+    with self.assertRaises(ValueError):
+      list(sentence_stream.iter_sentences(
+          self.lines, split_at_full_stops, lookahead=-1))
+
+
+class RescoreTest(unittest.TestCase):
+
+  lines = [
+      # One noun, and a word from a sentence that couldn't be parsed:
+      [{'string': 'arma', 'lemma': 'arma', 'pos': 'noun',
+        'case': ['accusative']},
+       {'string': 'Troiae', 'lemma': None, 'pos': 'unparsed', 'case': None}],
+      [{'string': 'Troiae', 'lemma': None, 'pos': 'unparsed', 'case': None},
+       {'string': ',', 'lemma': ',', 'pos': 'punctuation', 'case': None}],
+      [{'string': 'qui', 'lemma': 'qui', 'pos': 'pronoun',
+        'case': ['nominative']},
+       {'string': 'primus', 'lemma': 'primus', 'pos': 'adjective',
+        'case': ['nominative']},
+       {'string': 'oris', 'lemma': 'ora', 'pos': 'noun',
+        'case': ['ablative', 'dative']}],
+  ]
+
+  def test_matches_pipeline_scores(self):
+    exclusion_sets = {'none': [], 'no_pronouns': ['pronoun']}
+    for tags in (pd.Series(self.lines), pd.Series(map(str, self.lines))):
+      scores = rescore.score_tags(tags, exclusion_sets)
+      for i, line in enumerate(self.lines):
+        for name, excluded in exclusion_sets.items():
+          expected = compact_tags.enumerativeness(
+              compact_tags.from_dicts(line), excluded)
+          self.assertEqual(
+              {key: scores[f'{name}_{key}'][i] for key in expected},
+              expected)
+
+  def test_unparsed_tokens_are_not_counted(self):
+    scores = rescore.score_tags(pd.Series(self.lines[:1]), {'none': []})
+    self.assertEqual(scores['none_tokens'][0], 1)
+    self.assertEqual(scores['none_enumerativeness'][0], 1.0)
+
+
+class CompactTagsTest(unittest.TestCase):
+
+  def test_enumerativeness(self):
+    tags = compact_tags.from_dicts(RescoreTest.lines[2])
+    self.assertEqual(
+        compact_tags.enumerativeness(tags),
+        {'top_case': 2, 'tokens': 3, 'enumerativeness': 0.667})
+    self.assertEqual(
+        compact_tags.enumerativeness(tags, ['pronoun']),
+        {'top_case': 1, 'tokens': 2, 'enumerativeness': 0.5})
+    # Cases are excluded by the exact part of speech, and tokens by any part
+    # of speech containing it:
+    self.assertEqual(
+        compact_tags.enumerativeness(tags, ['noun']),
+        {'top_case': 2, 'tokens': 1, 'enumerativeness': 2.0})
+    self.assertEqual(
+        compact_tags.enumerativeness(
+            compact_tags.from_dicts(RescoreTest.lines[1])),
+        {'top_case': 0, 'tokens': 0, 'enumerativeness': None})
+
+  def test_tokens_read_and_pickle_as_dicts(self):
+    tags = compact_tags.from_dicts(RescoreTest.lines[2])
+    self.assertEqual(compact_tags.as_dicts(tags), RescoreTest.lines[2])
+    self.assertEqual(tags[2]['case'], ['ablative', 'dative'])
+    self.assertIsNone(tags[0].get('missing'))
+    self.assertEqual(pickle.loads(pickle.dumps(tags)), tags)
+
+
+class MorphologyMemoTest(unittest.TestCase):
+
+  text = 'arma uirumque mecum cano .'
+  tags = compact_tags.from_dicts([
+      {'string': 'arma', 'lemma': 'arma', 'pos': 'noun',
+       'case': ['accusative']},
+      {'string': 'uirum', 'lemma': 'uir', 'pos': 'noun',
+       'case': ['accusative']},
+      {'string': 'que', 'lemma': 'que', 'pos': 'conjunction', 'case': None},
+      {'string': 'cum', 'lemma': 'cum', 'pos': 'adposition', 'case': None},
+      {'string': 'me', 'lemma': 'ego', 'pos': 'pronoun',
+       'case': ['ablative']},
+      {'string': 'cano', 'lemma': 'cano', 'pos': 'verb', 'case': None},
+      {'string': '.', 'lemma': '.', 'pos': 'punctuation', 'case': None},
+  ])
+
+  def test_word_splits(self):
+    self.assertEqual(
+        morphology_memo.word_splits(self.text, self.tags),
+        [('arma', ('arma',)), ('uirumque', ('uirum', 'que')),
+         ('mecum', ('cum', 'me')), ('cano', ('cano',)), ('.', ('.',))])
+    self.assertIsNone(morphology_memo.word_splits('arma uirum', self.tags))
+
+  def test_fast_tags_split_words_as_parsed(self):
+    memo = morphology_memo.MorphologyMemo(min_count=2, version='test')
+    memo.record(self.tags, self.text)
+    self.assertIsNone(memo.fast_tags(self.text))
+    memo.record(self.tags, self.text)
+    self.assertEqual(
+        compact_tags.as_dicts(memo.fast_tags(self.text)),
+        compact_tags.as_dicts(self.tags))
+    # Analyses alone don't say how words are split:
+    memo = morphology_memo.MorphologyMemo(min_count=1, version='test')
+    memo.record(self.tags)
+    self.assertIsNone(memo.fast_tags(self.text))
+
+
+def write_author_file(path: str, sections: list) -> None:
+  '''Write an MQDQ author file with one work holding sections, each a list
+  of lines.'''
+  with open(path, 'w') as f:
+    json.dump({
+        'author_name': 'Test', 'author_date': None, 'author_id': 0,
+        'author_works': [{'name': 'Work', 'edition': None, 'sections': [
+            {'href': f'section{i}', 'meter': 'Hexameters', 'lines': lines}
+            for i, lines in enumerate(sections)]}]}, f)
+
+
+class MQDQStreamTest(unittest.TestCase):
+
+  data = {
+      'author_name': 'Vergilius', 'author_date': '70 BC - 19 BC',
+      'author_works': [
+          {'name': 'Opera minora', 'sections': [], 'edition': None},
+          {'name': 'Aeneis', 'edition': {'editor': 'Conte', 'year': 2009},
+           'sections': [
+               {'href': 'a}1', 'meter': 'Hexameters',
+                'lines': ['Arma uirumque cano, "Troiae" qui primus ab oris',
+                          'ἀνδρῶν \\ [Italiam] {fato} profugus']},
+               {'href': 'a2', 'meter': 'Hexameters', 'lines': []}]}],
+      'author_id': 12,
+  }
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.data_file = os.path.join(directory.name, 'author.json')
+    with open(self.data_file, 'w', encoding='utf-8') as f:
+      json.dump(self.data, f, indent=2, ensure_ascii=False)
+
+  def test_sections_match_json_load(self):
+    author = {key: value for key, value in self.data.items()
+              if key != 'author_works'}
+    expected = [
+        (author, work_index,
+         {key: value for key, value in work.items() if key != 'sections'},
+         section_index, section)
+        for work_index, work in enumerate(self.data['author_works'])
+        for section_index, section in enumerate(work['sections'])]
+    sections = list(mqdq_stream.iter_sections(self.data_file))
+    self.assertEqual([section[:5] for section in sections], expected)
+
+    for _, _, _, _, section, byte_offset in sections:
+      self.assertEqual(
+          mqdq_stream.read_section(self.data_file, byte_offset), section)
+    self.assertEqual(
+        mqdq_stream.read_author(self.data_file),
+        {'author_name': 'Vergilius', 'author_date': '70 BC - 19 BC'})
+
+
+class TextNormalizationTest(unittest.TestCase):
+
+  def test_normalize_line(self):
+    line = 'Arma <uirumque> ἀνδρῶν , "cano"  [Troiae]'
+    self.assertEqual(
+        text_normalization.normalize_line(line), 'Arma uirumque, cano Troiae')
+    self.assertEqual(
+        text_normalization.normalize_line(line, transliterate_greek=True),
+        'Arma uirumque andron, cano Troiae')
+
+  def test_normalize_file_transliterates_only_lines(self):
+    with tempfile.TemporaryDirectory() as directory:
+      data_file = os.path.join(directory, 'author.json')
+      with open(data_file, 'w', encoding='utf-8') as f:
+        json.dump(MQDQStreamTest.data, f, ensure_ascii=False)
+      text_normalization.normalize_file(data_file, data_file)
+      with open(data_file, encoding='ascii') as f:
+        normalized = json.load(f)
+
+    expected = json.loads(json.dumps(MQDQStreamTest.data))
+    for work in expected['author_works']:
+      for section in work['sections']:
+        section['lines'] = [
+            text_normalization.transliterate(line)
+            for line in section['lines']]
+    self.assertEqual(normalized, expected)
+    self.assertEqual(
+        normalized['author_works'][1]['sections'][0]['lines'][1][:7],
+        'andron ')
+
+
+class TagAll():
+  '''A stand-in for CLTK's NLP object that gives every word part of speech
+  pos, and raises KeyboardInterrupt (as if the run were stopped) on text
+  containing interrupt_at.'''
+
+  def __init__(self, pos: str = 'noun', interrupt_at: str = None):
+    self.pos = pos
+    self.interrupt_at = interrupt_at
+
+  def analyze(self, text: str):
+    if self.interrupt_at is not None and self.interrupt_at in text:
+      raise KeyboardInterrupt()
+    return types.SimpleNamespace(words=[
+        types.SimpleNamespace(
+            string=token, lemma=token.lower(),
+            pos=self.pos if token[0].isalnum() else 'punctuation',
+            features=types.SimpleNamespace(features={}))
+        for token in re.findall(r'\w+|[^\w\s]', text)])
+
+
+class AlignTagsTest(unittest.TestCase):
+
+  lines = ['Arma uirumque cano, Troiae', 'qui primus ab oris.']
+
+  def align(self, sentences: list) -> list:
+    '''The strings of each line's tokens, from sentences of strings.'''
+    tags = ([compact_tags.Token(string, string, 'noun') for string in strings]
+            for strings in sentences)
+    return [[tag.string for tag in line['tags']]
+            for line in tokenize_latin.align_tags_to_lines(self.lines, tags)]
+
+  def test_sentence_across_lines(self):
+    self.assertEqual(
+        self.align([['Arma', 'uirum', 'que', 'cano', ','],
+                    ['Troiae', 'qui', 'primus', 'ab', 'oris', '.']]),
+        [['Arma', 'uirum', 'que', 'cano', ',', 'Troiae'],
+         ['qui', 'primus', 'ab', 'oris', '.']])
+
+  def test_changed_token_is_aligned_by_length(self):
+    self.assertEqual(
+        self.align([['Arma', 'uirumque', 'cano,', 'Troiai', 'qui'],
+                    ['primus', 'ab', 'oris', '.']]),
+        [['Arma', 'uirumque', 'cano,', 'Troiai'],
+         ['qui', 'primus', 'ab', 'oris', '.']])
+
+  def test_missing_tokens_leave_lines_untagged(self):
+    self.assertEqual(
+        self.align([['Arma', 'uirumque', 'cano']]),
+        [['Arma', 'uirumque', 'cano'], []])
+
+
+class ParseCacheTest(unittest.TestCase):
+
+  tags = [{'string': 'arma', 'lemma': 'arma', 'pos': 'noun',
+           'case': ['accusative']}]
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.path = os.path.join(directory.name, 'parse_cache.sqlite')
+
+  def open_cache(self, **options) -> parse_cache.ParseCache:
+    cache = parse_cache.ParseCache(self.path, **options)
+    self.addCleanup(cache.close)
+    return cache
+
+  def test_round_trip(self):
+    cache = self.open_cache(version='1')
+    self.assertIsNone(cache.get('arma'))
+    cache.put('arma', self.tags)
+    self.assertEqual(cache.get('arma'), self.tags)
+    self.assertEqual(self.open_cache(version='1').get('arma'), self.tags)
+    self.assertIsNone(self.open_cache(version='2').get('arma'))
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+  def test_hits_are_written_in_batches(self):
+    cache = self.open_cache(version='1')
+    cache.put('arma', self.tags)
+    stored_last_used = cache._connection.execute(
+        'SELECT last_used FROM parses').fetchone()[0]
+    with mock.patch.object(parse_cache.time, 'time',
+                           return_value=stored_last_used + 10):
+      cache.get('arma')
+    self.assertFalse(cache._connection.in_transaction)
+    self.assertEqual(cache._connection.execute(
+        'SELECT last_used FROM parses').fetchone()[0], stored_last_used)
+    cache.flush()
+    self.assertEqual(cache._connection.execute(
+        'SELECT last_used FROM parses').fetchone()[0], stored_last_used + 10)
+
+  def test_evicts_least_recently_used(self):
+    cache = self.open_cache(version='1', max_entries=2)
+    for i, text in enumerate(['arma', 'uirum', 'cano']):
+      with mock.patch.object(parse_cache.time, 'time', return_value=i):
+        cache.put(text, self.tags)
+    with mock.patch.object(parse_cache.time, 'time', return_value=3):
+      cache.get('arma')
+    cache.evict()
+    self.assertEqual(
+        [text for text in ['arma', 'uirum', 'cano']
+         if cache.get(text) is not None], ['arma', 'cano'])
+    self.assertEqual(cache.evictions, 1)
+
+
+class ParsingTestCase(unittest.TestCase):
+  '''Runs each test in a temporary directory holding an author file,
+  data_file, with tokenize_latin's settings restored afterwards, and
+  sentences split without CLTK.'''
+
+  sections = [IterSentencesTest.lines, ['Musa, mihi causas memora.']]
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.directory = directory.name
+    self.data_file = os.path.join(self.directory, 'author.json')
+    write_author_file(self.data_file, self.sections)
+    for name, value in {
+        'sentence_tokenizer': types.SimpleNamespace(
+            tokenize=split_at_full_stops),
+        'cltk_nlp': None, 'parse_cache': None, 'morphology_memo': None,
+        'parse_server': None, 'quarantine': None,
+        'sentence_timeout_seconds': None, 'pipeline_profile': 'default',
+        'analyze_batch_size': 1}.items():
+      patcher = mock.patch.object(tokenize_latin, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def read_output(self, output_file: str) -> pd.DataFrame:
+    return pd.read_csv(output_file)
+
+
+class ParseCacheSettingsTest(ParsingTestCase):
+
+  def parse(self, nlp, profile: str, batch_size: int) -> str:
+    tokenize_latin.use_pipeline_profile(profile, batch_size=batch_size)
+    tokenize_latin.use_nlp(nlp)
+    return tokenize_latin.analyze_sentence('Arma uirumque cano.')[0].pos
+
+  def test_parses_are_reused_only_with_the_same_settings(self):
+    tokenize_latin.use_parse_cache(
+        os.path.join(self.directory, 'parse_cache.sqlite'))
+    self.addCleanup(tokenize_latin.use_parse_cache, None)
+    self.assertEqual(self.parse(TagAll('noun'), 'minimal', 1), 'noun')
+    self.assertEqual(self.parse(TagAll('verb'), 'minimal', 1), 'noun')
+    self.assertEqual(self.parse(TagAll('verb'), 'minimal', 4), 'verb')
+    self.assertEqual(self.parse(TagAll('adverb'), 'default', 1), 'adverb')
+
+
+class ParseServerTest(ParsingTestCase):
+
+  def test_defaults_match_pipeline(self):
+    defaults = {
+        name: parameter.default for name, parameter in
+        inspect.signature(parse_server.serve).parameters.items()}
+    for server_name, pipeline_name in (
+        ('pipeline_profile', 'cltk_pipeline_profile'),
+        ('analyze_batch_size', 'analyze_batch_size'),
+        ('transliterate_greek', 'transliterate_greek'),
+        ('sentence_timeout_seconds', 'sentence_timeout_seconds'),
+        ('morphology_fast_mode', 'morphology_fast_mode')):
+      self.assertEqual(
+          defaults[server_name], getattr(pipeline, pipeline_name),
+          server_name)
+
+  def tokenize(self, error: Exception) -> list:
+    tokenize_latin.use_nlp(TagAll('noun'))
+    client = mock.Mock()
+    client.tokenize_latin.side_effect = error
+    tokenize_latin.parse_server = client
+    return [line['text_parsed'] for line in
+            tokenize_latin.tokenize_latin(['Arma uirumque cano.'])]
+
+  def test_server_error_parses_the_section_here(self):
+    self.assertEqual(
+        self.tokenize(parse_server.ServerError('failed')),
+        ['Arma [noun] uirumque [noun] cano [noun] . [punctuation]'])
+    self.assertIsNotNone(tokenize_latin.parse_server)
+
+  def test_settings_mismatch_stops_using_the_server(self):
+    self.assertEqual(
+        len(self.tokenize(parse_server.SettingsMismatch('other', {}))), 1)
+    self.assertIsNone(tokenize_latin.parse_server)
+
+
+class ParquetOutputTest(ParsingTestCase):
+
+  def test_matches_csv_output(self):
+    tokenize_latin.use_nlp(TagAll())
+    csv_file = os.path.join(self.directory, 'author.csv')
+    parquet_file = os.path.join(self.directory, 'author.parquet')
+    create_csvs.mqdq_to_csv(self.data_file, csv_file)
+    parquet_output.mqdq_to_parquet(
+        self.data_file, parquet_file, row_group_lines=2)
+
+    from_csv = self.read_output(csv_file)
+    from_parquet = parquet_output.read_parquet(parquet_file)
+    self.assertEqual(list(from_parquet.columns), list(from_csv.columns))
+    self.assertEqual(
+        list(from_parquet['tags'].map(str)), list(from_csv['tags']))
+    columns = [column for column in from_csv.columns if column != 'tags']
+    pd.testing.assert_frame_equal(
+        from_parquet[columns].astype(object).where(
+            from_parquet[columns].notna(), None),
+        from_csv[columns].astype(object).where(
+            from_csv[columns].notna(), None),
+        check_dtype=False)
+    self.assertTrue(create_csvs.output_is_complete(parquet_file))
+
+  def test_interrupted_output_is_not_written(self):
+    tokenize_latin.use_nlp(TagAll(interrupt_at='Musa'))
+    parquet_file = os.path.join(self.directory, 'author.parquet')
+    with self.assertRaises(KeyboardInterrupt):
+      parquet_output.mqdq_to_parquet(self.data_file, parquet_file)
+    self.assertFalse(os.path.exists(parquet_file))
+    self.assertFalse(os.path.exists(f'{parquet_file}.tmp'))
+    self.assertFalse(create_csvs.output_is_complete(parquet_file))
+
+
+class LineIndexTest(ParsingTestCase):
+
+  def test_terms_from_csv_tags_match(self):
+    tags = RescoreTest.lines[2]
+    terms = line_index.line_terms(tags, 'Hexameters')
+    self.assertEqual(line_index.line_terms(str(tags), 'Hexameters'), terms)
+    self.assertTrue({('lemma', 'ora'), ('case', 'dative'),
+                     ('top_case', 'nominative'), ('meter', 'Hexameters')
+                     }.issubset(terms))
+    self.assertNotIn(('top_case', 'dative'), terms)
+
+  def test_query_after_updates(self):
+    tokenize_latin.use_nlp(TagAll())
+    output_directory = os.path.join(self.directory, 'output')
+    output_file = create_csvs.output_file_name(
+        self.data_file, output_directory)
+    create_csvs.mqdq_to_csv(self.data_file, output_file)
+    index = line_index.LineIndex(os.path.join(self.directory, 'index.sqlite'))
+    self.addCleanup(index.close)
+
+    counts = index.update(line_index.output_files(output_directory))
+    self.assertEqual((counts['indexed'], counts['lines']), (1, 5))
+    self.assertEqual(
+        [(line['section_url'], line['line_number']) for line in index.query(
+            lemma=['arma', 'cano'], pos='noun', meter='Hexameters')],
+        [('section0', 0)])
+    self.assertEqual(len(index.query(pos='punctuation')), 5)
+    self.assertEqual(index.query(lemma='arma', limit=1)[0]['file'],
+                     os.path.abspath(output_file))
+    self.assertEqual(index.query(lemma='ensis'), [])
+
+    self.assertEqual(
+        index.update(line_index.output_files(output_directory))['unchanged'],
+        1)
+    self.assertEqual(index.update([])['removed'], 1)
+    self.assertEqual(index.query(lemma='arma'), [])
+
+
+class RescoreOutputTest(ParsingTestCase):
+
+  def test_parquet_output_is_rescored_as_csv_output(self):
+    tokenize_latin.use_nlp(TagAll('pronoun'))
+    input_directory = os.path.join(self.directory, 'output')
+    create_csvs.mqdq_to_csv(
+        self.data_file, os.path.join(input_directory, 'author.csv'))
+    parquet_output.mqdq_to_parquet(
+        self.data_file, os.path.join(input_directory, 'author.parquet'))
+
+    output_directory = os.path.join(self.directory, 'rescored')
+    rescore.rescore_csv_folder(
+        input_directory, output_directory,
+        {'none': [], 'no_pronouns': ['pronoun']})
+
+    columns = [f'{name}_{key}' for name in ('none', 'no_pronouns')
+               for key in ('top_case', 'tokens', 'enumerativeness')]
+    from_csv = self.read_output(
+        os.path.join(output_directory, 'author.csv'))[columns]
+    from_parquet = pd.read_parquet(
+        os.path.join(output_directory, 'author.parquet'))[columns]
+    pd.testing.assert_frame_equal(from_parquet, from_csv, check_dtype=False)
+    self.assertTrue((from_csv['none_tokens'] > 0).all())
+    self.assertTrue((from_csv['no_pronouns_tokens'] == 0).all())
+
+
+class FaultIsolationTest(ParsingTestCase):
+
+  def test_parser_that_cannot_load_stops_the_run(self):
+    output_file = os.path.join(self.directory, 'author.csv')
+    quarantine_file = os.path.join(self.directory, '_quarantine.jsonl')
+    tokenize_latin.use_quarantine(quarantine_file)
+    with mock.patch.object(
+        tokenize_latin, 'build_nlp',
+        side_effect=ImportError('No module named cltk')):
+      with self.assertRaises(ImportError):
+        create_csvs.mqdq_to_csv(self.data_file, output_file)
+
+    self.assertFalse(create_csvs.output_is_complete(output_file))
+    self.assertFalse(os.path.exists(quarantine_file))
+
+  def test_parse_process_that_cannot_load_raises(self):
+    process = fault_isolation.ParseProcess('no such profile')
+    with self.assertRaises(fault_isolation.ParserLoadError):
+      process.start()
+    self.assertFalse(process.running)
+
+
+  def test_failed_sentence_is_retried_with_strict_normalization(self):
+    def analyze(text):
+      if not text.isascii():
+        raise ValueError('Unrecognized value')
+      return TagAll().analyze(text)
+
+    tokenize_latin.use_nlp(mock.Mock(**{'analyze.side_effect': analyze}))
+    tags, parsed = tokenize_latin.analyze_text_isolated('Lāvīnia venit.')
+    self.assertTrue(parsed)
+    self.assertEqual(
+        [(tag.string, tag.pos) for tag in tags],
+        [('Lāvīnia', 'noun'), ('venit', 'noun'), ('.', 'punctuation')])
+
+  def test_unparseable_sentence_is_quarantined(self):
+    quarantine_file = os.path.join(self.directory, 'quarantine.jsonl')
+    tokenize_latin.use_quarantine(quarantine_file)
+    tokenize_latin.use_nlp(mock.Mock(**{
+        'analyze.side_effect': ValueError('Unrecognized value')}))
+
+    tags, parsed = tokenize_latin.analyze_text_isolated(
+        'arma virumque', sentence='Arma virumque')
+    self.assertFalse(parsed)
+    self.assertEqual(
+        [(tag.string, tag.pos) for tag in tags],
+        [('arma', 'unparsed'), ('virumque', 'unparsed')])
+    [record] = fault_isolation.Quarantine(quarantine_file).records()
+    self.assertEqual(
+        (record['sentence'], record['text'], record['reason'],
+         record['error']),
+        ('Arma virumque', 'arma virumque', 'error',
+         'ValueError: Unrecognized value'))
+
+  def test_sentence_over_time_limit_is_quarantined(self):
+    quarantine_file = os.path.join(self.directory, 'quarantine.jsonl')
+    tokenize_latin.use_quarantine(quarantine_file, timeout_seconds=1)
+    process = mock.Mock(running=True, **{
+        'analyze.side_effect': fault_isolation.SentenceTimeout('Too long.')})
+    with mock.patch.object(tokenize_latin, 'parse_process', process):
+      _, parsed = tokenize_latin.analyze_text_isolated('arma virumque')
+
+    self.assertFalse(parsed)
+    process.analyze.assert_called_once_with('arma virumque', 1)
+    self.assertEqual(
+        [record['reason'] for record in
+         fault_isolation.Quarantine(quarantine_file).records()],
+        ['timeout'])
+
+  def test_parse_process_over_time_limit_is_killed(self):
+    process = fault_isolation.ParseProcess('default')
+    # A child that never answers:
+    process._process = subprocess.Popen(
+        [sys.executable, '-c', 'import time; time.sleep(60)'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding='utf-8')
+    child = process._process
+    with self.assertRaises(fault_isolation.SentenceTimeout):
+      process._read(0.1)
+    self.assertFalse(process.running)
+    self.assertIsNotNone(child.poll())
+
+
+class CorpusIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.directory = directory.name
+    self.index_path = os.path.join(self.directory, 'index.json')
+    self.data_files = [
+        os.path.join(self.directory, f'author{i}.json') for i in range(2)]
+    for data_file in self.data_files:
+      self.write_data_file(data_file, ParsingTestCase.sections)
+
+  def write_data_file(self, data_file: str, sections: list) -> None:
+    write_author_file(data_file, sections)
+    # (with the last section in another meter)
+    with open(data_file) as f:
+      data = json.load(f)
+    data['author_works'][0]['sections'][-1]['meter'] = 'Elegiacs'
+    with open(data_file, 'w') as f:
+      json.dump(data, f)
+
+  def build_index(self, data_files: list) -> tuple:
+    '''Build the index, returning it and the files that were read.'''
+    with mock.patch.object(
+        corpus_index, 'index_file', wraps=corpus_index.index_file) as index:
+      return corpus_index.build_index(data_files, self.index_path), [
+          args[0] for args, _ in index.call_args_list]
+
+  def test_tasks_match_those_read_from_the_file(self):
+    index, _ = self.build_index(self.data_files)
+    for allowed_meters in (None, ['Hexameters'], ['Elegiacs']):
+      self.assertEqual(
+          corpus_index.section_tasks(
+              index, self.data_files[0], allowed_meters),
+          section_pool.section_tasks(self.data_files[0], allowed_meters))
+    self.assertEqual(
+        corpus_index.total_lines(index, self.data_files, ['Hexameters']), 8)
+
+  def test_only_changed_files_are_indexed_again(self):
+    self.assertEqual(self.build_index(self.data_files)[1], self.data_files)
+    self.assertEqual(self.build_index(self.data_files)[1], [])
+
+    self.write_data_file(self.data_files[1], [['Arma virumque cano.']])
+    index, indexed = self.build_index(self.data_files[1:])
+    self.assertEqual(indexed, self.data_files[1:])
+    self.assertEqual(
+        [section['lines'] for section in index[self.data_files[1]][
+            'sections']], [1])
+    self.assertEqual(
+        index[self.data_files[1]]['sha256'],
+        corpus_index.file_hash(self.data_files[1]))
+
+    # (the entries of files not in a run are kept)
+    with open(self.index_path) as f:
+      self.assertEqual(sorted(json.load(f)), self.data_files)
+
+
+class CheckpointTest(ParsingTestCase):
+
+  def write_output(self, nlp, output_file: str) -> None:
+    tokenize_latin.use_nlp(nlp)
+    create_csvs.mqdq_to_csv(self.data_file, output_file, write_lines=1)
+
+  def test_resumed_output_matches_uninterrupted_output(self):
+    expected_file = os.path.join(self.directory, 'expected.csv')
+    self.write_output(TagAll('noun'), expected_file)
+
+    output_file = os.path.join(self.directory, 'author.csv')
+    with self.assertRaises(KeyboardInterrupt):
+      self.write_output(TagAll('noun', interrupt_at='Musa'), output_file)
+    self.assertFalse(create_csvs.output_is_complete(output_file))
+    # As if the interrupted section had been partly written:
+    with open(output_file, 'a') as f:
+      f.write('"Musa, mihi",\n')
+
+    self.write_output(TagAll('noun'), output_file)
+    with open(output_file) as f, open(expected_file) as expected:
+      self.assertEqual(f.read(), expected.read())
+    self.assertTrue(create_csvs.output_is_complete(output_file))
+    self.assertEqual(
+        [section['href'] for section in
+         create_csvs.read_checkpoint(output_file)['sections']],
+        ['section0', 'section1'])
+
+  def test_finished_sections_are_not_parsed_again(self):
+    output_file = os.path.join(self.directory, 'author.csv')
+    with self.assertRaises(KeyboardInterrupt):
+      self.write_output(TagAll('noun', interrupt_at='Musa'), output_file)
+
+    self.write_output(TagAll('verb'), output_file)
+    output = self.read_output(output_file)
+    self.assertTrue(output['text_parsed'][:4].str.contains('noun').all())
+    self.assertTrue(output['text_parsed'][4:].str.contains('verb').all())
+
+  def test_output_without_manifest_is_complete(self):
+    output_file = os.path.join(self.directory, 'author.csv')
+    self.assertFalse(create_csvs.output_is_complete(output_file))
+    with open(output_file, 'w') as f:
+      f.write('text\n')
+    self.assertTrue(create_csvs.output_is_complete(output_file))
+
+
+class SectionPoolTest(ParsingTestCase):
+  '''Runs the section pool's workers in this process.'''
+
+  def setUp(self):
+    super().setUp()
+    tokenize_latin.use_nlp(TagAll())
+    for worker_state, values in (
+        (section_pool._worker_settings,
+         {'excluded_parts_of_speech': [], 'write_lines': 1}),
+        (section_pool._worker_author, {})):
+      patcher = mock.patch.dict(worker_state, values)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.output_file = create_csvs.output_file_name(
+        self.data_file, os.path.join(self.directory, 'output'))
+
+  def write_part_files(self, tasks: list) -> dict:
+    os.makedirs(os.path.dirname(self.output_file), exist_ok=True)
+    checkpoint = create_csvs.resume_checkpoint(
+        self.output_file, self.data_file)
+    os.makedirs(f'{self.output_file}.parts', exist_ok=True)
+    for task in tasks:
+      section_pool._process_section(task, self.output_file)
+    return checkpoint
+
+  def expected_output(self) -> str:
+    expected_file = os.path.join(self.directory, 'expected.csv')
+    create_csvs.mqdq_to_csv(self.data_file, expected_file, write_lines=1)
+    with open(expected_file) as f:
+      return f.read()
+
+  def test_section_tasks_are_in_file_order(self):
+    tasks = section_pool.section_tasks(self.data_file)
+    self.assertEqual(
+        [(task['href'], task['lines']) for task in tasks],
+        [('section0', 4), ('section1', 1)])
+
+  def test_sections_parsed_out_of_order_are_merged_in_order(self):
+    tasks = section_pool.section_tasks(self.data_file)
+    checkpoint = self.write_part_files(reversed(tasks))
+    section_pool.merge_part_files(self.output_file, tasks, checkpoint)
+
+    with open(self.output_file) as f:
+      self.assertEqual(f.read(), self.expected_output())
+    self.assertTrue(create_csvs.output_is_complete(self.output_file))
+    self.assertEqual(
+        len(create_csvs.read_checkpoint(self.output_file)['sections']), 2)
+    self.assertFalse(os.path.exists(f'{self.output_file}.parts'))
+
+  def test_finished_part_files_are_merged_without_workers(self):
+    self.write_part_files(section_pool.section_tasks(self.data_file))
+    with mock.patch.object(section_pool.multiprocessing, 'Pool') as pool:
+      section_pool.mqdq_files_to_csv(
+          [self.data_file], os.path.dirname(self.output_file), 1,
+          write_lines=1)
+    pool.assert_not_called()
+
+    with open(self.output_file) as f:
+      self.assertEqual(f.read(), self.expected_output())
+
+
+class ArtifactStoreTest(ParsingTestCase):
+
+  def run_pipeline(self, nlp, **parameters) -> str:
+    '''Write the output of data_file as pipeline.py does with the artifact
+    store, parsing with nlp.'''
+    store = artifact_store.ArtifactStore(os.path.join(self.directory, 'store'))
+    output_directory = os.path.join(self.directory, 'output')
+    files_to_process, keys = artifact_store.reuse_outputs(
+        store, [self.data_file], output_directory,
+        artifact_store.output_parameters(**parameters))
+    tokenize_latin.use_nlp(nlp)
+    for data_file in files_to_process:
+      create_csvs.mqdq_to_csv(
+          data_file, create_csvs.output_file_name(data_file, output_directory),
+          write_lines=1, artifact_key=keys[data_file])
+    artifact_store.store_outputs(store, keys, output_directory)
+    return create_csvs.output_file_name(self.data_file, output_directory)
+
+  def test_interrupted_output_with_other_parameters_is_started_again(self):
+    with self.assertRaises(KeyboardInterrupt):
+      self.run_pipeline(
+          TagAll('noun', interrupt_at='Musa'), analyze_batch_size=1)
+    output_file = create_csvs.output_file_name(
+        self.data_file, os.path.join(self.directory, 'output'))
+    self.assertEqual(
+        len(create_csvs.read_checkpoint(output_file)['sections']), 1)
+
+    output_file = self.run_pipeline(TagAll('verb'), analyze_batch_size=2)
+    output = self.read_output(output_file)
+    self.assertEqual(len(output), sum(map(len, self.sections)))
+    self.assertFalse(output['text_parsed'].str.contains('noun').any())
+    self.assertTrue(create_csvs.output_is_complete(output_file))
+
+  def test_interrupted_output_with_same_parameters_is_resumed(self):
+    with self.assertRaises(KeyboardInterrupt):
+      self.run_pipeline(
+          TagAll('noun', interrupt_at='Musa'), analyze_batch_size=1)
+
+    output_file = self.run_pipeline(TagAll('verb'), analyze_batch_size=1)
+    output = self.read_output(output_file)
+    self.assertEqual(len(output), sum(map(len, self.sections)))
+    self.assertEqual(
+        list(output['section_url']), ['section0'] * 4 + ['section1'])
+    self.assertTrue(output['text_parsed'][:4].str.contains('noun').all())
+    self.assertTrue(output['text_parsed'][4:].str.contains('verb').all())
+
+  def test_stored_output_is_reused(self):
+    output_file = self.run_pipeline(TagAll('noun'), analyze_batch_size=1)
+    os.remove(output_file)
+    os.remove(create_csvs.checkpoint_file_name(output_file))
+    with mock.patch.object(create_csvs, 'mqdq_to_csv') as mqdq_to_csv:
+      self.run_pipeline(TagAll('verb'), analyze_batch_size=1)
+    mqdq_to_csv.assert_not_called()
+    self.assertTrue(
+        self.read_output(output_file)['text_parsed'].str.contains(
+            'noun').all())
+
+
+class OverlappedWritingTest(ParsingTestCase):
+
+  def write_output(self, nlp, output_file: str, overlapped: bool) -> str:
+    tokenize_latin.use_nlp(nlp)
+    create_csvs.mqdq_to_csv(
+        self.data_file, output_file, write_lines=3, overlapped=overlapped)
+    with open(output_file) as f:
+      return f.read()
+
+  def test_matches_sequential_output(self):
+    self.assertEqual(
+        self.write_output(
+            TagAll(), os.path.join(self.directory, 'overlapped.csv'), True),
+        self.write_output(
+            TagAll(), os.path.join(self.directory, 'sequential.csv'), False))
+
+  def test_interrupted_output_keeps_finished_sections(self):
+    output_file = os.path.join(self.directory, 'author.csv')
+    with self.assertRaises(KeyboardInterrupt):
+      self.write_output(TagAll(interrupt_at='Musa'), output_file, True)
+    self.assertEqual(
+        [section['href'] for section in
+         create_csvs.read_checkpoint(output_file)['sections']], ['section0'])
+    self.assertEqual(len(self.read_output(output_file)), 4)
+
+  def test_adaptive_batch_size_records_write_time(self):
+    tokenize_latin.use_nlp(TagAll())
+    write_lines = adaptive_batching.AdaptiveBatchSize(initial=2)
+    write_lines_to_csv = create_csvs.write_lines_to_csv
+
+    def slow_write(*args):
+      time.sleep(0.05)
+      write_lines_to_csv(*args)
+
+    output_file = os.path.join(self.directory, 'author.csv')
+    with mock.patch.object(create_csvs, 'write_lines_to_csv', slow_write), \
+        mock.patch.object(write_lines, 'record',
+                          wraps=write_lines.record) as record:
+      create_csvs.mqdq_to_csv(
+          self.data_file, output_file, write_lines=write_lines,
+          overlapped=True)
+
+    self.assertEqual(
+        len(self.read_output(output_file)), sum(map(len, self.sections)))
+    self.assertTrue(record.called)
+    for (lines, parse_seconds, write_seconds), _ in record.call_args_list:
+      self.assertGreaterEqual(write_seconds, 0.05)
+
+
+class RunMetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    run_metrics.reset()
+    self.addCleanup(run_metrics.reset)
+
+  def test_nested_stage_time_is_counted_once(self):
+    with mock.patch.object(
+        run_metrics.time, 'perf_counter', side_effect=[0, 1, 4, 10]):
+      with run_metrics.stage('outer'):
+        with run_metrics.stage('inner'):
+          pass
+
+    stages = run_metrics.summary()['stages']
+    self.assertEqual(
+        {name: (stage['calls'], stage['seconds'])
+         for name, stage in stages.items()},
+        {'outer': (1, 7), 'inner': (1, 3)})
+    self.assertEqual(stages['outer']['share'], 0.7)
+
+  def test_worker_metrics_are_merged(self):
+    with run_metrics.section('author.json', 0, 0):
+      run_metrics.count('lines', 3)
+      run_metrics.observe('batch_size', 10)
+    metrics = run_metrics.take()
+    self.assertEqual(run_metrics.summary()['counters'], {})
+
+    run_metrics.merge(metrics)
+    run_metrics.merge(json.loads(json.dumps(metrics)))
+    summary = run_metrics.summary()
+    self.assertEqual(summary['counters'], {'lines': 6})
+    self.assertEqual(summary['files']['author.json']['lines'], 6)
+    self.assertEqual(len(summary['sections']), 2)
+    self.assertEqual(summary['values']['batch_size']['counts'], {'10': 2})
+
+
+class LazyImportTest(unittest.TestCase):
+
+  def test_pipeline_starts_without_heavy_imports(self):
+    # (in a new interpreter, since this one has imported them for the tests)
+    imported = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, pipeline; print(" ".join(sorted(set(sys.modules) & '
+         '{"cltk", "numpy", "pandas", "pyarrow", "stanza", "torch"})))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True,
+        text=True, check=True).stdout.split()
+    self.assertEqual(imported, [])
+
+
+class SectionProfilerTest(unittest.TestCase):
+
+  def test_keeps_slowest_sections(self):
+    profiler = section_profiler.SectionProfiler(top_n=2)
+    profiler.merge([
+        {'href': f'section{seconds}', 'seconds': seconds, 'samples': 0,
+         'stacks': {}} for seconds in (1, 3, 2)])
+    self.assertEqual(
+        [profile['href'] for profile in profiler.profiles()],
+        ['section3', 'section2'])
+
+  def test_samples_the_running_section(self):
+    def spin_section(seconds):
+      end = time.perf_counter() + seconds
+      while time.perf_counter() < end:
+        pass
+
+    profiler = section_profiler.SectionProfiler(interval_seconds=0.001)
+    token = profiler.start()
+    spin_section(0.1)
+    profiler.finish(token, {'href': 'section0', 'seconds': 0.1})
+
+    with tempfile.TemporaryDirectory() as directory:
+      [entry] = profiler.write(directory)
+      self.assertTrue(os.path.exists(
+          os.path.join(directory, entry['stacks_file'])))
+    self.assertGreater(entry['samples'], 0)
+    self.assertIn('spin_section', entry['top_functions'][0][0])
+
+
+class AggregateTest(unittest.TestCase):
+
+  # (section_meter, tokens, enumerativeness) per line:
+  lines = [('Hexameters', 5, 1.0), ('Hexameters', 5, 0.9),
+           ('Hexameters', 3, 1.0), ('Unknown', 4, 0.5),
+           ('Lyric', 6, 1.0), ('Hexameters', 4, None)]
+
+  meter_corrections = pd.DataFrame({
+      'author_name': ['A. Persius Flaccus'], 'work_name': ['Satirae'],
+      'section_meter': ['Unknown'], 'Corrected_meter': ['Hexameters']})
+
+  def test_summarizes_csv_and_parquet_output(self):
+    output = pd.DataFrame([
+        {'author_name': 'A. Persius Flaccus ', 'author_date': '34 - 62',
+         'work_name': 'Satirae', 'section_meter': meter, 'tokens': tokens,
+         'enumerativeness': enumerativeness}
+        for meter, tokens, enumerativeness in self.lines])
+    date_corrections = aggregate.read_cleaning_csv(
+        os.path.join(aggregate.analysis_directory, 'dates_cleaning.csv'))
+
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'A. Persius Flaccus.csv')
+      output.to_csv(path, index=False)
+      output.to_parquet(os.path.splitext(path)[0] + '.parquet')
+      for output_file in (path, os.path.splitext(path)[0] + '.parquet'):
+        summary = aggregate.summarize_file(
+            output_file, self.meter_corrections, date_corrections,
+            lines_threshold=3)
+        self.assertEqual(summary, [{
+            'folder': os.path.basename(directory),
+            'file': 'A. Persius Flaccus.csv',
+            'author_name': 'A. Persius Flaccus', 'date': 62, 'n': 4,
+            'high_count': 2, 'one_count': 1,
+            'enumerativeness_rate8': 0.5, 'enumerativeness_rate1': 0.25}])
+
+      self.assertEqual(
+          aggregate.summarize_file(
+              path, self.meter_corrections, date_corrections,
+              lines_threshold=4), [])
+
+
+class EstimateRatesTest(unittest.TestCase):
+
+  def test_no_events_is_not_certain(self):
+    # 50 sampled lines of 1200, none above the threshold:
+    blocks = np.array([[10, 10, 0, 0]] * 5, dtype=float)
+    estimate = sampling.estimate_rates([(1200, blocks, False)])
+    self.assertEqual(estimate['rate8'], 0)
+    self.assertGreater(estimate['rate8_high'], .05)
+
+  def test_complete_strata_are_exact(self):
+    blocks = np.array([[10, 10, 3, 1]] * 5, dtype=float)
+    estimate = sampling.estimate_rates([(50, blocks, True)])
+    self.assertEqual(
+        (estimate['rate8_low'], estimate['rate8'], estimate['rate8_high']),
+        (.3, .3, .3))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,190 @@
+'''Normalize MQDQ lines for parsing in a single pass, and (only when asked)
+write a normalized copy of the corpus.
+
+tokenize_latin.prepare_input_text used to make four regular-expression passes
+over every line, and again over every sentence, and "Renaming Greek.py" made
+a whole extra read and rewrite of each author file, with json.load, to
+transliterate Greek before the pipeline ran. Here, transliteration (if
+wanted), punctuation removal, non-ASCII removal, and whitespace collapsing
+are done together in normalize_line(), whose results are cached, so a line or
+sentence that is seen again (e.g., a formulaic line repeated across the
+corpus) isn't normalized again. With
+tokenize_latin.use_greek_transliteration(), Greek is transliterated as lines
+are parsed, and the corpus doesn't need to be rewritten at all.
+
+normalize_corpus() still writes a transliterated copy of the corpus, for
+those who want one: each file is read and written one section at a time,
+files are written in parallel, and each is written to a temporary file that
+replaces the output only once it is complete, so an interrupted run never
+leaves a truncated file.
+
+Usage, from the root of this repository:
+
+  python3 text_normalization.py OUTPUT_DIRECTORY FILE.json [FILE.json ...] \\
+    [--workers 4]
+
+(OUTPUT_DIRECTORY may be the directory of the files, to replace them.)
+'''
+
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import re
+
+import mqdq_stream
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+# Punctuation to remove before parsing: <...> and [...] are editorial marks
+# in some MQDQ texts (CLTK was treating words that started with '<' as verbs),
+# and quotes cause an error, 'CLTKException: Reference: Unrecognized value for
+# UD feature NumForm'.
+removed_punctuation = b'<>[]()\'"*'
+
+# The number of normalized lines to keep in normalize_line()'s cache:
+cache_size = 2 ** 16
+
+_whitespace = re.compile(r'\s+')
+
+
+def transliterate(text: str) -> str:
+  '''Transliterate Greek (and any other non-ASCII characters) into ASCII,
+  with unidecode, as "Renaming Greek.py" did.'''
+  import unidecode
+
+  return unidecode.unidecode(text)
+
+
+@functools.lru_cache(maxsize=cache_size)
+def normalize_line(text: str, transliterate_greek: bool = False) -> str:
+  '''Prepare a line (or sentence) for parsing with CLTK.
+
+  Args:
+    text: A string to be processed.
+
+    transliterate_greek: Whether to transliterate Greek words (see
+      transliterate()), rather than remove them. Defaults to False.
+
+  Output: text with the characters in removed_punctuation and all
+    non-ASCII characters (e.g., Greek words, if not transliterated) removed,
+    each run of whitespace made a single space, and spaces before commas
+    (where a word has been removed) removed.
+  '''
+  if transliterate_greek:
+    text = transliterate(text)
+
+  # Removing the punctuation and the non-ASCII characters in the same
+  # (C-speed) pass:
+  ascii_text = text.encode('ascii', 'ignore').translate(
+      None, removed_punctuation).decode('ascii')
+
+  return _whitespace.sub(' ', ascii_text).replace(' ,', ',')
+
+
+def normalize_file(data_file: str, output_file: str) -> str:
+  '''Write a copy of an MQDQ author file with every line transliterated
+  (see transliterate()). The file is read and written one section at a time
+  (see mqdq_stream), to a temporary file that replaces output_file once it is
+  complete.
+
+  Args:
+    data_file: The filename of a JSON file, as for create_csvs.mqdq_to_csv.
+
+    output_file: The file to write, which may be data_file itself.
+
+  Output: output_file.
+  '''
+  temporary_output_file = f'{output_file}.tmp'
+
+  with open(data_file, 'rb') as f, \
+      open(temporary_output_file, 'w', encoding='ascii') as output:
+    stream = mqdq_stream.JSONStream(f)
+
+    def write_members(members, write_value):
+      output.write('{')
+      for key_index, key in enumerate(members):
+        output.write((', ' if key_index > 0 else '') + json.dumps(key) + ': ')
+        write_value(key)
+      output.write('}')
+
+    def write_elements(write_element):
+      output.write('[')
+      for element_index, _ in enumerate(stream.elements()):
+        output.write(', ' if element_index > 0 else '')
+        write_element()
+      output.write(']')
+
+    def write_section():
+      section = stream.value()
+      if 'lines' in section:
+        section['lines'] = [transliterate(line) for line in section['lines']]
+      output.write(json.dumps(section))
+
+    def write_work_value(key):
+      if key == 'sections':
+        write_elements(write_section)
+      else:
+        output.write(json.dumps(stream.value()))
+
+    def write_author_value(key):
+      if key == 'author_works':
+        write_elements(lambda: write_members(
+            stream.members(), write_work_value))
+      else:
+        output.write(json.dumps(stream.value()))
+
+    write_members(stream.members(), write_author_value)
+
+  os.replace(temporary_output_file, output_file)
+  return output_file
+
+
+def _normalize_file(arguments: tuple) -> str:
+  data_file, output_file = arguments
+  logger.info('Transliterating "%s"...', data_file)
+  return normalize_file(data_file, output_file)
+
+
+def normalize_corpus(data_files: list, output_directory: str,
+                     number_of_workers: int = 1) -> list:
+  '''Write a transliterated copy (see normalize_file()) of each of
+  data_files to output_directory, under the same name.
+
+  Args:
+    data_files: A list of MQDQ author files.
+
+    output_directory: The directory to write to. If it is the directory of
+      data_files, they are replaced.
+
+    number_of_workers: The number of files to write at once, each in its own
+      process. Defaults to 1.
+
+  Output: A list of the files written.
+  '''
+  os.makedirs(output_directory, exist_ok=True)
+  tasks = [
+      (data_file, os.path.join(output_directory, os.path.basename(data_file)))
+      for data_file in data_files]
+
+  if number_of_workers <= 1:
+    return [_normalize_file(task) for task in tasks]
+
+  with multiprocessing.Pool(number_of_workers) as pool:
+    return pool.map(_normalize_file, tasks, chunksize=1)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('output_directory')
+  parser.add_argument('data_files', nargs='+')
+  parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+  args = parser.parse_args()
+
+  logger.setLevel(logging.INFO)
+  normalize_corpus(
+      args.data_files, args.output_directory,
+      number_of_workers=args.workers)
@@ -1,15 +1,349 @@
-from cltk import NLP
-from cltk.sentence.lat import LatinPunktSentenceTokenizer
-from collections import Counter
 import itertools
+import logging
 import re
 
-cltk_nlp = NLP(language="lat")
+import compact_tags
+import fault_isolation
+from morphology_memo import MorphologyMemo
+from parse_cache import ParseCache, cltk_version
+from parse_server import ParseClient, ServerError, SettingsMismatch
+import run_metrics
+import sentence_stream
+import text_normalization
+
+logger = logging.getLogger('mqdq_tokenization')
+logging.basicConfig()
+
+# which CLTK pipeline to build (see use_pipeline_profile()), and how many
+# sentences to send to it in one analyze call
+pipeline_profile = 'default'
+analyze_batch_size = 1
+
+# the CLTK NLP object, built by get_nlp() the first time it is needed
+# (CLTK itself is only imported then, since importing it takes seconds)
+cltk_nlp = None
 
 # this tokenizer is used to group words into sentences (rather than lines), to improve accuracy of tokenization
-sentence_tokenizer = LatinPunktSentenceTokenizer()
+# (built by get_sentence_tokenizer() the first time it is needed)
+sentence_tokenizer = None
+
+# the number of sentences of lookahead to keep when splitting a section into
+# sentences as its lines are read (see sentence_stream.py); None splits the
+# whole section before parsing any of it
+sentence_lookahead = 2
+
+# the longest to spend parsing one sentence, in seconds, before giving up on it
+# (see fault_isolation.py); None waits indefinitely
+sentence_timeout_seconds = None
+
+# with a sentence timeout, text is parsed in a fault_isolation.ParseProcess,
+# which can be killed, rather than with cltk_nlp in this process (see
+# get_parse_process())
+parse_process = None
+
+# an optional fault_isolation.Quarantine, for sentences that couldn't be
+# parsed, set with use_quarantine()
+quarantine = None
+
+# the href of the section being parsed, for the quarantine
+current_section_href = None
+
+# an optional parse_cache.ParseCache, set with use_parse_cache()
+parse_cache = None
+
+# an optional morphology_memo.MorphologyMemo, set with use_morphology_memo();
+# in fast mode, sentences whose every word form has a certain analysis in it
+# aren't parsed, and if learning, the analyses of parsed sentences are added
+morphology_memo = None
+morphology_fast_mode = False
+morphology_learn = True
+
+# an optional parse_server.ParseClient, set with use_parse_server()
+parse_server = None
+
+# whether to transliterate Greek words before parsing, rather than remove them
+# (set with use_greek_transliteration())
+transliterate_greek = False
+
+
+def use_parse_cache(path: str, max_entries: int = 2000000) -> None:
+  '''Store and look up sentence parses in a persistent cache, so that
+  re-running the pipeline over unchanged text skips CLTK. Parses are only
+  reused with the same CLTK version, pipeline profile, and batch size (see
+  parse_cache_version()).
+
+  Args:
+    path: The SQLite file to keep the cache in, or None to stop using a cache.
+
+    max_entries: The maximum number of sentences to keep in the cache.
+  '''
+  global parse_cache
+
+  if parse_cache is not None:
+    parse_cache.close()
+
+  parse_cache = ParseCache(
+      path, max_entries=max_entries,
+      version=parse_cache_version()) if path is not None else None
+
+
+def parse_cache_version() -> str:
+  '''The parse cache version for the current settings: the CLTK version,
+  with the pipeline profile and batch size, which both change the tokens a
+  sentence is given, so that sentences parsed with others aren't reused.'''
+  return (f'{cltk_version()} {pipeline_profile} '
+          f'batch {analyze_batch_size}')
+
+
+def use_quarantine(path: str, timeout_seconds: float = None) -> None:
+  '''Record sentences that couldn't be parsed in a quarantine file, and set
+  a time limit for parsing each sentence (see fault_isolation.py).
+
+  Args:
+    path: The JSON Lines file to append to, or None to only log them.
+
+    timeout_seconds: The longest to spend parsing one sentence, or None to
+      wait indefinitely. Defaults to None.
+  '''
+  global quarantine, sentence_timeout_seconds, parse_process
+
+  quarantine = fault_isolation.Quarantine(path) if path is not None else None
+  sentence_timeout_seconds = timeout_seconds
+  if timeout_seconds is None and parse_process is not None:
+    parse_process.close()
+    parse_process = None
+
+
+def use_morphology_memo(path: str, fast: bool = False, learn: bool = True,
+                        **options) -> None:
+  '''Count the analyses CLTK gives each word form in a morphology memo, and
+  optionally use them in place of parsing (see morphology_memo.py).
+
+  Args:
+    path: The SQLite file to keep the memo in, or None to stop using one.
+
+    fast: Whether to give sentences whose every word form has a certain
+      analysis in the memo those analyses, without parsing them. This can
+      change scores; see morphology_memo.drift_report(). Defaults to False.
+
+    learn: Whether to add the analyses of each sentence parsed to the memo.
+      Defaults to True.
+
+    options: Passed to morphology_memo.MorphologyMemo, e.g., min_count.
+  '''
+  global morphology_memo, morphology_fast_mode, morphology_learn
+
+  if morphology_memo is not None:
+    morphology_memo.close()
+
+  morphology_memo = MorphologyMemo(
+      path, **options) if path is not None else None
+  morphology_fast_mode = fast
+  morphology_learn = learn
+
 
+def parser_settings() -> dict:
+  '''The settings in this process that change how text is parsed, which a
+  parse server must share to parse for it.'''
+  return {
+      'pipeline_profile': pipeline_profile,
+      'analyze_batch_size': analyze_batch_size,
+      'transliterate_greek': transliterate_greek,
+      'sentence_timeout_seconds': sentence_timeout_seconds,
+      'morphology_fast_mode':
+          morphology_memo is not None and morphology_fast_mode,
+  }
 
+
+def use_parse_server(socket_path: str) -> bool:
+  '''Send sections to a parse server (see parse_server.py) for parsing, if
+  one is running, rather than loading CLTK in this process. Sections are
+  only parsed there if the server's parser_settings() match this process's
+  at the time; otherwise, they're parsed here.
+
+  Args:
+    socket_path: The server's Unix socket, or None to stop using a server.
+
+  Output: Whether a server was found. If not, sections are parsed in this
+    process.
+  '''
+  global parse_server
+
+  if parse_server is not None:
+    parse_server.close()
+    parse_server = None
+
+  if socket_path is None:
+    return False
+
+  try:
+    parse_server = ParseClient(socket_path)
+  except OSError:
+    logger.info(
+        'No parse server is running at "%s"; parsing in this process.',
+        socket_path)
+    return False
+
+  logger.info('Parsing with the parse server at "%s".', socket_path)
+  return True
+
+
+def build_nlp(profile: str = 'default'):
+  '''Build a CLTK NLP object for Latin.
+
+  Args:
+    profile: Either "default", for CLTK's full default Latin pipeline, or
+      "minimal", for a pipeline with only the processes whose output this
+      project reads (each word's string, lemma, part of speech, and case):
+      CLTK's Latin normalization, followed by Stanza, which tokenizes,
+      lemmatizes, and tags. The embeddings, stopword, named entity, and
+      lexicon processes of the default pipeline are skipped.
+  '''
+  from cltk import NLP
+
+  if profile == 'default':
+    return NLP(language="lat")
+
+  if profile == 'minimal':
+    from cltk.alphabet.processes import LatinNormalizeProcess
+    from cltk.core.data_types import Pipeline
+    from cltk.dependency.processes import LatinStanzaProcess
+    from cltk.languages.utils import get_lang
+
+    return NLP(
+        language="lat",
+        custom_pipeline=Pipeline(
+            description='Latin tokenization and morphosyntax only',
+            processes=[LatinNormalizeProcess, LatinStanzaProcess],
+            language=get_lang('lat')),
+        suppress_banner=True)
+
+  raise ValueError(f'Unknown CLTK pipeline profile "{profile}".')
+
+
+def get_nlp():
+  '''The CLTK NLP object for the current pipeline profile, built on first
+  use.'''
+  global cltk_nlp
+
+  if cltk_nlp is None:
+    with run_metrics.stage('load_model'):
+      cltk_nlp = build_nlp(pipeline_profile)
+
+  return cltk_nlp
+
+
+def get_parse_process() -> fault_isolation.ParseProcess:
+  '''The fault_isolation.ParseProcess for the current pipeline profile, with
+  its models loaded.'''
+  global parse_process
+
+  if parse_process is None:
+    parse_process = fault_isolation.ParseProcess(pipeline_profile)
+  if not parse_process.running:
+    with run_metrics.stage('load_model'):
+      parse_process.start()
+  return parse_process
+
+
+def load_parser(timeout_seconds: float = None) -> None:
+  '''Load the models that analyze_text(text, timeout_seconds) parses with:
+  get_nlp()'s, or, with a timeout, get_parse_process()'s (starting it again
+  if it was killed).
+
+  Raises any error in loading them (e.g., ImportError if CLTK isn't
+  installed, or fault_isolation.ParserLoadError), which, unlike an error in
+  parsing one sentence, every sentence would have, and so stops the run.
+  '''
+  if timeout_seconds is not None:
+    get_parse_process()
+  else:
+    get_nlp()
+
+
+def get_sentence_tokenizer():
+  '''CLTK's Latin sentence tokenizer, built on first use.'''
+  global sentence_tokenizer
+
+  if sentence_tokenizer is None:
+    from cltk.sentence.lat import LatinPunktSentenceTokenizer
+
+    with run_metrics.stage('load_model'):
+      sentence_tokenizer = LatinPunktSentenceTokenizer()
+
+  return sentence_tokenizer
+
+
+def use_pipeline_profile(profile: str, batch_size: int = 1) -> None:
+  '''Choose the CLTK pipeline used for parsing.
+
+  Args:
+    profile: "default" or "minimal"; see build_nlp().
+
+    batch_size: The number of sentences to parse in one analyze call.
+      Sentences are joined for parsing and the resulting tokens are split
+      back into sentences; if they can't be matched up exactly, the batch is
+      parsed one sentence at a time instead. Defaults to 1.
+  '''
+  global cltk_nlp, pipeline_profile, analyze_batch_size, parse_process
+
+  if profile not in ('default', 'minimal'):
+    raise ValueError(f'Unknown CLTK pipeline profile "{profile}".')
+
+  if profile != pipeline_profile:
+    cltk_nlp = None
+    if parse_process is not None:
+      parse_process.close()
+      parse_process = None
+  pipeline_profile = profile
+  analyze_batch_size = max(1, batch_size)
+  if parse_cache is not None:
+    parse_cache.version = parse_cache_version()
+
+
+def use_greek_transliteration(enabled: bool) -> None:
+  '''Transliterate Greek words (see text_normalization.transliterate()) as
+  text is prepared for parsing, rather than removing them, with the same
+  result as running "Renaming Greek.py" over the corpus first. The "text"
+  of each output line is left as it is in the corpus.
+
+  Args:
+    enabled: Whether to transliterate.
+  '''
+  global transliterate_greek
+
+  transliterate_greek = enabled
+
+
+def use_nlp(nlp) -> None:
+  '''Parse with nlp in place of the CLTK pipeline from build_nlp(), e.g., a
+  deterministic stand-in for benchmarking (see benchmarks/fake_nlp.py).
+
+  Args:
+    nlp: An object with an analyze(text=...) method that returns an object
+      like a CLTK Doc (see tags_from_doc()), or None to go back to building
+      the current profile's CLTK pipeline.
+  '''
+  global cltk_nlp
+
+  cltk_nlp = nlp
+
+
+def use_sentence_tokenizer(tokenizer) -> None:
+  '''Split sections into sentences with tokenizer in place of CLTK's, e.g.,
+  a deterministic stand-in for benchmarking (see benchmarks/fake_nlp.py).
+
+  Args:
+    tokenizer: An object with a tokenize(text) method that returns a list of
+      sentences, each a substring of text, in order, or None to go back to
+      CLTK's Latin sentence tokenizer.
+  '''
+  global sentence_tokenizer
+
+  sentence_tokenizer = tokenizer
+
+
+@run_metrics.timed('prepare_input_text')
 def prepare_input_text(text: str) -> str:
   '''Remove certain punctuation from a string to prepare it for parsing using
   CLTK.
@@ -21,108 +355,444 @@ def prepare_input_text(text: str) -> str:
   Also remove quotes, which cause an error,
   'CLTKException: Reference: Unrecognized value for UD feature NumForm'.
 
+  Also remove all non-ASCII characters (e.g. Greek words, unless
+  use_greek_transliteration() is on), and extra whitespace. All of this is
+  done in one pass, with results cached; see
+  text_normalization.normalize_line().
+
   Args:
     text: A string to be processed.
   '''
+  return text_normalization.normalize_line(text, transliterate_greek)
+
+def analyze_sentence(sentence: str) -> list:
+  '''Parse a single sentence with CLTK, using the parse cache if one is set.
+
+  Args:
+    sentence: A sentence from get_sentence_tokenizer().
+
+  Output: A list (one element per token) of compact_tags.Tokens, each of
+  which can be read as a dict (see compact_tags.as_dicts()) comprising:
+    - 'string': The token string
+    - 'lemma': The lemma of the string
+    - 'pos': The Part of Speech of the string
+    - 'case': A list of the token's case values, or None
+  '''
+  text = prepare_input_text(sentence)
+
+  tags = cached_tags(text)
+  if tags is not None:
+    return tags
+
+  tags, parsed = analyze_text_isolated(text, sentence)
+
+  if parsed:
+    store_tags(text, tags)
 
-  # remove problematic punctuation
-  punct_removed= re.sub('[<>\[\]\(\)\'\"\*]', '', text)
+  return tags
 
-  # remove all non-ASCII characters (e.g. Greek words)
-  # note that this removes non-Greek unicode as well 
-  # (it will remove everything not found here https://www.w3schools.com/charsets/ref_html_ascii.asp)
-  nonascii_removed = re.sub(r'[^\x00-\x7F]', '', punct_removed)
 
-  # delete extra white space (extra white space is introduced by removing Greek words)
-  # delete doubled spaces (make them just a single space)
-  space_removed = re.sub(r'\s+', ' ', nonascii_removed)
-  # delete spaces that occur before a comma (this happens where a word has been removed)
-  clean_text = re.sub(' ,', ',', space_removed)
+def cached_tags(text: str) -> list:
+  '''The tokens of text without parsing it: from the morphology memo, in
+  fast mode, or else from the parse cache. None if neither has them.'''
+  if morphology_memo is not None and morphology_fast_mode:
+    tags = morphology_memo.fast_tags(text)
+    if tags is not None:
+      return tags
+
+  if parse_cache is not None:
+    tags = parse_cache.get(text)
+    if tags is not None:
+      return compact_tags.from_dicts(tags)
+
+  return None
+
+
+def store_tags(text: str, tags: list) -> None:
+  '''Keep the tokens CLTK gave text in the parse cache and morphology memo,
+  if they are set.'''
+  if parse_cache is not None:
+    parse_cache.put(text, compact_tags.as_dicts(tags))
+  if morphology_memo is not None and morphology_learn:
+    morphology_memo.record(tags, text)
+
+
+def analyze_text(text: str, timeout_seconds: float = None) -> list:
+  '''Parse prepared text with CLTK, returning the tokens described in
+  analyze_sentence().
+
+  Args:
+    text: The prepared text.
+
+    timeout_seconds: If not None, text is parsed in get_parse_process(),
+      which is killed, raising fault_isolation.SentenceTimeout, if parsing
+      takes longer. Defaults to None, which parses in this process.
+  '''
+  if timeout_seconds is not None:
+    process = get_parse_process()
+    with run_metrics.stage('cltk_analyze'):
+      return compact_tags.from_dicts(process.analyze(text, timeout_seconds))
 
+  nlp = get_nlp()
+  with run_metrics.stage('cltk_analyze'):
+    return tags_from_doc(nlp.analyze(text=text))
 
-  return clean_text
 
-def tokenize_latin(input_text):
+def analyze_text_isolated(text: str, sentence: str = None) -> tuple:
+  '''Parse prepared text as analyze_text() does, but within
+  sentence_timeout_seconds, retrying with stricter normalization if that
+  fails, and giving the text unparsed tokens (and quarantining it) if that
+  fails too; see fault_isolation.py.
+
+  Args:
+    text: The prepared text of one sentence.
+
+    sentence: The sentence as it was split from the section, for the
+      quarantine. Defaults to text.
+
+  Output: A (tags, parsed) tuple, where tags is a list of tokens, as from
+    analyze_text(), and parsed is False if they are unparsed tokens.
+  '''
+  # The parser is loaded outside of the tries below, so that an error in
+  # loading it isn't taken for an error in this sentence:
+  load_parser(sentence_timeout_seconds)
+  try:
+    return analyze_text(text, sentence_timeout_seconds), True
+  except Exception as e:
+    error = e
+
+  strict_text = fault_isolation.strict_normalize(text)
+  if strict_text != text and strict_text != '':
+    logger.warning(
+        'Could not parse "%s" (%s: %s); retrying as "%s"...', text,
+        type(error).__name__, error, strict_text)
+    # (a parse process that timed out is started again here)
+    load_parser(sentence_timeout_seconds)
+    try:
+      tags = analyze_text(strict_text, sentence_timeout_seconds)
+      run_metrics.count('sentences_retried')
+      return fault_isolation.restore_strings(tags, text), True
+    except Exception as e:
+      error = e
+
+  logger.warning(
+      'Could not parse "%s" (%s: %s); marking it unparsed.', text,
+      type(error).__name__, error)
+  run_metrics.count('sentences_unparsed')
+  if quarantine is not None:
+    quarantine.add(
+        sentence if sentence is not None else text, text, error,
+        section_href=current_section_href)
+  return fault_isolation.unparsed_tags(text), False
+
+
+def tags_from_doc(cltk_doc) -> list:
+  '''Extract the tokens described in analyze_sentence() from a CLTK Doc, as
+  compact_tags.Tokens.'''
+  tags = []
+  for x in cltk_doc.words:
+    # Only the case is kept from the token's features:
+    case = None
+    for key, value in x.features.features.items():
+      if str(key) == 'Case':
+        case = [str(case_value) for case_value in value]
+    tags.append(compact_tags.Token(x.string, x.lemma, str(x.pos), case))
+  return tags
+
+
+def split_tags_by_text(tags: list, texts: list) -> list:
+  '''Split the tokens of several texts that were parsed together back into
+  one list per text.
+
+  Args:
+    tags: A list of token dicts (see analyze_sentence()).
+
+    texts: The texts that were joined with spaces and parsed to give tags.
+
+  Output: A list with one list of token dicts per element of texts, or None
+    if the tokens don't match the texts exactly.
+  '''
+  split_tags = []
+  tag_index = 0
+
+  for text in texts:
+    text_combined = re.sub(r'\s', '', text)
+    text_tags = []
+    offset = 0
+    while offset < len(text_combined):
+      if tag_index == len(tags) or not text_combined.startswith(
+          tags[tag_index]['string'], offset):
+        return None
+      offset += len(tags[tag_index]['string'])
+      text_tags.append(tags[tag_index])
+      tag_index += 1
+    split_tags.append(text_tags)
+
+  if tag_index != len(tags):
+    if len(split_tags) == 0 or any(
+        tag['string'] != '' for tag in tags[tag_index:]):
+      return None
+    split_tags[-1] += tags[tag_index:]
+
+  return split_tags
+
+
+def analyze_sentences(sentences: list):
+  '''Parse sentences with CLTK, analyze_batch_size sentences at a time.
+
+  Args:
+    sentences: An iterable of sentences from get_sentence_tokenizer() (e.g.,
+      from sentence_stream.iter_sentences()), which is only read as far as
+      is needed for the sentences parsed so far.
+
+  Output: A generator of lists of token dicts (see analyze_sentence()), one
+    per sentence, in order.
+  '''
+  if analyze_batch_size <= 1:
+    for sentence in sentences:
+      yield analyze_sentence(sentence)
+    return
+
+  sentences = iter(sentences)
+  while True:
+    batch_sentences = list(itertools.islice(sentences, analyze_batch_size))
+    if len(batch_sentences) == 0:
+      return
+    texts = [prepare_input_text(s) for s in batch_sentences]
+    batch_tags = [cached_tags(text) for text in texts]
+    uncached = [i for i, tags in enumerate(batch_tags) if tags is None]
+
+    if len(uncached) > 1:
+      load_parser(sentence_timeout_seconds)
+      try:
+        split_tags = split_tags_by_text(
+            analyze_text(
+                ' '.join(texts[i] for i in uncached),
+                sentence_timeout_seconds * len(uncached)
+                if sentence_timeout_seconds is not None else None),
+            [texts[i] for i in uncached])
+      except Exception as e:
+        # Each sentence is tried on its own below, so that only the one that
+        # failed is affected:
+        logger.warning('Batched parse failed (%s: %s).', type(e).__name__, e)
+        split_tags = None
+
+      if split_tags is None:
+        logger.info(
+            'Batched parse did not split back into sentences; parsing '
+            'them one at a time...')
+      else:
+        for i, tags in zip(uncached, split_tags):
+          batch_tags[i] = tags
+          store_tags(texts[i], tags)
+
+    for i, tags in enumerate(batch_tags):
+      if tags is None:
+        tags, parsed = analyze_text_isolated(texts[i], batch_sentences[i])
+        if parsed:
+          store_tags(texts[i], tags)
+      yield tags
+
+
+def tokenize_latin(input_text, section_href: str = None):
   '''Take input text in Latin, and output an array of dicts that include
     lemmas and parts of speech.
 
   Args:
     input_text: A list of text lines.
-    
+
+    section_href: The href of the section the lines are from, recorded with
+      any sentences that can't be parsed (see use_quarantine()). Defaults to
+      None.
+
   Output: A generator that produces a list (one element per input line) of 
   dicts, each of which comprises:
       - 'text': The original input string from the line
       - 'text_parsed': A string collating the text with its parsed part of
         speech.
-      - 'tags': A list (one element per token) of dicts, each of which 
-        comprises:
+      - 'tags': A list (one element per token) of compact_tags.Tokens, each
+        of which can be read as a dict comprising:
           - 'string': The original token string
           - 'lemma': The lemma of the string
           - 'pos': The Part of Speech of the string in the original text
   '''
+  global current_section_href
+
+  current_section_href = section_href
+
+  if parse_server is not None:
+    parsed_lines = tokenize_latin_on_server(input_text, section_href)
+    if parsed_lines is not None:
+      yield from parsed_lines
+      return
+
   # Break into sentences, *possibly* to speed up processing (vs.
   # processing potentially hundreds of lines of text at once), and
   # to avoid running out of memory for long passages:
-  sentences = sentence_tokenizer.tokenize(' '.join(input_text))
-
-  tags_generator = (
-      cltk_nlp.analyze(text=prepare_input_text(s)) for s in sentences)
-  staged_tags = []
-
-  for line in input_text:
-    relevant_tags = []
-    line_prepared = prepare_input_text(line)
-
-    # Reconstruct the original lines from the tags as the parser has split
-    # them:
-    # To do this, we will iterate through tokens until the original text (with
-    # whitespace removed) matches a collection of concatenated tokens.
-    # This approach seems necessary because CLTK sometimes includes punctuation
-    # marks with word tokens, and sometimes does not, making it difficult to
-    # match tokens with their original lines based on, e.g., length of the
-    # original line's text.
-
-    line_combined = re.sub(r'\s', '', line_prepared)
-
-    line_is_reconstructed = False
-    while line_is_reconstructed != True:
-      if ''.join([x.get('string') for x in relevant_tags]) != \
-          line_combined:
-        # CDB testing: next line
-        # print (line_combined)
-        if len(staged_tags) == 0:
-          # CDB testing: next line
-          # print (staged_tags)
-
-          cltk_doc = next(tags_generator)
-
-          staged_tags += [{
-            'string': x.string,
-            'lemma': x.lemma,
-            'pos': str(x.pos),
-            'case': {str(key): [str(case_value) for case_value in value] for \
-              key, value in x.features.features.items()}.get('Case')
-          } for x in cltk_doc.words]
-
-          # breakpoint()
-
-        relevant_tags.append(staged_tags[0])
-        del staged_tags[0]
-      else:
-        line_is_reconstructed = True
+  if sentence_lookahead is None:
+    with run_metrics.stage('sentence_tokenization'):
+      sentences = get_sentence_tokenizer().tokenize(' '.join(input_text))
+    run_metrics.count('sentences', len(sentences))
+  else:
+    # Sentences are split off as they are needed, so the first lines are
+    # parsed and yielded before the rest of the section has been split:
+    sentences = counted_sentences(sentence_stream.iter_sentences(
+        input_text, timed_sentence_tokenize, lookahead=sentence_lookahead))
+
+  tags_generator = analyze_sentences(sentences)
+
+  yield from align_tags_to_lines(input_text, tags_generator)
+
+  # Worker processes can be stopped without closing the memo or parse cache,
+  # so their counts and hit times are written after every section:
+  if morphology_memo is not None:
+    morphology_memo.flush()
+  if parse_cache is not None:
+    parse_cache.flush()
+
+
+def timed_sentence_tokenize(text: str) -> list:
+  '''Split text into sentences with get_sentence_tokenizer(), timed as
+  "sentence_tokenization".'''
+  tokenizer = get_sentence_tokenizer()
+  with run_metrics.stage('sentence_tokenization'):
+    return tokenizer.tokenize(text)
+
+
+def counted_sentences(sentences):
+  '''Count each of an iterable of sentences in run_metrics as it's read.'''
+  for sentence in sentences:
+    run_metrics.count('sentences')
+    yield sentence
+
+
+def tokenize_latin_on_server(input_text, section_href: str = None) -> list:
+  '''Parse input_text with the parse server, as tokenize_latin() would.
+
+  Output: A list of dicts, as from tokenize_latin(), or None if the
+    server couldn't parse input_text, which is then parsed in this process.
+    If the connection to the server was lost, or the server parses with
+    other settings, all later sections are parsed in this process too.
+  '''
+  global parse_server
+
+  try:
+    with run_metrics.stage('parse_server'):
+      response = parse_server.tokenize_latin(
+          list(input_text), section_href=section_href,
+          settings=parser_settings())
+  except SettingsMismatch as e:
+    logger.warning(
+        '%s Its settings are %s, and this process\'s are %s; parsing in '
+        'this process from now on.', e, e.server_settings, parser_settings())
+    parse_server.close()
+    parse_server = None
+    return None
+  except ServerError as e:
+    logger.warning('%s Parsing the section in this process...', e)
+    return None
+  except OSError as e:
+    logger.warning(
+        'Lost the connection to the parse server (%s); parsing in this '
+        'process from now on.', e)
+    parse_server.close()
+    parse_server = None
+    return None
+
+  run_metrics.count('sentences', response['sentences'])
+  run_metrics.count('lines', len(response['lines']))
+  for line in response['lines']:
+    line['tags'] = compact_tags.from_dicts(line['tags'])
+  return response['lines']
+
+
+def align_tags_to_lines(input_text, tags_generator):
+  '''Split a stream of parsed tokens back into the lines they came from.
 
-        # Create a plain-text string interspersing the original text with the
-        # part of speech, etc.:
-        line_with_parsing = ' '.join(
-            [f'{x["string"]} [{x["pos"]}{", " + ", ".join(x["case"]) + " case" if x["case"] is not None else ""}]' for x in relevant_tags])
+  Args:
+    input_text: A list of text lines.
 
-        yield {
-            'text': line,
-            'text_parsed': line_with_parsing,
-            'tags': relevant_tags,
-        }
+    tags_generator: An iterator of lists of token dicts (see
+      analyze_sentence()), one list per sentence, covering the text of
+      input_text in order.
 
+  Output: A generator of dicts, one per input line, as described in
+    tokenize_latin().
+  '''
+  staged_tags = []
+  # The position of the next unused token in staged_tags:
+  staged_index = 0
+  tags_exhausted = False
 
+  for line in input_text:
+    with run_metrics.stage('line_alignment'):
+      relevant_tags = []
+      line_prepared = prepare_input_text(line)
+
+      # Reconstruct the original lines from the tags as the parser has split
+      # them:
+      # To do this, we will iterate through tokens until the original text
+      # (with whitespace removed) matches a collection of concatenated
+      # tokens.
+      # This approach seems necessary because CLTK sometimes includes
+      # punctuation marks with word tokens, and sometimes does not, making it
+      # difficult to match tokens with their original lines based on, e.g.,
+      # length of the original line's text.
+      # Rather than re-joining all of the line's tokens after each new one,
+      # we check each new token against the line at a running character
+      # offset, so each line takes time linear in its length.
+
+      # (prepare_input_text leaves no whitespace other than single spaces)
+      line_combined = line_prepared.replace(' ', '')
+
+      offset = 0
+      in_sync = True
+      while offset < len(line_combined):
+        while staged_index == len(staged_tags) and not tags_exhausted:
+          try:
+            staged_tags = next(tags_generator)
+            staged_index = 0
+          except StopIteration:
+            tags_exhausted = True
+
+        if tags_exhausted:
+          logger.warning(
+              'Ran out of tokens while aligning line "%s"; the rest of the '
+              'section will have no tags.', line)
+          break
+
+        tag = staged_tags[staged_index]
+        staged_index += 1
+        relevant_tags.append(tag)
+
+        if in_sync and line_combined.startswith(tag['string'], offset):
+          offset += len(tag['string'])
+        else:
+          # The parser changed the text in a way that can't be matched to
+          # this line (previously, this would pull sentences until the section
+          # ran out). Fall back to assigning tokens to the line by length; the
+          # next line starts matching exactly again.
+          if in_sync:
+            logger.warning(
+                'Could not match token "%s" to line "%s"; aligning the rest '
+                'of the line by length.', tag['string'], line)
+            in_sync = False
+          offset += len(tag['string'])
+
+      # Create a plain-text string interspersing the original text with the
+      # part of speech, etc.:
+      line_with_parsing = ' '.join(
+          [f'{x.string} [{x.pos}{", " + ", ".join(x.case) + " case" if x.case_codes is not None else ""}]' for x in relevant_tags])
+    run_metrics.count('lines')
+
+    yield {
+        'text': line,
+        'text_parsed': line_with_parsing,
+        'tags': relevant_tags,
+    }
+
+
+@run_metrics.timed('enumerativeness')
 def enumerativeness(
   parsed_line: list,
   excluded_parts_of_speech:list = [],
@@ -168,22 +838,16 @@ def enumerativeness(
   
   # else :
 
-  cases = list(itertools.chain.from_iterable(
-    [tag.get('case', []) for tag in parsed_line.get('tags') if \
-      tag.get('pos') not in excluded_parts_of_speech and \
-        tag.get('case') is not None]))
-
-  case_counter = Counter(cases)
-  top_count_token_case = case_counter.most_common(1)[0][1] if \
-      len(case_counter) > 0 else 0
-
-  line_words = len([str(x['pos']) for x in parsed_line.get('tags') if str(
-      x['pos']) != 'punctuation'])
-
-  line_words_limited = len([str(x['pos']) for x in parsed_line.get(
-      'tags') if str(x['pos']) != 'punctuation' and
-      not any(excluded_pos in x['pos'] for excluded_pos in excluded_parts_of_speech)])
-
-  enumerativeness_dict = {"top_case" : top_count_token_case, "tokens" : line_words_limited, "enumerativeness" : round(top_count_token_case / line_words_limited, 3) if line_words_limited > 0 else None}
+  # The cases of tokens whose pos is excluded aren't counted; tokens that are
+  # punctuation, or whose pos contains an excluded pos, aren't counted as
+  # tokens. Both are counted in one pass over the tokens' pos and case codes
+  # (see compact_tags.enumerativeness()); dict tags (e.g., read back from
+  # output) are converted first.
+  tags = parsed_line.get('tags')
+  if len(tags) > 0 and not isinstance(tags[0], compact_tags.Token):
+    tags = compact_tags.from_dicts(tags)
+
+  enumerativeness_dict = compact_tags.enumerativeness(
+      tags, excluded_parts_of_speech)
 
   return enumerativeness_dict